@@ -167,6 +167,7 @@ class DINOv2InferConfig(EmbedderInferConfig):
     image_size_center_crop_pad: int
     instance_segmentation: bool
     mean_std_descriptor: str
+    max_batch_pixels: int = 1024 * 1024
 
     @classmethod
     def from_dict(cls, config: dict):
@@ -180,7 +181,8 @@ class DINOv2InferConfig(EmbedderInferConfig):
             use_cls_token=dino_v2_config['use_cls_token'],
             image_size_center_crop_pad=dino_v2_config['image_size_center_crop_pad'],
             instance_segmentation=dino_v2_config['instance_segmentation'],
-            mean_std_descriptor=dino_v2_config['mean_std_descriptor']
+            mean_std_descriptor=dino_v2_config['mean_std_descriptor'],
+            max_batch_pixels=dino_v2_config.get('max_batch_pixels', 1024 * 1024)
         )
 
     def to_structured_dict(self):
@@ -190,7 +192,8 @@ class DINOv2InferConfig(EmbedderInferConfig):
             'use_cls_token': self.use_cls_token,
             'image_size_center_crop_pad': self.image_size_center_crop_pad,
             'instance_segmentation': self.instance_segmentation,
-            'mean_std_descriptor': self.mean_std_descriptor
+            'mean_std_descriptor': self.mean_std_descriptor,
+            'max_batch_pixels': self.max_batch_pixels
         }
 
         return config
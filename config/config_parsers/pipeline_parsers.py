@@ -121,6 +121,8 @@ class PipelineSegmenterIOConfig(PipelineSegmenterConfig):
     boxes_geopackage_path: str
     aoi_geopackage_path: str
     output_folder: str
+    previous_masks_cache_path: str = None
+    incremental_iou_threshold: float = 0.95
 
     @classmethod
     def from_dict(cls, config: dict):
@@ -134,6 +136,8 @@ class PipelineSegmenterIOConfig(PipelineSegmenterConfig):
             boxes_geopackage_path=pipeline_segmenter_io_config['boxes_geopackage_path'],
             aoi_geopackage_path=pipeline_segmenter_io_config['aoi_geopackage_path'],
             output_folder=pipeline_segmenter_io_config['output_folder'],
+            previous_masks_cache_path=pipeline_segmenter_io_config.get('previous_masks_cache_path'),
+            incremental_iou_threshold=pipeline_segmenter_io_config.get('incremental_iou_threshold', 0.95),
         )
 
     def to_structured_dict(self):
@@ -143,6 +147,8 @@ class PipelineSegmenterIOConfig(PipelineSegmenterConfig):
             'boxes_geopackage_path': self.boxes_geopackage_path,
             'aoi_geopackage_path': self.aoi_geopackage_path,
             'output_folder': self.output_folder,
+            'previous_masks_cache_path': self.previous_masks_cache_path,
+            'incremental_iou_threshold': self.incremental_iou_threshold,
         }
 
         return config
@@ -48,6 +48,9 @@ class SegmenterInferIOConfig(SegmenterInferConfig):
     coco_path: str
     input_tiles_root: str
     output_folder: str
+    masks_cache_output_path: str = None
+    previous_masks_cache_path: str = None
+    incremental_iou_threshold: float = 0.95
 
     @classmethod
     def from_dict(cls, config: dict):
@@ -58,6 +61,9 @@ class SegmenterInferIOConfig(SegmenterInferConfig):
             coco_path=segmenter_io_config['coco_path'],
             input_tiles_root=segmenter_io_config['input_tiles_root'],
             output_folder=segmenter_io_config['output_folder'],
+            masks_cache_output_path=segmenter_io_config.get('masks_cache_output_path'),
+            previous_masks_cache_path=segmenter_io_config.get('previous_masks_cache_path'),
+            incremental_iou_threshold=segmenter_io_config.get('incremental_iou_threshold', 0.95),
         )
 
     def to_structured_dict(self):
@@ -65,9 +71,14 @@ class SegmenterInferIOConfig(SegmenterInferConfig):
         config['segmenter']['infer']['io'] = {
             'coco_path': self.coco_path,
             'input_tiles_root': self.input_tiles_root,
-            'output_folder': self.output_folder
+            'output_folder': self.output_folder,
+            'masks_cache_output_path': self.masks_cache_output_path,
+            'previous_masks_cache_path': self.previous_masks_cache_path,
+            'incremental_iou_threshold': self.incremental_iou_threshold
         }
 
+        return config
+
 
 @dataclass
 class SegmenterScoreIOConfig(BaseConfig):
@@ -10,6 +10,8 @@ from torch.optim.lr_scheduler import StepLR
 from torch.utils.data import TensorDataset, DataLoader
 from tqdm import tqdm
 
+from engine.utils.embeddings_store import load_gdf_embeddings
+
 # Check if CUDA is available and set device to GPU if possible
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"Using device: {device}")
@@ -119,9 +121,9 @@ def train_model(model, train_loader, valid_loader, criterion, optimizer, schedul
 
 
 def load_data(filename):
-    # Load a dataframe and convert embeddings from string to numpy arrays
+    # Load a dataframe saved by embedder_infer_main, and its embeddings from the binary store next to it
     df = pd.read_csv(filename)
-    df['embeddings'] = df['embeddings'].apply(eval)  # Convert string representations of lists to actual lists
+    df['embeddings'] = list(load_gdf_embeddings(df, filename, 'embeddings'))
     return df
 
 
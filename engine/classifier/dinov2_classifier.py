@@ -30,6 +30,9 @@ from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 import albumentations as A
 
+from engine.utils.feature_cache import build_features_cache, module_fingerprint, CachedFeaturesDataset
+from engine.utils.model_registry import get_dinov2_backbone
+
 
 class LabeledDINOv2Dataset:
     def __init__(self,
@@ -243,7 +246,7 @@ class DINOv2Inference:
 
         model_name = f"dinov2_vit{self.size[0]}{self.vit_patch_size}_reg"
 
-        return torch.hub.load('facebookresearch/dinov2', model_name, pretrained=True).to(self.device)
+        return get_dinov2_backbone(model_name).to(self.device)
 
     def __call__(self, x: torch.Tensor):
         # with torch.inference_mode():
@@ -280,7 +283,26 @@ class FCNNHead(nn.Module):
         return x
 
 
+def cache_dinov2_features(dataset, dino_model, cache_path, batch_size, collate_fn):
+    """
+    Runs the frozen DINOv2 model once on each sample of an augmentation-free dataset and returns a dataset of the
+    cached features, to train the head without the DINOv2 forward pass at every epoch.
+    """
+    loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn, shuffle=False)
+    backbone_id = f"dinov2-{dino_model.size}-{module_fingerprint(dino_model.model)}"
+    samples_ids = [(dataset.masks[i]['raster_path'], dataset.masks[i]['polygons_id']) for i in range(len(dataset))]
+    cache_path = build_features_cache(feature_extractor=lambda batch: dino_model(batch[0]),
+                                      data_loader=loader,
+                                      n_samples=len(dataset),
+                                      cache_path=cache_path,
+                                      backbone_id=backbone_id,
+                                      samples_ids=samples_ids,
+                                      desc='Caching DINOv2 features...')
+    return CachedFeaturesDataset(cache_path, labels=[dataset.masks[i]['label'] for i in range(len(dataset))])
+
+
 def train_one_epoch(loader, dino_model, classifier_model, optimizer, criterion, device, writer, epoch_index):
+    # dino_model is None if the loader returns cached DINOv2 features (see cache_dinov2_features)
     classifier_model.train()
     running_loss = 0.0
     running_steps = 0
@@ -289,10 +311,12 @@ def train_one_epoch(loader, dino_model, classifier_model, optimizer, criterion,
         inputs, labels = inputs.to(device), labels.to(device)
 
         optimizer.zero_grad()
-        with torch.no_grad():
-            features = dino_model(inputs)
-
-        features = features.detach().clone()
+        if dino_model is not None:
+            with torch.no_grad():
+                features = dino_model(inputs)
+            features = features.detach().clone()
+        else:
+            features = inputs
 
         outputs = classifier_model(features)
         loss = criterion(outputs, labels)
@@ -317,7 +341,7 @@ def validate_one_epoch(loader, dino_model, classifier_model, criterion, device,
     with torch.no_grad():
         for inputs, labels in tqdm(loader, desc="Validation", leave=False):
             inputs, labels = inputs.to(device), labels.to(device)
-            features = dino_model(inputs)
+            features = dino_model(inputs) if dino_model is not None else inputs
             outputs = classifier_model(features)
             # print("v", outputs)
             loss = criterion(outputs, labels)
@@ -435,6 +459,8 @@ def validate_save_gdf(dataset, loader, dino_model, classifier_model, device, out
 def train_main():
     image_size = 224
     assert image_size % 14 == 0, "Output size must be a multiple of 14"
+    # trains the head from DINOv2 features computed once, without the data augmentation
+    cache_features = False
 
     rasters_labels_configs = [
         {
@@ -467,7 +493,7 @@ def train_main():
         categories_coco=json.load(open(
             'C:/Users/Hugo/PycharmProjects/geodataset/geodataset/utils/categories/quebec_trees/quebec_trees_categories.json',
             "rb"))['categories'],
-        augment_data=True
+        augment_data=not cache_features
     )
 
     valid_dataset = LabeledDINOv2Dataset(
@@ -505,6 +531,17 @@ def train_main():
 
     collate_fn = lambda x: (torch.stack([torch.tensor(data[0]) for data in x]), torch.tensor([data[1] for data in x]))
 
+    if cache_features:
+        # outside of the run folder, so the next runs reuse the caches while the model and samples don't change
+        features_cache_folder = Path(output_folder).parent / 'features_cache'
+        with torch.no_grad():
+            train_dataset = cache_dinov2_features(train_dataset, dino_model, features_cache_folder / 'train_features.npy',
+                                                  batch_size=16, collate_fn=collate_fn)
+            valid_dataset = cache_dinov2_features(valid_dataset, dino_model, features_cache_folder / 'valid_features.npy',
+                                                  batch_size=16, collate_fn=collate_fn)
+        # the head is trained directly from the cached features
+        dino_model = None
+
     # Define data loaders
     train_loader = DataLoader(train_dataset, batch_size=2, collate_fn=collate_fn,
                               shuffle=True)  # Define your training DataLoader
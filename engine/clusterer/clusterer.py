@@ -10,6 +10,8 @@ from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 from sklearn.preprocessing import StandardScaler
 
+from engine.utils.distances import radius_neighbors_graph
+
 
 class Clusterer:
     def __init__(self,
@@ -108,10 +110,13 @@ class Clusterer:
                            hdbscan_cluster_selection_method_list: list):
 
         if cluster_algo == 'dbscan':
+            # the neighbors graph for the largest eps also holds the neighbors of all the smaller ones
+            neighbors_graph = self._get_dbscan_neighbors_graph(max(dbscan_eps_list))
             combinations = itertools.product(dbscan_eps_list,
                                              dbscan_min_samples_list)
             for (eps, min_samples) in combinations:
-                self._run_dbscan(eps=eps, min_samples=min_samples, display_results=True)
+                self._run_dbscan(eps=eps, min_samples=min_samples, display_results=True,
+                                 neighbors_graph=neighbors_graph)
         elif cluster_algo == 'hdbscan':
             combinations = itertools.product(hdbscan_cluster_selection_epsilon_list,
                                              hdbscan_min_samples_list,
@@ -145,12 +150,27 @@ class Clusterer:
         output_name_prefix = f"{cluster_algo}_{self.metric}_{self.reduce_algo_name1}_{self.n_components1}_{self.reduce_algo_name2}_{self.n_components2}_{self.visualize_algo_name}_{self.min_cluster_size}"
         return output_name_prefix
 
+    def _get_dbscan_neighbors_graph(self, eps: float):
+        # sklearn has no tree index for the cosine metric and falls back to brute force, so the eps neighbors are
+        # computed once, by blocks of Gram matrix distances, and given to DBSCAN as a precomputed sparse graph
+        if self.metric != 'cosine':
+            return None
+        return radius_neighbors_graph(self.reduced_embeddings, radius=eps, metric=self.metric)
+
     def _run_dbscan(self,
                     eps: float,
                     min_samples: int,
-                    display_results: bool):
-        dbscan = DBSCAN(eps=eps, min_samples=min_samples, metric=self.metric, n_jobs=self.n_cpus)
-        cluster_labels = dbscan.fit_predict(self.reduced_embeddings)
+                    display_results: bool,
+                    neighbors_graph=None):
+        if neighbors_graph is None:
+            neighbors_graph = self._get_dbscan_neighbors_graph(eps)
+
+        if neighbors_graph is not None:
+            dbscan = DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed', n_jobs=self.n_cpus)
+            cluster_labels = dbscan.fit_predict(neighbors_graph)
+        else:
+            dbscan = DBSCAN(eps=eps, min_samples=min_samples, metric=self.metric, n_jobs=self.n_cpus)
+            cluster_labels = dbscan.fit_predict(self.reduced_embeddings)
         cluster_labels, n_clusters = self.parse_clusters(cluster_labels)
         print(f'eps={eps}, min_samples={min_samples},'
               f' n_samples_without_cluster={len([x for x in cluster_labels if x == -1])},'
@@ -1,4 +1,3 @@
-import ast
 import os.path
 
 import numpy as np
@@ -6,6 +5,7 @@ import pandas as pd
 import geopandas as gpd
 
 from engine.clusterer.clusterer import Clusterer
+from engine.utils.embeddings_store import load_gdf_embeddings
 
 if __name__ == '__main__':
     # embeddings_df = pd.read_pickle('C:/Users/Hugo/PycharmProjects/xprize-rainforest/engine/embedder/dinov2/embeddings_df_True_None_1720055270.0580597.pkl')
@@ -15,11 +15,12 @@ if __name__ == '__main__':
     # embeddings_df.rename(columns={'labels': 'tiles_paths'}, inplace=True)
     # embeddings_df['tiles_paths'] = embeddings_df['tiles_paths'].apply(lambda x: prefix + x)
 
-    embeddings_gdf = gpd.read_file('/home/hugo/Documents/xprize/infer/20240130_zf2transectew_m3m_rgb_TEST_2_EMBEDDERS/20240130_zf2transectew_m3m_rgb_final.gpkg')
+    embeddings_geopackage_path = '/home/hugo/Documents/xprize/infer/20240130_zf2transectew_m3m_rgb_TEST_2_EMBEDDERS/20240130_zf2transectew_m3m_rgb_final.gpkg'
+    embeddings_gdf = gpd.read_file(embeddings_geopackage_path)
     embeddings_df = embeddings_gdf
     # embeddings_df['embeddings'] = embeddings_df['embeddings'].apply(lambda x: ast.literal_eval(x))
-    embeddings_df['embeddings_contrastive'] = embeddings_df['embeddings_contrastive'].apply(lambda x: ast.literal_eval(x))
-    embeddings_df['embeddings_dinov2'] = embeddings_df['embeddings_dinov2'].apply(lambda x: ast.literal_eval(x))
+    embeddings_df['embeddings_contrastive'] = list(load_gdf_embeddings(embeddings_gdf, embeddings_geopackage_path, 'embeddings_contrastive'))
+    embeddings_df['embeddings_dinov2'] = list(load_gdf_embeddings(embeddings_gdf, embeddings_geopackage_path, 'embeddings_dinov2'))
 
     output_root_dir = '/home/hugo/Documents/xprize/cluster/cluster_PRACTICE_resnetQPE'
 
@@ -88,7 +89,7 @@ if __name__ == '__main__':
 
     merged_gdf = embeddings_gdf
     merged_gdf['cluster_labels'] = clusters
-    merged_gdf['embeddings'] = merged_gdf['embeddings'].apply(lambda x: str(x))
+    merged_gdf = merged_gdf.drop(columns=[column for column in merged_gdf.columns if column.startswith('embeddings')])
     merged_gdf.to_file(f"./20240521_practice100ha_highres_m3m_rgb_final_clustered_resnetQPE_clusters_{reduce_algo_name1}_{n_components1}_{reduce_algo_name2}_{n_components2}_{cluster_algo}_{hdbscan_min_samples}_{str(hdbscan_cluster_selection_epsilon).replace('.', 'p')}.gpkg", driver='GPKG')
 
 
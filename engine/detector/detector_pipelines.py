@@ -16,6 +16,7 @@ from engine.detector.model import Detector
 from geodataset.dataset import DetectionLabeledRasterCocoDataset, UnlabeledRasterDataset
 
 from engine.detector.utils import WarmupStepLR, detector_result_to_lists
+from engine.utils.model_registry import load_weights
 
 
 class DetectorBasePipeline(ABC):
@@ -43,7 +44,7 @@ class DetectorBasePipeline(ABC):
                               box_predictions_per_image=box_predictions_per_image).to(self.device)
 
         if checkpoint_state_dict_path:
-            self.model.load_state_dict(torch.load(checkpoint_state_dict_path))
+            self.model.load_state_dict(load_weights(checkpoint_state_dict_path))
 
         self.model.to(self.device)
 
@@ -8,11 +8,12 @@ import torch.optim as optim
 from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
-from sklearn.neighbors import KNeighborsClassifier
 from sklearn.svm import SVC
 
 import joblib
 
+from engine.utils.embedding_index import EmbeddingKNNClassifier
+
 import matplotlib.pyplot as plt
 import seaborn as sns
 
@@ -61,7 +62,9 @@ class DownstreamModelTrainer:
 
     def train_knn(self, X_train: np.ndarray, X_test: np.ndarray, y_train: np.ndarray, y_test: np.ndarray) -> Tuple:
         """Train a K-Nearest Neighbors classifier."""
-        knn = KNeighborsClassifier(n_neighbors=self.config.get('n_neighbors', 10))
+        knn = EmbeddingKNNClassifier(n_neighbors=self.config.get('n_neighbors', 10),
+                                     index_type=self.config.get('knn_index_type', 'exact'),
+                                     device='cuda' if torch.cuda.is_available() else 'cpu')
         return self._train_model(knn, X_train, X_test, y_train, y_test)
 
     def train_svc(self, X_train: np.ndarray, X_test: np.ndarray, y_train: np.ndarray, y_test: np.ndarray) -> Tuple:
@@ -10,7 +10,8 @@ import rasterio
 from geodataset.dataset.base_dataset import BaseLabeledCocoDataset
 from geodataset.utils import rle_segmentation_to_mask, mask_to_polygon
 
-from engine.embedder.contrastive.contrastive_utils import FOREST_QPEB_MEAN, FOREST_QPEB_STD, scale_values, normalize
+from engine.embedder.utils import get_categories_distances_matrix
+from engine.utils.feature_cache import MemmapFeatures
 
 
 class BaseContrastiveLabeledCocoDataset(BaseLabeledCocoDataset):
@@ -97,39 +98,26 @@ class ContrastiveDataset:
                  transform: albumentations.core.composition.Compose,
                  taxa_distances_df: pd.DataFrame or None,
                  max_resampling_times: int,
-                 normalize: bool = True,
-                 mean: np.array = FOREST_QPEB_MEAN,
-                 std: np.array = FOREST_QPEB_STD,
                  min_margin: int = 0.5,
-                 max_margin: int = 2):
+                 max_margin: int = 2,
+                 return_sample_index: bool = False):
         self.dataset_config = dataset_config
         self.min_level = min_level
         self.image_size = image_size
         self.random_crop = random_crop
         self.transform = transform
         self.taxa_distances_df = taxa_distances_df
-        self.normalize = normalize
-        self.mean = mean
-        self.std = std
         self.min_margin = min_margin
         self.max_margin = max_margin
         self.max_resampling_times = max_resampling_times
+        # the global sample id is also returned, to update the embedding memory bank (see engine.utils.memory_bank)
+        self.return_sample_index = return_sample_index
 
         self.datasets = dataset_config
 
         assert self.min_level in ['species', 'genus', 'family'], f"min_level should be one of ['species', 'genus', 'family'], got {self.min_level}."
 
-        if self.taxa_distances_df is not None:
-            self.taxa_distances_df = taxa_distances_df.set_index(['canonicalName1', 'canonicalName2'])
-            # scaling negative pairs distances to [min_margin, max_margin]
-            self.taxa_distances_df.loc[self.taxa_distances_df['dist'] > 0, 'dist'] = scale_values(
-                values=self.taxa_distances_df.loc[self.taxa_distances_df['dist'] > 0, 'dist'],
-                old_min=min(self.taxa_distances_df.loc[self.taxa_distances_df['dist'] > 0, 'dist']),
-                old_max=max(self.taxa_distances_df.loc[self.taxa_distances_df['dist'] > 0, 'dist']),
-                new_min=self.min_margin,
-                new_max=self.max_margin
-            )
-        else:
+        if self.taxa_distances_df is None:
             warn('No taxa distances provided. Using default distance of 1 for all negative pairs.', UserWarning)
 
         self.categories_names, self.categories_names_to_idx, self.categories_dists = self._get_categories_distances()
@@ -181,25 +169,19 @@ class ContrastiveDataset:
                     else:
                         raise ValueError(f"Unknown category rank: {category['rank']}.")
 
-        print('Generating categories distances...')
-        categories_dists = {}
-        for category_name_1 in categories_names_to_rank.keys():
-            for category_name_2 in categories_names_to_rank.keys():
-                if category_name_1 == category_name_2:
-                    categories_dists[(category_name_1, category_name_2)] = 0
-                elif category_name_1 == 'Dead' or category_name_2 == 'Dead':
-                    categories_dists[(category_name_1, category_name_2)] = self.DEAD_DISTANCE
-                else:
-                    if self.taxa_distances_df is not None:
-                        categories_dists[(category_name_1, category_name_2)] = self.taxa_distances_df.loc[(category_name_1, category_name_2), 'dist']
-                    else:
-                        categories_dists[(category_name_1, category_name_2)] = 1
+        categories_names = set(categories_names_to_rank.keys())
+        # sorted, as the order of a set of strings changes with the hash seed of each process
+        categories_names_to_idx = {k: i + 1 for i, k in enumerate(sorted(categories_names))}
 
+        # categories_dists[label_id1, label_id2], with the label ids of categories_names_to_idx
+        print('Generating categories distances...')
+        categories_dists = get_categories_distances_matrix(categories_names_to_idx=categories_names_to_idx,
+                                                           taxa_distances_df=self.taxa_distances_df,
+                                                           dead_distance=self.DEAD_DISTANCE,
+                                                           min_margin=self.min_margin,
+                                                           max_margin=self.max_margin)
         print('Categories distances successfully generated.')
 
-        categories_names = set(categories_names_to_rank.keys())
-        categories_names_to_idx = {k: i + 1 for i, k in enumerate(categories_names)}
-
         return categories_names, categories_names_to_idx, categories_dists
 
     def _get_all_samples(self):
@@ -273,7 +255,9 @@ class ContrastiveDataset:
             print(f"Mean samples per class: {mean_samples_per_class}")
 
             next_index = len(self.all_samples_dataset_indices)
-            for category_name in self.categories_names:
+            # sorted, so the same seed resamples the same samples in every process (the set order depends on the
+            # hash seed of the process)
+            for category_name in sorted(self.categories_names):
                 samples_for_category = self.samples_indices_per_label[category_name]
                 if len(samples_for_category) < mean_samples_per_class:
                     shuffled_indices = np.random.choice(samples_for_category, size=int(mean_samples_per_class - len(samples_for_category)), replace=True)
@@ -288,8 +272,7 @@ class ContrastiveDataset:
     def __len__(self):
         return len(self.all_samples_dataset_indices)
 
-    def __getitem__(self, idx):
-        real_idx = self.index[idx]
+    def get_sample_metadata(self, real_idx: int):
         dataset_key, dataset_idx = self.all_samples_dataset_indices[real_idx]
         label = self.all_samples_labels[real_idx]
         label_id = self.categories_names_to_idx[label]
@@ -297,6 +280,11 @@ class ContrastiveDataset:
         family_id = self.categories_names_to_idx[family]
         tile = self.datasets[dataset_key][dataset_idx]
         month, day = int(tile['month']), int(tile['day'])
+        return tile, month, day, label_id, label, family_id, family
+
+    def __getitem__(self, idx):
+        real_idx = self.index[idx]
+        tile, month, day, label_id, label, family_id, family = self.get_sample_metadata(real_idx)
 
         with rasterio.open(tile['path']) as tile_file:
             data = tile_file.read([1, 2, 3])
@@ -339,38 +327,83 @@ class ContrastiveDataset:
             data = self.transform(image=data)['image']
             data = data.transpose((2, 0, 1))
 
-        data = data / 255
+        # the raw uint8 crop is returned, it is normalized on the model device (see ImageNormalization)
+        data = np.ascontiguousarray(data)
 
-        if self.normalize:
-            data = normalize(data, self.mean, self.std)
+        if self.return_sample_index:
+            return data, month, day, label_id, label, family_id, family, real_idx
 
         return data, month, day, label_id, label, family_id, family
 
 
+class ContrastiveCachedFeaturesDataset:
+    """
+    The items of a ContrastiveDataset, with the cached backbone features of the samples instead of their image crops
+    (see engine.utils.feature_cache). A sample gets the features of its tile, so the samples duplicated by the class
+    balancing share the same cached features.
+
+    Parameters:
+    - contrastive_dataset (ContrastiveDataset): The dataset whose items are returned.
+    - cache_path (Path): The path of the features cache.
+    - cache_samples_dataset_indices (dict): The [dataset_key, dataset_idx] tile of each row of the cache, i.e. the
+        all_samples_dataset_indices of the ContrastiveDataset the cache was built from.
+    """
+    def __init__(self,
+                 contrastive_dataset: ContrastiveDataset,
+                 cache_path: Path,
+                 cache_samples_dataset_indices: dict):
+        self.contrastive_dataset = contrastive_dataset
+        self.features = MemmapFeatures(cache_path)
+
+        tiles_rows = {tuple(tile): row for row, tile in cache_samples_dataset_indices.items()}
+        self.features_rows = np.array([tiles_rows[tuple(contrastive_dataset.all_samples_dataset_indices[real_idx])]
+                                       for real_idx in range(len(contrastive_dataset))], dtype=np.int64)
+
+        # used by the samplers
+        self.all_samples_labels = contrastive_dataset.all_samples_labels
+
+    def __len__(self):
+        return len(self.contrastive_dataset)
+
+    def __getitem__(self, idx):
+        real_idx = self.contrastive_dataset.index[idx]
+        _, month, day, label_id, label, family_id, family = self.contrastive_dataset.get_sample_metadata(real_idx)
+        features = self.features[self.features_rows[real_idx]]
+
+        if self.contrastive_dataset.return_sample_index:
+            return features, month, day, label_id, label, family_id, family, real_idx
+
+        return features, month, day, label_id, label, family_id, family
+
+
 class ContrastiveInferDataset(BaseContrastiveLabeledCocoDataset):
     def __init__(self, image_size: int, transform: albumentations.core.composition.Compose,
                  fold: str, root_path: Path or List[Path], date_pattern: str or None,
-                 day_month_year: Tuple[int, int, int] = None, normalize: bool = True,
-                 mean: np.array = FOREST_QPEB_MEAN, std: np.array = FOREST_QPEB_STD):
+                 day_month_year: Tuple[int, int, int] = None):
 
         super().__init__(fold=fold, root_path=root_path, date_pattern=date_pattern,
                          day_month_year=day_month_year, transform=transform)
         self.image_size = image_size
         self.transform = transform
-        self.normalize = normalize
-        self.mean = mean
-        self.std = std
 
     def __len__(self):
         return len(self.tiles)
 
     def __getitem__(self, idx):
+        return self.preprocess_tile(idx, self.read_tile(idx))
+
+    def read_tile(self, idx: int) -> np.ndarray:
+        with rasterio.open(self.tiles[idx]['path']) as tile_file:
+            return tile_file.read([1, 2, 3])
+
+    def preprocess_tile(self, idx: int, data: np.ndarray):
+        """
+        Crops/pads a tile read by read_tile, so that the tile can be decoded once and shared with other embedders
+        (see engine.embedder.multi_embedder). The tile stays uint8, it is normalized by the model.
+        """
         tile = self.tiles[idx]
         month, day = int(tile['month']), int(tile['day'])
 
-        with rasterio.open(tile['path']) as tile_file:
-            data = tile_file.read([1, 2, 3])
-
         if data.shape[1] > self.image_size:
             # crop
             data_center = int(data.shape[1] / 2)
@@ -390,10 +423,7 @@ class ContrastiveInferDataset(BaseContrastiveLabeledCocoDataset):
             data = self.transform(image=data)['image']
             data = data.transpose((2, 0, 1))
 
-        data = data / 255
-
-        if self.normalize:
-            data = normalize(data, self.mean, self.std)
+        data = np.ascontiguousarray(data)
 
         return data, month, day
 
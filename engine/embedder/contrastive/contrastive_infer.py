@@ -2,11 +2,8 @@ from pathlib import Path
 from typing import List, Tuple
 
 import numpy as np
-import pandas as pd
-import geopandas as gpd
 import torch
-from geodataset.utils import rle_segmentation_to_mask, mask_to_polygon, tiles_polygons_gdf_to_crs_gdf, \
-    GeoPackageNameConvention
+from geodataset.utils import GeoPackageNameConvention
 from torch import nn
 from tqdm import tqdm
 
@@ -15,107 +12,73 @@ from engine.embedder.contrastive.contrastive_dataset import ContrastiveDataset,
 from engine.embedder.contrastive.contrastive_model import XPrizeTreeEmbedder2NoDate, XPrizeTreeEmbedder, \
     XPrizeTreeEmbedder2, DinoV2Embedder
 from engine.embedder.contrastive.contrastive_utils import ConditionalAutocast, FOREST_QPEB_MEAN, FOREST_QPEB_STD, \
-    IMAGENET_MEAN, IMAGENET_STD, contrastive_infer_collate_fn
+    IMAGENET_MEAN, IMAGENET_STD, InferenceOutputBuffer
+from engine.utils.model_registry import load_weights
 
 
-def contrastive_classifier_embedder_infer(backbone_name: str,
-                                          final_embedding_size: int,
-                                          data_roots: str or List[str],
-                                          fold: str,
-                                          day_month_year: Tuple[int, int, int],
-                                          image_size: int,
-                                          mean_std_descriptor: str,
-                                          contrastive_checkpoint: str,
-                                          batch_size: int):
-
-    if mean_std_descriptor == 'forest_qpeb':
-        mean = FOREST_QPEB_MEAN
-        std = FOREST_QPEB_STD
-    elif mean_std_descriptor == 'imagenet':
-        mean = IMAGENET_MEAN
-        std = IMAGENET_STD
-    else:
-        raise ValueError(f'Unknown mean_std_descriptor: {mean_std_descriptor}')
-
+def get_contrastive_infer_dataset(data_roots: str or List[str],
+                                  fold: str,
+                                  day_month_year: Tuple[int, int, int],
+                                  image_size: int):
     dataset = ContrastiveInferDataset(
         root_path=data_roots,
         date_pattern=None,
         day_month_year=day_month_year,
         fold=fold,
         image_size=image_size,
-        transform=None,
-        normalize=True,
-        mean=mean,
-        std=std,
+        transform=None
     )
 
-    loader = torch.utils.data.DataLoader(
-        dataset,
-        batch_size=batch_size,
-        shuffle=False,  # not shuffling is REQUIRED for the inference (order is important)
-        num_workers=4,
-        collate_fn=contrastive_infer_collate_fn
-    )
+    return dataset
+
+
+def get_mean_std(mean_std_descriptor: str):
+    if mean_std_descriptor == 'forest_qpeb':
+        return FOREST_QPEB_MEAN, FOREST_QPEB_STD
+    elif mean_std_descriptor == 'imagenet':
+        return IMAGENET_MEAN, IMAGENET_STD
+    else:
+        raise ValueError(f'Unknown mean_std_descriptor: {mean_std_descriptor}')
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+def load_contrastive_embedder(backbone_name: str,
+                              final_embedding_size: int,
+                              contrastive_checkpoint: str,
+                              mean_std_descriptor: str,
+                              device: torch.device):
+    """
+    Parameters:
+    - mean_std_descriptor (str): The normalization of the input images, 'forest_qpeb' or 'imagenet'. It is applied
+      by the model on its device, the datasets return uint8 images.
+    """
     print(f'Loading model from {contrastive_checkpoint}')
+    mean, std = get_mean_std(mean_std_descriptor)
     model = XPrizeTreeEmbedder(
         resnet_model=backbone_name,
         final_embedding_size=final_embedding_size,
-        dropout=0
+        dropout=0,
+        pretrained=False,
+        mean=mean,
+        std=std
     )
-    model.load_state_dict(torch.load(contrastive_checkpoint))
+    model.load_state_dict(load_weights(contrastive_checkpoint))
     model.to(device)
     model.eval()
 
-    embeddings, predicted_families, predicted_families_scores = infer_model_without_labels(
-        model=model, dataloader=loader, device=device, use_mixed_precision=False, desc='Infering...'
-    )
-
-    torch.cuda.reset_peak_memory_stats()
-    torch.cuda.empty_cache()
-
-    tiles_paths = []
-    polygons = []
-
-    for tile_idx in range(len(dataset)):
-        tile = dataset.tiles[tile_idx]
-        label = tile['labels'][0]
-        segmentation = label['segmentation']
-        if ('is_rle_format' in label and label['is_rle_format']) or isinstance(segmentation, dict):
-            # RLE format
-            mask = rle_segmentation_to_mask(segmentation)
-            polygon = mask_to_polygon(mask)
-            polygons.append(polygon)
-            tiles_paths.append(str(tile['path']))
-        else:
-            raise NotImplementedError("Please make sure that the masks are encoded using RLE.")
-
-    tiles_polygons_gdf = gpd.GeoDataFrame({
-        'a_id': [str(x) for x in range(len(polygons))],     # this is just a dummy column so that QGIS doesn't use the 'embeddings' column as base label for the geometries
-        'geometry': polygons,
-        'embeddings': embeddings.tolist(),
-        'tile_path': tiles_paths
-    })
-
-    if predicted_families_scores:
-        tiles_polygons_gdf['predicted_family'] = predicted_families
-        tiles_polygons_gdf['predicted_family_scores'] = predicted_families_scores.tolist()
-
-    tiles_polygons_gdf_crs = tiles_polygons_gdf_to_crs_gdf(tiles_polygons_gdf)
-
-    tiles_polygons_gdf_crs['area'] = tiles_polygons_gdf_crs['geometry'].area
-
-    tiles_polygons_gdf_crs['embeddings'] = tiles_polygons_gdf_crs['embeddings'].apply(lambda x: str(x))
-
-    return tiles_polygons_gdf_crs
+    return model
 
 
-def infer_model_without_labels(model, dataloader, device, use_mixed_precision, desc='Infering...', as_numpy=True):
-    all_embeddings = torch.tensor([])
+def infer_model_without_labels(model, dataloader, device, use_mixed_precision, desc='Infering...', as_numpy=True,
+                               embeddings_output_path: str or Path = None):
+    """
+    The outputs are written to buffers preallocated from len(dataloader.dataset). If embeddings_output_path is
+    provided, the embeddings are streamed to that memory-mapped .npy file instead of being kept in memory.
+    """
+    n_samples = len(dataloader.dataset)
+    all_embeddings = InferenceOutputBuffer(n_samples, output_path=embeddings_output_path)
     all_predicted_families = []
-    all_predicted_families_scores = torch.tensor([])
+    all_predicted_families_scores = InferenceOutputBuffer(n_samples)
+    has_predicted_families_scores = True
 
     for images, months, days in tqdm(dataloader, total=len(dataloader), desc=desc):
         embeddings, predicted_families, predicted_families_scores = infer_batch(
@@ -123,32 +86,38 @@ def infer_model_without_labels(model, dataloader, device, use_mixed_precision, d
             device=device, use_mixed_precision=use_mixed_precision
         )
 
-        all_embeddings = torch.cat((all_embeddings, embeddings.detach().cpu()), dim=0)
+        all_embeddings.add(embeddings)
         all_predicted_families.extend(predicted_families)
 
         if predicted_families_scores is not None:
-            all_predicted_families_scores = torch.cat(
-                (all_predicted_families_scores, predicted_families_scores.detach().cpu()), dim=0)
+            all_predicted_families_scores.add(predicted_families_scores)
         else:
-            all_predicted_families_scores = None
+            has_predicted_families_scores = False
 
+    all_embeddings = all_embeddings.get(as_numpy=as_numpy)
+    all_predicted_families_scores = all_predicted_families_scores.get(as_numpy=as_numpy) \
+        if has_predicted_families_scores else None
     if as_numpy:
-        all_embeddings = all_embeddings.numpy()
         all_predicted_families = np.array(all_predicted_families)
-        if all_predicted_families_scores is not None:
-            all_predicted_families_scores = all_predicted_families_scores.numpy()
 
     return all_embeddings, all_predicted_families, all_predicted_families_scores
 
 
-def infer_model_with_labels(model, dataloader, device, use_mixed_precision, desc='Infering...', as_numpy=True):
+def infer_model_with_labels(model, dataloader, device, use_mixed_precision, desc='Infering...', as_numpy=True,
+                            embeddings_output_path: str or Path = None):
+    """
+    The outputs are written to buffers preallocated from len(dataloader.dataset). If embeddings_output_path is
+    provided, the embeddings are streamed to that memory-mapped .npy file instead of being kept in memory.
+    """
+    n_samples = len(dataloader.dataset)
     all_labels = []
-    all_labels_ids = torch.tensor([])
+    all_labels_ids = InferenceOutputBuffer(n_samples)
     all_families = []
-    all_families_ids = torch.tensor([])
-    all_embeddings = torch.tensor([])
+    all_families_ids = InferenceOutputBuffer(n_samples)
+    all_embeddings = InferenceOutputBuffer(n_samples, output_path=embeddings_output_path)
     all_predicted_families = []
-    all_predicted_families_scores = torch.tensor([])
+    all_predicted_families_scores = InferenceOutputBuffer(n_samples)
+    has_predicted_families_scores = True
     with torch.no_grad():
         for images, months, days, labels_ids, labels, families_ids, families in tqdm(dataloader, total=len(dataloader),
                                                                                      desc=desc):
@@ -158,32 +127,33 @@ def infer_model_with_labels(model, dataloader, device, use_mixed_precision, desc
             )
 
             all_labels.extend(labels)
-            all_labels_ids = torch.cat((all_labels_ids, labels_ids.detach().cpu()), dim=0)
+            all_labels_ids.add(labels_ids)
             all_families.extend(families)
-            all_families_ids = torch.cat((all_families_ids, families_ids.detach().cpu()), dim=0)
-            all_embeddings = torch.cat((all_embeddings, embeddings.detach().cpu()), dim=0)
+            all_families_ids.add(families_ids)
+            all_embeddings.add(embeddings)
             all_predicted_families.extend(predicted_families)
             if predicted_families_scores is not None:
-                all_predicted_families_scores = torch.cat((all_predicted_families_scores, predicted_families_scores.detach().cpu()), dim=0)
+                all_predicted_families_scores.add(predicted_families_scores)
             else:
-                all_predicted_families_scores = None
+                has_predicted_families_scores = False
 
+        all_labels_ids = all_labels_ids.get(as_numpy=as_numpy)
+        all_families_ids = all_families_ids.get(as_numpy=as_numpy)
+        all_embeddings = all_embeddings.get(as_numpy=as_numpy)
+        all_predicted_families_scores = all_predicted_families_scores.get(as_numpy=as_numpy) \
+            if has_predicted_families_scores else None
         if as_numpy:
             all_labels = np.array(all_labels)
-            all_labels_ids = all_labels_ids.numpy()
             all_families = np.array(all_families)
-            all_families_ids = all_families_ids.numpy()
-            all_embeddings = all_embeddings.numpy()
             all_predicted_families = np.array(all_predicted_families)
-            if all_predicted_families_scores is not None:
-                all_predicted_families_scores = all_predicted_families_scores.numpy()
 
         return all_labels, all_labels_ids, all_families, all_families_ids, all_embeddings, all_predicted_families, all_predicted_families_scores
 
 
 def infer_batch(images, months, days, model, device, use_mixed_precision):
     with torch.no_grad():
-        data = torch.Tensor(images).to(device)
+        # the uint8 images are normalized by the model, on the device
+        data = torch.as_tensor(images).to(device, non_blocking=True)
         months = torch.Tensor(months).to(device)
         days = torch.Tensor(days).to(device)
         if len(data.shape) == 3:
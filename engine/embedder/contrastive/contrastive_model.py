@@ -1,27 +1,47 @@
 import math
 
+import numpy as np
 import torch
 from torch import nn
-from torchvision import models
 
 from engine.embedder.dinov2.dinov2 import DINOv2Inference
+from engine.embedder.utils import FOREST_QPEB_MEAN, FOREST_QPEB_STD
+from engine.utils.model_registry import get_resnet_backbone, load_weights
+
+
+class ImageNormalization(nn.Module):
+    """
+    Normalizes a batch of raw (0-255, usually uint8) images on the model device: (x / 255 - mean) / std is computed
+    as a single fused x * scale + bias, so the datasets and DataLoader workers only handle uint8 crops.
+    The mean and std are not saved in the state dict, so the checkpoints are unchanged.
+
+    Parameters:
+    - mean (np.array): The mean of each channel, for images scaled to [0, 1].
+    - std (np.array): The std of each channel, for images scaled to [0, 1].
+    """
+    def __init__(self, mean: np.array, std: np.array):
+        super(ImageNormalization, self).__init__()
+        mean = torch.as_tensor(np.asarray(mean), dtype=torch.float32).view(1, -1, 1, 1)
+        std = torch.as_tensor(np.asarray(std), dtype=torch.float32).view(1, -1, 1, 1)
+        self.register_buffer('scale', 1 / (255 * std), persistent=False)
+        self.register_buffer('bias', -mean / std, persistent=False)
+
+    def forward(self, x):
+        return torch.addcmul(self.bias, x.float(), self.scale)
 
 
 class XPrizeTreeEmbedder(nn.Module):
     def __init__(self,
                  resnet_model: str,
                  final_embedding_size: int,
-                 dropout: float):
+                 dropout: float,
+                 pretrained: bool = True,
+                 mean: np.array = FOREST_QPEB_MEAN,
+                 std: np.array = FOREST_QPEB_STD):
         super(XPrizeTreeEmbedder, self).__init__()
-        # Load a ResNet50 model pre-trained on ImageNet
-        if resnet_model == 'resnet50':
-            self.backbone = models.resnet50(weights=models.ResNet50_Weights.DEFAULT)
-        elif resnet_model == 'resnet101':
-            self.backbone = models.resnet101(weights=models.ResNet101_Weights.DEFAULT)
-        elif resnet_model == 'resnet152':
-            self.backbone = models.resnet152(weights=models.ResNet152_Weights.DEFAULT)
-        else:
-            raise ValueError(f'Invalid resnet model: {resnet_model}')
+        self.input_normalization = ImageNormalization(mean, std)
+        # Load a ResNet model pre-trained on ImageNet, unless a checkpoint will be loaded afterwards
+        self.backbone = get_resnet_backbone(resnet_model, pretrained=pretrained)
 
         self.final_embedding_size = final_embedding_size
 
@@ -37,8 +57,15 @@ class XPrizeTreeEmbedder(nn.Module):
         )
 
     def forward(self, x):
-        output = self.backbone(x)
-        embeddings_final = self.fc(output)
+        return self.forward_head(self.forward_backbone(x))
+
+    def forward_backbone(self, x):
+        x = self.input_normalization(x)
+        return self.backbone(x)
+
+    def forward_head(self, features):
+        # the head alone, to train it from cached backbone features (see engine.utils.feature_cache)
+        embeddings_final = self.fc(features)
         return embeddings_final
 
 
@@ -48,17 +75,14 @@ class XPrizeTreeEmbedder2(nn.Module):
                  final_embedding_size: int,
                  dropout: float,
                  families: list[str],
-                 date_embedding_dim: int = 32):
+                 date_embedding_dim: int = 32,
+                 pretrained: bool = True,
+                 mean: np.array = FOREST_QPEB_MEAN,
+                 std: np.array = FOREST_QPEB_STD):
         super(XPrizeTreeEmbedder2, self).__init__()
-        # Load a ResNet50 model pre-trained on ImageNet
-        if resnet_model == 'resnet50':
-            self.backbone = models.resnet50(weights=models.ResNet50_Weights.DEFAULT)
-        elif resnet_model == 'resnet101':
-            self.backbone = models.resnet101(weights=models.ResNet101_Weights.DEFAULT)
-        elif resnet_model == 'resnet152':
-            self.backbone = models.resnet152(weights=models.ResNet152_Weights.DEFAULT)
-        else:
-            raise ValueError(f'Invalid resnet model: {resnet_model}')
+        self.input_normalization = ImageNormalization(mean, std)
+        # Load a ResNet model pre-trained on ImageNet, unless a checkpoint will be loaded afterwards
+        self.backbone = get_resnet_backbone(resnet_model, pretrained=pretrained)
 
         self.final_embedding_size = final_embedding_size
 
@@ -97,9 +121,15 @@ class XPrizeTreeEmbedder2(nn.Module):
         return date_encodings
 
     def forward(self, x, month, day):
-        output = self.backbone(x)
+        return self.forward_head(self.forward_backbone(x), month, day)
+
+    def forward_backbone(self, x):
+        x = self.input_normalization(x)
+        return self.backbone(x)
+
+    def forward_head(self, features, month, day):
         date_encoding = self._get_date_encoding(month, day)
-        embeddings_concat = torch.cat((output, date_encoding), dim=1)
+        embeddings_concat = torch.cat((features, date_encoding), dim=1)
         embeddings_final = self.fc(embeddings_concat)
         classification_logits = self.family_classifier(embeddings_final)
         return embeddings_final, classification_logits
@@ -116,12 +146,13 @@ class XPrizeTreeEmbedder2(nn.Module):
     @classmethod
     def from_checkpoint(cls,
                         checkpoint_path):
-        checkpoint = torch.load(checkpoint_path)
+        checkpoint = load_weights(checkpoint_path)
 
         model = cls(resnet_model=checkpoint['resnet_model'],
                     final_embedding_size=checkpoint['final_embedding_size'],
                     dropout=checkpoint['dropout'],
-                    families=checkpoint['families'])
+                    families=checkpoint['families'],
+                    pretrained=False)
         model.load_state_dict(checkpoint['model_state_dict'])
         return model
 
@@ -131,17 +162,14 @@ class XPrizeTreeEmbedder2NoDate(nn.Module):
                  resnet_model: str,
                  final_embedding_size: int,
                  dropout: float,
-                 families: list[str]):
+                 families: list[str],
+                 pretrained: bool = True,
+                 mean: np.array = FOREST_QPEB_MEAN,
+                 std: np.array = FOREST_QPEB_STD):
         super(XPrizeTreeEmbedder2NoDate, self).__init__()
-        # Load a ResNet50 model pre-trained on ImageNet
-        if resnet_model == 'resnet50':
-            self.backbone = models.resnet50(weights=models.ResNet50_Weights.DEFAULT)
-        elif resnet_model == 'resnet101':
-            self.backbone = models.resnet101(weights=models.ResNet101_Weights.DEFAULT)
-        elif resnet_model == 'resnet152':
-            self.backbone = models.resnet152(weights=models.ResNet152_Weights.DEFAULT)
-        else:
-            raise ValueError(f'Invalid resnet model: {resnet_model}')
+        self.input_normalization = ImageNormalization(mean, std)
+        # Load a ResNet model pre-trained on ImageNet, unless a checkpoint will be loaded afterwards
+        self.backbone = get_resnet_backbone(resnet_model, pretrained=pretrained)
 
         self.final_embedding_size = final_embedding_size
 
@@ -167,8 +195,14 @@ class XPrizeTreeEmbedder2NoDate(nn.Module):
         print('model families_to_id_mapping:', self.families_to_id_mapping)
 
     def forward(self, x):
-        output = self.backbone(x)
-        embeddings_final = self.fc(output)
+        return self.forward_head(self.forward_backbone(x))
+
+    def forward_backbone(self, x):
+        x = self.input_normalization(x)
+        return self.backbone(x)
+
+    def forward_head(self, features):
+        embeddings_final = self.fc(features)
         classification_logits = self.family_classifier(embeddings_final)
         return embeddings_final, classification_logits
 
@@ -184,12 +218,13 @@ class XPrizeTreeEmbedder2NoDate(nn.Module):
     @classmethod
     def from_checkpoint(cls,
                         checkpoint_path):
-        checkpoint = torch.load(checkpoint_path)
+        checkpoint = load_weights(checkpoint_path)
 
         model = cls(resnet_model=checkpoint['resnet_model'],
                     final_embedding_size=checkpoint['final_embedding_size'],
                     dropout=checkpoint['dropout'],
-                    families=checkpoint['families'])
+                    families=checkpoint['families'],
+                    pretrained=False)
         model.load_state_dict(checkpoint['model_state_dict'])
         return model
 
@@ -198,8 +233,11 @@ class DinoV2Embedder(nn.Module):
     def __init__(self,
                  size: str,
                  final_embedding_size: int,
-                 dropout: float):
+                 dropout: float,
+                 mean: np.array = FOREST_QPEB_MEAN,
+                 std: np.array = FOREST_QPEB_STD):
         super(DinoV2Embedder, self).__init__()
+        self.input_normalization = ImageNormalization(mean, std)
 
         self.size = size
         self.final_embedding_size = final_embedding_size
@@ -207,7 +245,7 @@ class DinoV2Embedder(nn.Module):
 
         self.dino = DINOv2Inference(
             size=self.size,
-            normalize=False,    # done in the dataset
+            normalize=False,    # done by self.input_normalization
             instance_segmentation=False,
             mean_std_descriptor=None
         )
@@ -229,8 +267,15 @@ class DinoV2Embedder(nn.Module):
         )
 
     def forward(self, x):
+        return self.forward_head(self.forward_backbone(x))
+
+    def forward_backbone(self, x):
+        x = self.input_normalization(x)
         output, _ = self.dino(x, average_non_masked_patches=False)
-        embeddings_final = self.fc(output)
+        return output
+
+    def forward_head(self, features):
+        embeddings_final = self.fc(features)
         return embeddings_final
 
     def save(self, path):
@@ -244,7 +289,7 @@ class DinoV2Embedder(nn.Module):
     @classmethod
     def from_checkpoint(cls,
                         checkpoint_path):
-        checkpoint = torch.load(checkpoint_path)
+        checkpoint = load_weights(checkpoint_path)
 
         model = cls(size=checkpoint['size'],
                     final_embedding_size=checkpoint['final_embedding_size'],
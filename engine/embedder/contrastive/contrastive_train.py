@@ -1,6 +1,7 @@
 import argparse
 import os
 import time
+from contextlib import nullcontext
 from pathlib import Path
 import albumentations as A
 import numpy as np
@@ -12,7 +13,6 @@ from pytorch_metric_learning import losses, distances, reducers, miners
 from pytorch_metric_learning.distances import LpDistance
 from pytorch_metric_learning.samplers import MPerClassSampler, FixedSetOfTriplets
 from sklearn.metrics import precision_recall_fscore_support, accuracy_score
-from sklearn.neighbors import KNeighborsClassifier
 from sklearn.preprocessing import StandardScaler
 from tensorboardX import SummaryWriter
 from torch import nn
@@ -20,13 +20,20 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 from warmup_scheduler import GradualWarmupScheduler
 
-from engine.embedder.contrastive.contrastive_dataset import ContrastiveInternalDataset, ContrastiveDataset
+from engine.embedder.contrastive.contrastive_dataset import ContrastiveInternalDataset, ContrastiveDataset, \
+    ContrastiveCachedFeaturesDataset
 from engine.embedder.contrastive.contrastive_infer import infer_model_with_labels
 from engine.embedder.contrastive.contrastive_model import XPrizeTreeEmbedder, XPrizeTreeEmbedder2, \
     XPrizeTreeEmbedder2NoDate, DinoV2Embedder
-from engine.embedder.contrastive.contrastive_utils import FOREST_QPEB_MEAN, FOREST_QPEB_STD, save_model, \
-    contrastive_collate_fn
+from engine.embedder.contrastive.contrastive_utils import save_model, contrastive_collate_fn
 from engine.embedder.transforms import embedder_transforms_v2, embedder_simple_transforms_v2
+from engine.utils.distances import pairwise_distances_mean
+from engine.utils.distributed import init_distributed, is_distributed, is_main_process, barrier, \
+    cleanup_distributed, all_gather_tensor, DistributedBatchShardSampler
+from engine.utils.embedding_index import EmbeddingKNNClassifier
+from engine.utils.feature_cache import build_features_cache, module_fingerprint
+from engine.utils.memory_bank import EmbeddingMemoryBank
+from engine.utils.model_registry import load_weights
 
 
 def train(model: XPrizeTreeEmbedder or XPrizeTreeEmbedder2 or XPrizeTreeEmbedder2NoDate or DinoV2Embedder,
@@ -47,23 +54,51 @@ def train(model: XPrizeTreeEmbedder or XPrizeTreeEmbedder2 or XPrizeTreeEmbedder
           output_dir: Path,
           num_epochs: int,
           validate_every_n_epochs: int,
-          valid_knn_k: int):
-
-    if use_multi_gpu:
-        model = nn.DataParallel(model)
+          valid_knn_k: int,
+          memory_bank: EmbeddingMemoryBank = None,
+          memory_bank_n_negatives: int = 8,
+          memory_bank_n_positives: int = 2,
+          loss_weight_memory_bank: float = 1.0,
+          cached_features: bool = False):
+    """
+    Trains the model with triplets mined within each batch. If a memory_bank is given (the train dataset must then
+    return the global sample ids, see ContrastiveDataset.return_sample_index), the triplets are also mined against the
+    hardest negatives and positives of the whole training set found in the bank, which is refreshed with the
+    embeddings of each batch.
+    If cached_features is True, the train dataloader returns the cached features of the frozen backbone instead of
+    the images (see ContrastiveCachedFeaturesDataset), and only the head of the model is run.
+    If the default process group is initialized (see engine.utils.distributed.init_distributed), the model is
+    wrapped in DistributedDataParallel, each process training on its shard of the batches. The validation, logging
+    and checkpoints are then only done by the main process, the writer and output_dir of the other ones can be None.
+    """
+
+    distributed = is_distributed()
     model.to(device)
+    if distributed:
+        model = nn.parallel.DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+    elif use_multi_gpu:
+        model = nn.DataParallel(model)
 
-    model.eval()
-    with torch.no_grad():
-        validate(
-            model=model,
-            train_loader=valid_train_dataloader,
-            valid_dataloaders=valid_dataloaders,
-            distance=distance,
-            overall_step=0,
-            writer=writer,
-            valid_knn_k=valid_knn_k
-        )
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        actual_model = model.module
+    else:
+        actual_model = model
+    # a DDP forward is a collective operation, so the main process validates the unwrapped model alone
+    validation_model = actual_model if distributed else model
+
+    if is_main_process():
+        model.eval()
+        with torch.no_grad():
+            validate(
+                model=validation_model,
+                train_loader=valid_train_dataloader,
+                valid_dataloaders=valid_dataloaders,
+                distance=distance,
+                overall_step=0,
+                writer=writer,
+                valid_knn_k=valid_knn_k
+            )
+    barrier()
 
     scaler = torch.cuda.amp.GradScaler()  # Initialize the GradScaler for mixed precision training
 
@@ -73,54 +108,77 @@ def train(model: XPrizeTreeEmbedder or XPrizeTreeEmbedder2 or XPrizeTreeEmbedder
         loss_since_last_log = 0
         loss_classification_since_last_log = 0
         loss_triplet_since_last_log = 0
+        loss_memory_bank_since_last_log = 0
         step_since_last_log = 0
         # re-instantiate the dataloader at the start of each epoch as the sampling was re-generated at the end of every epoch
         overall_step = epoch * len(train_dataloader) // n_grad_accumulation_steps
         accumulated_steps = 0
+        if hasattr(train_dataloader.sampler, 'set_epoch'):
+            train_dataloader.sampler.set_epoch(epoch)
 
-        for data in tqdm(train_dataloader, desc=f'Epoch {epoch}...'):
-            imgs, months, days, labels_ids, labels, families_ids, families = data
+        for step_index, data in enumerate(tqdm(train_dataloader, desc=f'Epoch {epoch}...', disable=not is_main_process())):
+            imgs, months, days, labels_ids, labels, families_ids, families = data[:7]
             imgs, labels_ids, families_ids = imgs.to(device), labels_ids.to(device), families_ids.to(device)
             months, days = months.to(device), days.to(device),
 
-            optimizer.zero_grad()
-
-            with torch.cuda.amp.autocast():  # Enable autocasting for mixed precision
-                if isinstance(model, nn.DataParallel):
-                    actual_model = model.module
-                else:
-                    actual_model = model
-
-                if isinstance(actual_model, XPrizeTreeEmbedder):
-                    embeddings = model(imgs)
-                    indices_tuple = mining_func(embeddings, labels_ids)
-                    loss = criterion_metric(embeddings=embeddings, labels=labels_ids, indices_tuple=indices_tuple)
-                elif isinstance(actual_model, XPrizeTreeEmbedder2):
-                    embeddings, classifier_logits = model(imgs, months, days)
-                    indices_tuple = mining_func(embeddings, labels_ids)
-                    loss_triplet = criterion_metric(embeddings=embeddings, labels=labels_ids, indices_tuple=indices_tuple)
-                    model_compatible_labels = torch.Tensor([actual_model.families_to_id_mapping[family] for family in families]).long().to(device)
-                    loss_classification = criterion_classification(classifier_logits, model_compatible_labels)
-                    loss = loss_weight_triplet * loss_triplet + loss_weight_classification * loss_classification
-                    loss_classification_since_last_log += loss_weight_classification * loss_classification.item()
-                    loss_triplet_since_last_log += loss_weight_triplet * loss_triplet.item()
-                elif isinstance(actual_model, XPrizeTreeEmbedder2NoDate):
-                    embeddings, classifier_logits = model(imgs)
-                    indices_tuple = mining_func(embeddings, labels_ids)
-                    loss_triplet = criterion_metric(embeddings=embeddings, labels=labels_ids, indices_tuple=indices_tuple)
-                    model_compatible_labels = torch.Tensor([actual_model.families_to_id_mapping[family] for family in families]).long().to(device)
-                    loss_classification = criterion_classification(classifier_logits, model_compatible_labels)
-                    loss = loss_weight_triplet * loss_triplet + loss_weight_classification * loss_classification
-                    loss_classification_since_last_log += loss_weight_classification * loss_classification.item()
-                    loss_triplet_since_last_log += loss_weight_triplet * loss_triplet.item()
-                elif isinstance(actual_model, DinoV2Embedder):
-                    embeddings = model(imgs)
-                    indices_tuple = mining_func(embeddings, labels_ids)
-                    loss = criterion_metric(embeddings=embeddings, labels=labels_ids, indices_tuple=indices_tuple)
-                else:
-                    raise ValueError(f'Unknown model type: {actual_model.__class__}')
-
-            scaler.scale(loss).backward()  # Backward pass with scaled loss
+            # with DDP, the gradients are only all-reduced on the last step of each accumulation (or of the epoch)
+            sync_gradients = accumulated_steps + 1 == n_grad_accumulation_steps or step_index + 1 == len(train_dataloader)
+            with model.no_sync() if distributed and not sync_gradients else nullcontext():
+                with torch.cuda.amp.autocast():  # Enable autocasting for mixed precision
+                    # imgs are the backbone features if they were cached
+                    forward = actual_model.forward_head if cached_features else model
+
+                    if isinstance(actual_model, XPrizeTreeEmbedder):
+                        embeddings = forward(imgs)
+                        indices_tuple = mining_func(embeddings, labels_ids)
+                        loss = criterion_metric(embeddings=embeddings, labels=labels_ids, indices_tuple=indices_tuple)
+                    elif isinstance(actual_model, XPrizeTreeEmbedder2):
+                        embeddings, classifier_logits = forward(imgs, months, days)
+                        indices_tuple = mining_func(embeddings, labels_ids)
+                        loss_triplet = criterion_metric(embeddings=embeddings, labels=labels_ids, indices_tuple=indices_tuple)
+                        model_compatible_labels = torch.Tensor([actual_model.families_to_id_mapping[family] for family in families]).long().to(device)
+                        loss_classification = criterion_classification(classifier_logits, model_compatible_labels)
+                        loss = loss_weight_triplet * loss_triplet + loss_weight_classification * loss_classification
+                        loss_classification_since_last_log += loss_weight_classification * loss_classification.item()
+                        loss_triplet_since_last_log += loss_weight_triplet * loss_triplet.item()
+                    elif isinstance(actual_model, XPrizeTreeEmbedder2NoDate):
+                        embeddings, classifier_logits = forward(imgs)
+                        indices_tuple = mining_func(embeddings, labels_ids)
+                        loss_triplet = criterion_metric(embeddings=embeddings, labels=labels_ids, indices_tuple=indices_tuple)
+                        model_compatible_labels = torch.Tensor([actual_model.families_to_id_mapping[family] for family in families]).long().to(device)
+                        loss_classification = criterion_classification(classifier_logits, model_compatible_labels)
+                        loss = loss_weight_triplet * loss_triplet + loss_weight_classification * loss_classification
+                        loss_classification_since_last_log += loss_weight_classification * loss_classification.item()
+                        loss_triplet_since_last_log += loss_weight_triplet * loss_triplet.item()
+                    elif isinstance(actual_model, DinoV2Embedder):
+                        embeddings = forward(imgs)
+                        indices_tuple = mining_func(embeddings, labels_ids)
+                        loss = criterion_metric(embeddings=embeddings, labels=labels_ids, indices_tuple=indices_tuple)
+                    else:
+                        raise ValueError(f'Unknown model type: {actual_model.__class__}')
+
+                    if memory_bank is not None:
+                        samples_indices = data[7].to(device)
+                        ref_emb, ref_labels, _ = memory_bank.get_hard_references(embeddings=embeddings,
+                                                                                 labels=labels_ids,
+                                                                                 n_negatives=memory_bank_n_negatives,
+                                                                                 n_positives=memory_bank_n_positives,
+                                                                                 indices=samples_indices)
+                        if len(ref_emb) > 0:
+                            ref_emb = ref_emb.to(embeddings.dtype)
+                            ref_labels = ref_labels.to(labels_ids.dtype)
+                            indices_tuple = mining_func(embeddings, labels_ids, ref_emb, ref_labels)
+                            loss_memory_bank = criterion_metric(embeddings=embeddings, labels=labels_ids,
+                                                                indices_tuple=indices_tuple,
+                                                                ref_emb=ref_emb, ref_labels=ref_labels)
+                            loss = loss + loss_weight_memory_bank * loss_memory_bank
+                            loss_memory_bank_since_last_log += loss_weight_memory_bank * loss_memory_bank.item()
+                        # the bank of each process is refreshed with the batches of all the processes
+                        memory_bank.update(all_gather_tensor(samples_indices), all_gather_tensor(embeddings))
+
+                # averaged over the accumulation steps, so the update has the scale of a single batch of the
+                # accumulated size
+                scaler.scale(loss / n_grad_accumulation_steps).backward()  # Backward pass with scaled loss
 
             total_loss += loss.item()
             loss_since_last_log += loss.item()
@@ -135,17 +193,20 @@ def train(model: XPrizeTreeEmbedder or XPrizeTreeEmbedder2 or XPrizeTreeEmbedder
                 accumulated_steps = 0
                 overall_step += 1
 
-                if overall_step != 0 and overall_step % 10 == 0:
+                if overall_step != 0 and overall_step % 10 == 0 and is_main_process():
                     writer.add_scalar('Loss', loss_since_last_log / step_since_last_log, overall_step)
                     writer.add_scalar('Loss_Classification', loss_classification_since_last_log / step_since_last_log, overall_step)
                     writer.add_scalar('Loss_Triplet', loss_triplet_since_last_log / step_since_last_log, overall_step)
+                    if memory_bank is not None:
+                        writer.add_scalar('Loss_Memory_Bank', loss_memory_bank_since_last_log / step_since_last_log, overall_step)
                     writer.add_scalar('Learning_Rate', optimizer.param_groups[0]['lr'], overall_step)
                     loss_since_last_log = 0
                     loss_classification_since_last_log = 0
                     loss_triplet_since_last_log = 0
+                    loss_memory_bank_since_last_log = 0
                     step_since_last_log = 0
 
-                if overall_step != 0 and overall_step % 50 == 0:
+                if overall_step != 0 and overall_step % 50 == 0 and is_main_process():
                     writer.flush()
 
         # Check if there are remaining accumulated gradients
@@ -154,24 +215,27 @@ def train(model: XPrizeTreeEmbedder or XPrizeTreeEmbedder2 or XPrizeTreeEmbedder
             scaler.update()
             optimizer.zero_grad()
 
-        if epoch % validate_every_n_epochs == 0 and epoch != 0:
-            model.eval()
-            with torch.no_grad():
-                valid_loss = validate(
-                    model=model,
-                    train_loader=valid_train_dataloader,
-                    valid_dataloaders=valid_dataloaders,
-                    distance=distance,
-                    overall_step=overall_step,
-                    writer=writer,
-                    valid_knn_k=valid_knn_k
-                )
-
-            checkpoint_output_file = os.path.join(output_dir, f'checkpoint_{epoch}_{overall_step}.pth')
-            save_model(model, checkpoint_output_file=checkpoint_output_file)
-            print(f'Epoch {epoch}, Train Loss: {total_loss / len(train_dataloader)}, Valid Loss: {valid_loss}')
-        else:
-            print(f'Epoch {epoch}, Train Loss: {total_loss / len(train_dataloader)}')
+        # the validation and checkpoints are done by the main process only
+        if is_main_process():
+            if epoch % validate_every_n_epochs == 0 and epoch != 0:
+                model.eval()
+                with torch.no_grad():
+                    valid_loss = validate(
+                        model=validation_model,
+                        train_loader=valid_train_dataloader,
+                        valid_dataloaders=valid_dataloaders,
+                        distance=distance,
+                        overall_step=overall_step,
+                        writer=writer,
+                        valid_knn_k=valid_knn_k
+                    )
+
+                checkpoint_output_file = os.path.join(output_dir, f'checkpoint_{epoch}_{overall_step}.pth')
+                save_model(model, checkpoint_output_file=checkpoint_output_file)
+                print(f'Epoch {epoch}, Train Loss: {total_loss / len(train_dataloader)}, Valid Loss: {valid_loss}')
+            else:
+                print(f'Epoch {epoch}, Train Loss: {total_loss / len(train_dataloader)}')
+        barrier()
 
         scheduler.step()
         model.train()
@@ -194,6 +258,11 @@ def validate(model,
     scaler_standard = StandardScaler()
     X_train = scaler_standard.fit_transform(train_embeddings)
 
+    # The standardized train embeddings are the kNN reference set of all the validation datasets. The neighbors are
+    # found by blocked top-k on the training device instead of refitting a brute-force sklearn kNN on CPU per dataset.
+    k_neighbors = EmbeddingKNNClassifier(n_neighbors=valid_knn_k, metric=distance, device=device)
+    k_neighbors.fit(X_train, train_labels)
+
     all_valid_embeddings = []
     all_valid_labels_ids = []
     total_knn_accuracy = 0
@@ -210,8 +279,6 @@ def validate(model,
         valid_embeddings = valid_embeddings[~valid_to_delete]
         valid_labels = valid_labels[~valid_to_delete]
         X_test = scaler_standard.transform(valid_embeddings)
-        k_neighbors = KNeighborsClassifier(n_neighbors=valid_knn_k, metric=distance)
-        k_neighbors.fit(X_train, train_labels)
         predictions = k_neighbors.predict(X_test)
 
         all_valid_embeddings.append(valid_embeddings)
@@ -273,29 +340,53 @@ def validate(model,
     return final_valid_loss
 
 
-def get_average_embeddings_distance(embeddings: torch.Tensor, n_max=1000):
-    train_embeddings_np = embeddings.cpu().numpy()
+def build_backbone_features_cache(model, dataset: ContrastiveDataset, cache_path: Path, batch_size: int, num_workers: int):
+    """
+    Infers the frozen backbone of the model once on each sample of an augmentation-free dataset and caches the
+    features, so the head can be trained from them (see ContrastiveCachedFeaturesDataset).
+    """
+    data_loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        collate_fn=contrastive_collate_fn,
+        num_workers=num_workers
+    )
 
-    # Number of embeddings
-    n = train_embeddings_np.shape[0]
+    def feature_extractor(batch):
+        with torch.cuda.amp.autocast():
+            return model.forward_backbone(batch[0].to(device))
 
-    # If the number of pairs is manageable, compute all distances
-    if n <= n_max:
-        # Compute the pairwise distance matrix
-        distances = np.linalg.norm(train_embeddings_np[:, np.newaxis] - train_embeddings_np, axis=2)
+    # the features depend on the backbone weights, the input normalization and the tiles crop size
+    backbone_id = (f"{type(model).__name__}-{dataset.image_size}px-"
+                   f"{module_fingerprint(nn.ModuleList([model.input_normalization, model.backbone]))}")
+    samples_ids = [str(dataset.get_sample_metadata(dataset.index[idx])[0]['path']) for idx in range(len(dataset))]
 
-        # Compute the average distance
-        average_distance = np.mean(distances)
-    else:
-        # Randomly sample pairs if there are too many pairs
+    model.to(device)
+    model.eval()
+    cache_path = build_features_cache(feature_extractor=feature_extractor,
+                                      data_loader=data_loader,
+                                      n_samples=len(dataset),
+                                      cache_path=cache_path,
+                                      backbone_id=backbone_id,
+                                      samples_ids=samples_ids,
+                                      desc='Caching the frozen backbone features...')
+    model.train()
+
+    return cache_path
 
-        indices = np.random.choice(n, n_max, replace=False)
-        sampled_embeddings_np = train_embeddings_np[indices]
 
-        sampled_distances = np.linalg.norm(sampled_embeddings_np[:, np.newaxis] - sampled_embeddings_np, axis=2).flatten()
+def get_average_embeddings_distance(embeddings: torch.Tensor, n_max=10000):
+    # Number of embeddings
+    n = embeddings.shape[0]
 
-        # Compute the average distance of the sampled pairs
-        average_distance = np.mean(sampled_distances)
+    # If there are too many pairs, randomly sample the embeddings
+    if n > n_max:
+        indices = torch.from_numpy(np.random.choice(n, n_max, replace=False)).to(embeddings.device)
+        embeddings = embeddings[indices]
+
+    # The distances are streamed by blocks, on the device of the embeddings
+    average_distance = pairwise_distances_mean(embeddings, metric='euclidean')
 
     print(f"Average distance between pairs: {average_distance}")
 
@@ -348,8 +439,32 @@ if __name__ == '__main__':
     data_loader_num_workers = yaml_config['data_loader_num_workers']
     phylogenetic_tree_distances_path = yaml_config['phylogenetic_tree_distances_path']
     output_folder_root = Path(yaml_config['output_folder_root'])
-
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # cross-batch hard mining with an embedding memory bank, disabled if no momentum is given
+    memory_bank_momentum = yaml_config.get('memory_bank_momentum', None)
+    memory_bank_n_negatives = yaml_config.get('memory_bank_n_negatives', 8)
+    memory_bank_n_positives = yaml_config.get('memory_bank_n_positives', 2)
+    loss_weight_memory_bank = yaml_config.get('loss_weight_memory_bank', 1.0)
+    # with a frozen backbone, train the head from backbone features computed once on the augmentation-free samples
+    cache_backbone_features = yaml_config.get('cache_backbone_features', False)
+    if cache_backbone_features and not freeze_resnet_backbone:
+        raise ValueError('cache_backbone_features requires freeze_resnet_backbone.')
+    # outside of the run folder, so the next runs reuse the cache while its backbone and samples don't change
+    backbone_features_cache_path = Path(yaml_config.get(
+        'backbone_features_cache_path',
+        output_folder_root / 'backbone_features_cache' / f'{resnet_model}_{image_size}_{min_level}.npy'
+    ))
+    # with torchrun, one process per device (or per CPU process with the gloo backend), see engine.utils.distributed,
+    # e.g. torchrun --nnodes 2 --nproc_per_node 4 --rdzv_endpoint <host>:29500 -m engine.embedder.contrastive.contrastive_train --config_path ...
+    distributed_backend = yaml_config.get('distributed_backend', None)
+    seed = yaml_config.get('seed', 0)
+
+    rank, world_size, device = init_distributed(backend=distributed_backend)
+    if world_size > 1:
+        if cache_backbone_features:
+            raise ValueError('cache_backbone_features is not supported with distributed training, as the head would'
+                             ' be called outside of DistributedDataParallel.')
+        # the class balancing resampling of the datasets must be the same in all the processes
+        np.random.seed(seed)
     output_model_name = f'contrastive_{resnet_model}_{image_size}_{final_embedding_size}_{train_batch_size * n_grad_accumulation_steps}_{min_level}'
 
     # Loading datasets
@@ -397,11 +512,9 @@ if __name__ == '__main__':
         image_size=image_size,
         random_crop=random_crop,
         transform=A.Compose(embedder_transforms_v2),
-        normalize=True,
-        mean=FOREST_QPEB_MEAN,
-        std=FOREST_QPEB_STD,
         taxa_distances_df=pd.read_csv(phylogenetic_tree_distances_path),
-        max_resampling_times=max_resampling_times_train
+        max_resampling_times=max_resampling_times_train,
+        return_sample_index=memory_bank_momentum is not None
     )
 
     siamese_sampler_dataset_valid_knn_train = ContrastiveDataset(
@@ -410,9 +523,6 @@ if __name__ == '__main__':
         image_size=image_size,
         random_crop=False,
         transform=A.Compose(embedder_simple_transforms_v2),
-        normalize=True,
-        mean=FOREST_QPEB_MEAN,
-        std=FOREST_QPEB_STD,
         taxa_distances_df=pd.read_csv(phylogenetic_tree_distances_path),
         max_resampling_times=max_resampling_times_valid_train
     )
@@ -431,9 +541,6 @@ if __name__ == '__main__':
             image_size=image_size,
             random_crop=False,
             transform=None,
-            normalize=True,
-            mean=FOREST_QPEB_MEAN,
-            std=FOREST_QPEB_STD,
             taxa_distances_df=pd.read_csv(phylogenetic_tree_distances_path),
             max_resampling_times=0
         )
@@ -450,9 +557,6 @@ if __name__ == '__main__':
             image_size=image_size,
             random_crop=False,
             transform=None,
-            normalize=True,
-            mean=FOREST_QPEB_MEAN,
-            std=FOREST_QPEB_STD,
             taxa_distances_df=pd.read_csv(phylogenetic_tree_distances_path),
             max_resampling_times=0
         )
@@ -469,9 +573,6 @@ if __name__ == '__main__':
             image_size=image_size,
             random_crop=False,
             transform=None,
-            normalize=True,
-            mean=FOREST_QPEB_MEAN,
-            std=FOREST_QPEB_STD,
             taxa_distances_df=pd.read_csv(phylogenetic_tree_distances_path),
             max_resampling_times=0
         )
@@ -488,9 +589,6 @@ if __name__ == '__main__':
             image_size=image_size,
             random_crop=False,
             transform=None,
-            normalize=True,
-            mean=FOREST_QPEB_MEAN,
-            std=FOREST_QPEB_STD,
             taxa_distances_df=pd.read_csv(phylogenetic_tree_distances_path),
             max_resampling_times=0
         )
@@ -501,7 +599,8 @@ if __name__ == '__main__':
     model = XPrizeTreeEmbedder(
         resnet_model=resnet_model,
         final_embedding_size=final_embedding_size,
-        dropout=dropout
+        dropout=dropout,
+        pretrained=not start_from_checkpoint
     )
 
     # model = XPrizeTreeEmbedder2(
@@ -527,7 +626,7 @@ if __name__ == '__main__':
 
     if start_from_checkpoint:
         if isinstance(model, XPrizeTreeEmbedder):
-            model.load_state_dict(torch.load(start_from_checkpoint))
+            model.load_state_dict(load_weights(start_from_checkpoint))
         elif isinstance(model, (XPrizeTreeEmbedder2, XPrizeTreeEmbedder2NoDate, DinoV2Embedder)):
             model = model.from_checkpoint(start_from_checkpoint)
         else:
@@ -552,6 +651,21 @@ if __name__ == '__main__':
         margin=triplet_margin, distance=distance_f, type_of_triplets=triplet_type
     )
 
+    if memory_bank_momentum is not None:
+        # the bank follows the distance of the miner, the embeddings are normalized by LpDistance and CosineSimilarity
+        memory_bank = EmbeddingMemoryBank(
+            n_samples=len(siamese_sampler_dataset_train),
+            embedding_size=final_embedding_size,
+            momentum=memory_bank_momentum,
+            labels=np.array([siamese_sampler_dataset_train.categories_names_to_idx[label]
+                             for label in siamese_sampler_dataset_train.all_samples_labels]),
+            metric=distance,
+            normalize=True,
+            device=device
+        )
+    else:
+        memory_bank = None
+
     optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=0.01)
     if scheduler_name == 'cosine':
         scheduler = torch.optim.lr_scheduler.CosineAnnealingWarmRestarts(optimizer, T_0=scheduler_T, T_mult=scheduler_T_mult)
@@ -564,16 +678,47 @@ if __name__ == '__main__':
     optimizer.step()  # Step once to avoid lr of 0 from scheduler
     scheduler.step()  # Step once to avoid lr of 0 from scheduler
 
-    output_dir = output_folder_root / f'{output_model_name}_{int(time.time())}'
-    os.makedirs(output_dir, exist_ok=True)
-    writer = SummaryWriter(str(output_dir))
+    if rank == 0:
+        output_dir = output_folder_root / f'{output_model_name}_{int(time.time())}'
+        os.makedirs(output_dir, exist_ok=True)
+        writer = SummaryWriter(str(output_dir))
+
+        with open(output_dir / 'contrastive_train_config.yaml', 'w') as config_file:
+            yaml.safe_dump(yaml_config, config_file)
+    else:
+        output_dir = None
+        writer = None
 
-    with open(output_dir / 'contrastive_train_config.yaml', 'w') as config_file:
-        yaml.safe_dump(yaml_config, config_file)
+    if cache_backbone_features:
+        # each tile once, without augmentation nor class balancing resampling
+        cache_dataset = ContrastiveDataset(
+            dataset_config=train_dataset_config,
+            min_level=min_level,
+            image_size=image_size,
+            random_crop=False,
+            transform=None,
+            taxa_distances_df=pd.read_csv(phylogenetic_tree_distances_path),
+            max_resampling_times=0
+        )
+        cache_path = build_backbone_features_cache(model=model,
+                                                   dataset=cache_dataset,
+                                                   cache_path=backbone_features_cache_path,
+                                                   batch_size=valid_batch_size,
+                                                   num_workers=data_loader_num_workers)
+        train_dataset = ContrastiveCachedFeaturesDataset(
+            contrastive_dataset=siamese_sampler_dataset_train,
+            cache_path=cache_path,
+            cache_samples_dataset_indices=cache_dataset.all_samples_dataset_indices
+        )
+    else:
+        train_dataset = siamese_sampler_dataset_train
 
     train_sampler = MPerClassSampler(siamese_sampler_dataset_train.all_samples_labels, m=triplet_sampler_m, batch_size=train_batch_size, length_before_new_iter=len(siamese_sampler_dataset_train))
+    if world_size > 1:
+        # each process gets whole batches of the same MPerClassSampler draw, train_batch_size is per process
+        train_sampler = DistributedBatchShardSampler(train_sampler, batch_size=train_batch_size, seed=seed)
     train_dataloader = DataLoader(
-        siamese_sampler_dataset_train,
+        train_dataset,
         batch_size=train_batch_size,
         collate_fn=contrastive_collate_fn,
         pin_memory=use_multi_gpu,
@@ -620,6 +765,13 @@ if __name__ == '__main__':
         output_dir=output_dir,
         num_epochs=num_epochs,
         validate_every_n_epochs=validate_every_n_epochs,
-        valid_knn_k=valid_knn_k
+        valid_knn_k=valid_knn_k,
+        memory_bank=memory_bank,
+        memory_bank_n_negatives=memory_bank_n_negatives,
+        memory_bank_n_positives=memory_bank_n_positives,
+        loss_weight_memory_bank=loss_weight_memory_bank,
+        cached_features=cache_backbone_features
     )
 
+    cleanup_distributed()
+
@@ -1,3 +1,5 @@
+from pathlib import Path
+
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -16,14 +18,6 @@ FOREST_QPEB_MEAN = np.array([0.463, 0.537, 0.363])
 FOREST_QPEB_STD = np.array([0.207, 0.206, 0.162])
 
 
-def scale_values(values, old_min, old_max, new_min, new_max):
-    scaled_values = []
-    for value in values:
-        scaled_value = ((value - old_min) / (old_max - old_min)) * (new_max - new_min) + new_min
-        scaled_values.append(scaled_value)
-    return scaled_values
-
-
 def normalize(data: np.array, mean: np.array, std: np.array):
     for channel in range(data.shape[0]):
         data[channel] = (data[channel] - mean[channel]) / std[channel]
@@ -32,7 +26,7 @@ def normalize(data: np.array, mean: np.array, std: np.array):
 
 
 def save_model(model, checkpoint_output_file):
-    if isinstance(model, nn.DataParallel):
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
         # Save the original model which is wrapped inside `.module`
         actual_model = model.module
     else:
@@ -71,7 +65,8 @@ def pad_and_stack_images(images):
 
 
 def contrastive_collate_fn(batch):
-    images = [torch.Tensor(b[0]) for b in batch]
+    # the images stay uint8 until they are on the model device
+    images = [torch.from_numpy(b[0]) for b in batch]
     months = torch.Tensor([b[1] for b in batch]).long()
     days = torch.Tensor([b[2] for b in batch]).long()
     labels_ids = torch.Tensor([b[3] for b in batch])
@@ -81,11 +76,16 @@ def contrastive_collate_fn(batch):
 
     images_padded = pad_and_stack_images(images)
 
+    if len(batch[0]) > 7:
+        # the datasets built with return_sample_index=True also return the global sample ids
+        samples_indices = torch.Tensor([b[7] for b in batch]).long()
+        return images_padded, months, days, labels_ids, labels, families_ids, families, samples_indices
+
     return images_padded, months, days, labels_ids, labels, families_ids, families
 
 
 def contrastive_infer_collate_fn(batch):
-    images = [torch.Tensor(b[0]) for b in batch]
+    images = [torch.from_numpy(b[0]) for b in batch]
     months = torch.Tensor([b[1] for b in batch]).long()
     days = torch.Tensor([b[2] for b in batch]).long()
 
@@ -107,3 +107,61 @@ class ConditionalAutocast:
         if self.autocast:
             self.autocast.__exit__(exc_type, exc_val, exc_tb)
 
+
+
+class InferenceOutputBuffer:
+    """
+    Collects the per-batch outputs of an inference loop into an array preallocated from the number of samples,
+    instead of growing a tensor with torch.cat at each batch, which copies all the previous outputs every time.
+    The array is allocated at the first batch, once the shape of the outputs is known. With an output_path, the
+    array is a memory-mapped .npy file, so the outputs are streamed to disk instead of being kept in memory.
+
+    Parameters:
+    - n_samples (int): The expected number of samples, usually len(dataloader.dataset).
+        An in-memory buffer grows if more samples are added, a memory-mapped one raises a ValueError.
+    - output_path (str or Path or None): The path of the .npy file to stream the outputs to, if any.
+    - dtype (np.dtype): The dtype of the outputs.
+    """
+    def __init__(self, n_samples: int, output_path: str or Path = None, dtype: np.dtype = np.float32):
+        self.n_samples = n_samples
+        self.output_path = output_path
+        self.dtype = dtype
+
+        self.array = None
+        self.size = 0
+
+    def add(self, batch_outputs: torch.Tensor or np.ndarray):
+        if isinstance(batch_outputs, torch.Tensor):
+            batch_outputs = batch_outputs.detach().cpu().numpy()
+
+        if self.array is None:
+            shape = (max(self.n_samples, len(batch_outputs)),) + batch_outputs.shape[1:]
+            if self.output_path:
+                self.array = np.lib.format.open_memmap(self.output_path, mode='w+', dtype=self.dtype, shape=shape)
+            else:
+                self.array = np.empty(shape, dtype=self.dtype)
+        elif self.size + len(batch_outputs) > len(self.array):
+            if self.output_path:
+                raise ValueError(f"More than the {len(self.array)} expected samples were added to the memory-mapped"
+                                 f" buffer {self.output_path}.")
+            grown_array = np.empty((max(2 * len(self.array), self.size + len(batch_outputs)),) + self.array.shape[1:],
+                                   dtype=self.dtype)
+            grown_array[:self.size] = self.array[:self.size]
+            self.array = grown_array
+
+        self.array[self.size:self.size + len(batch_outputs)] = batch_outputs
+        self.size += len(batch_outputs)
+
+    def get(self, as_numpy: bool = True):
+        """
+        Returns the outputs added so far, as a view of the buffer (no copy). If the buffer is memory-mapped, it is
+        flushed to disk first, and its file keeps the n_samples rows even if fewer samples were added.
+        """
+        if self.array is None:
+            outputs = np.empty((0,), dtype=self.dtype)
+        else:
+            if self.output_path:
+                self.array.flush()
+            outputs = self.array[:self.size]
+
+        return outputs if as_numpy else torch.from_numpy(np.asarray(outputs))
@@ -4,12 +4,12 @@ import numpy as np
 import pandas as pd
 import torch
 from sklearn.metrics import classification_report
-from sklearn.neighbors import KNeighborsClassifier
 
 from engine.embedder.contrastive.contrastive_dataset import ContrastiveInternalDataset, ContrastiveDataset
 from engine.embedder.contrastive.contrastive_model import XPrizeTreeEmbedder
 from engine.embedder.contrastive.contrastive_train import infer_model
-from engine.embedder.contrastive.contrastive_utils import FOREST_QPEB_MEAN, FOREST_QPEB_STD, contrastive_collate_fn
+from engine.embedder.contrastive.contrastive_utils import contrastive_collate_fn
+from engine.utils.embedding_index import EmbeddingKNNClassifier
 
 
 if __name__ == "__main__":
@@ -88,9 +88,6 @@ if __name__ == "__main__":
         min_level=min_level,
         image_size=image_size,
         transform=None,
-        normalize=True,
-        mean=FOREST_QPEB_MEAN,
-        std=FOREST_QPEB_STD,
         taxa_distances_df=pd.read_csv(phylogenetic_tree_distances_path)
     )
 
@@ -104,9 +101,6 @@ if __name__ == "__main__":
         min_level=min_level,
         image_size=image_size,
         transform=None,
-        normalize=True,
-        mean=FOREST_QPEB_MEAN,
-        std=FOREST_QPEB_STD,
         taxa_distances_df=pd.read_csv(phylogenetic_tree_distances_path)
     )
 
@@ -125,7 +119,7 @@ if __name__ == "__main__":
     test_embeddings_np = test_embeddings.cpu().numpy() if isinstance(test_embeddings, torch.Tensor) else np.array(test_embeddings)
 
     # train a k neighbors classifier
-    k_neighbors = KNeighborsClassifier(n_neighbors=n_neighbors, metric=metric)
+    k_neighbors = EmbeddingKNNClassifier(n_neighbors=n_neighbors, metric=metric, device=device)
     k_neighbors.fit(train_embeddings_np, train_labels_ids)
     test_predictions = k_neighbors.predict(test_embeddings_np)
 
@@ -14,7 +14,7 @@ from engine.embedder.contrastive.contrastive_dataset import ContrastiveInternalD
 from engine.embedder.contrastive.contrastive_model import XPrizeTreeEmbedder, XPrizeTreeEmbedder2, \
     XPrizeTreeEmbedder2NoDate
 from engine.embedder.contrastive.contrastive_train import infer_model_with_labels
-from engine.embedder.contrastive.contrastive_utils import FOREST_QPEB_MEAN, FOREST_QPEB_STD, contrastive_collate_fn
+from engine.embedder.contrastive.contrastive_utils import contrastive_collate_fn
 
 if __name__ == "__main__":
     # source_data_root = Path('/home/hugo/Documents/xprize/data/FINAL_polygon_dataset_1536px_gr0p03')
@@ -90,9 +90,6 @@ if __name__ == "__main__":
         min_level=min_level,
         image_size=image_size,
         transform=None,
-        normalize=True,
-        mean=FOREST_QPEB_MEAN,
-        std=FOREST_QPEB_STD,
         taxa_distances_df=pd.read_csv(phylogenetic_tree_distances_path),
         max_resampling_times=0
     )
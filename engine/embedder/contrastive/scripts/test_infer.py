@@ -14,7 +14,7 @@ from engine.embedder.contrastive.contrastive_dataset import ContrastiveInternalD
 from engine.embedder.contrastive.contrastive_model import XPrizeTreeEmbedder, XPrizeTreeEmbedder2, \
     XPrizeTreeEmbedder2NoDate
 from engine.embedder.contrastive.contrastive_infer import infer_model_without_labels, infer_model_with_labels
-from engine.embedder.contrastive.contrastive_utils import FOREST_QPEB_MEAN, FOREST_QPEB_STD, contrastive_collate_fn, \
+from engine.embedder.contrastive.contrastive_utils import contrastive_collate_fn, \
     contrastive_infer_collate_fn
 
 if __name__ == "__main__":
@@ -71,9 +71,6 @@ if __name__ == "__main__":
         date_pattern=brazil_date_pattern,
         image_size=image_size,
         transform=None,
-        normalize=True,
-        mean=FOREST_QPEB_MEAN,
-        std=FOREST_QPEB_STD
     )
 
     dataset = ContrastiveDataset(
@@ -89,9 +86,6 @@ if __name__ == "__main__":
         random_crop=False,
         image_size=image_size,
         transform=None,
-        normalize=True,
-        mean=FOREST_QPEB_MEAN,
-        std=FOREST_QPEB_STD,
         taxa_distances_df=pd.read_csv(phylogenetic_tree_distances_path),
         max_resampling_times=0
     )
@@ -0,0 +1,97 @@
+import os
+import socket
+import unittest
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+from torch.utils.data import Sampler
+
+from engine.utils.distributed import init_distributed, cleanup_distributed, all_gather_tensor, \
+    DistributedBatchShardSampler
+
+WORLD_SIZE = 2
+BATCH_SIZE = 4
+
+
+class NumpyPermutationSampler(Sampler):
+    # draws from np.random like the pytorch-metric-learning samplers
+    def __init__(self, n_samples: int):
+        self.n_samples = n_samples
+
+    def __len__(self):
+        return self.n_samples
+
+    def __iter__(self):
+        return iter(np.random.permutation(self.n_samples).tolist())
+
+
+def _get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _get_model() -> nn.Module:
+    torch.manual_seed(0)
+    return nn.Linear(5, 3)
+
+
+def _get_batch(rank: int) -> torch.Tensor:
+    return torch.randn(BATCH_SIZE, 5, generator=torch.Generator().manual_seed(100 + rank))
+
+
+def _get_loss(model: nn.Module, batch: torch.Tensor) -> torch.Tensor:
+    return model(batch).pow(2).mean()
+
+
+def _run_process(rank: int, port: int):
+    os.environ.update({'RANK': str(rank), 'LOCAL_RANK': str(rank), 'WORLD_SIZE': str(WORLD_SIZE),
+                       'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port)})
+    init_distributed(backend='gloo')
+    try:
+        # the shards of the processes are the whole batches of a single draw, with the same seed in all the processes
+        n_samples = 4 * WORLD_SIZE * BATCH_SIZE + 3
+        sampler = DistributedBatchShardSampler(NumpyPermutationSampler(n_samples), batch_size=BATCH_SIZE, seed=7)
+        sampler.set_epoch(1)
+        np.random.seed(rank)  # the global NumPy state of the processes doesn't matter, and is restored
+        numpy_state = np.random.get_state()[1].copy()
+        shard = torch.tensor(list(sampler))
+        assert np.array_equal(np.random.get_state()[1], numpy_state)
+        assert len(shard) == len(sampler) == 4 * BATCH_SIZE
+
+        np.random.seed(7 + 1)
+        expected_indices = torch.tensor(np.random.permutation(n_samples)[:4 * WORLD_SIZE * BATCH_SIZE])
+        gathered_shards = all_gather_tensor(shard).view(WORLD_SIZE, -1, BATCH_SIZE)
+        assert torch.equal(gathered_shards.transpose(0, 1).flatten(), expected_indices)
+
+        # after one step on different batches, the parameters are the same in all the processes, and equal to a
+        # single process step on the batches of all the processes
+        model = nn.parallel.DistributedDataParallel(_get_model())
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        _get_loss(model, _get_batch(rank)).backward()
+        optimizer.step()
+
+        reference_model = _get_model()
+        reference_optimizer = torch.optim.SGD(reference_model.parameters(), lr=0.1)
+        _get_loss(reference_model, torch.cat([_get_batch(r) for r in range(WORLD_SIZE)])).backward()
+        reference_optimizer.step()
+
+        for parameter, reference_parameter in zip(model.parameters(), reference_model.parameters()):
+            gathered_parameters = all_gather_tensor(parameter.detach().unsqueeze(0))
+            assert torch.equal(gathered_parameters[0], gathered_parameters[1])
+            assert torch.allclose(parameter, reference_parameter, atol=1e-6)
+        dist.barrier()
+    finally:
+        cleanup_distributed()
+
+
+class TestDistributedTraining(unittest.TestCase):
+    def test_two_gloo_processes(self):
+        mp.spawn(_run_process, args=(_get_free_port(),), nprocs=WORLD_SIZE, join=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,25 +2,27 @@ import itertools
 import json
 import math
 import time
+from functools import partial
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
 import geopandas as gpd
 import torch
 import torch.nn.functional as F
 import torchvision.transforms.functional as tvf
 from einops import einops
-from geodataset.utils import rle_segmentation_to_mask, mask_to_polygon, tiles_polygons_gdf_to_crs_gdf
+from geodataset.utils import rle_segmentation_to_mask, mask_to_polygon
 from scipy import sparse
-from skimage.measure import block_reduce
 from tqdm import tqdm
 
 from geodataset.dataset import SegmentationLabeledRasterCocoDataset
 
 from config.config_parsers.embedder_parsers import DINOv2InferConfig
-from engine.embedder.dinov2.dinov2_dataset import DINOv2SegmentationLabeledRasterCocoDataset
+from engine.embedder.dinov2.dinov2_dataset import DINOv2SegmentationLabeledRasterCocoDataset, \
+    PaddedSizeBucketBatchSampler, collate_fn_segmentation_padded
 from engine.embedder.utils import apply_pca_to_images, IMAGENET_MEAN, IMAGENET_STD, FOREST_QPEB_MEAN, FOREST_QPEB_STD
+from engine.utils.model_registry import get_dinov2_backbone
+from engine.utils.polygons import tiles_polygons_gdf_to_crs_gdf
 from engine.utils.utils import collate_fn_segmentation
 
 
@@ -40,7 +42,14 @@ class DINOv2Preprocessor:
         pad_size_right = pad_size - pad_size_left
         return pad_size_left, pad_size_right
 
-    def preprocess(self, x: torch.Tensor):
+    def preprocess(self, x: torch.Tensor, valid_pixels_masks: torch.Tensor = None):
+        """
+        Parameters:
+        - x (torch.Tensor): The (batch, channels, height, width) tiles.
+        - valid_pixels_masks (torch.Tensor or None): The (batch, 1, height, width) masks of the pixels which are not
+          padding, for batches padded by collate_fn_segmentation_padded. The padding is reset to 0 after the
+          normalization, like the padding added by this method.
+        """
         if self.normalize:
             if self.instance_normalization:
                 mean = x.mean(dim=(2, 3), keepdim=True)
@@ -54,6 +63,9 @@ class DINOv2Preprocessor:
                 else:
                     raise ValueError("Invalid mean_std_descriptor value. Valid values are ['imagenet', 'forest_qpeb']")
 
+            if valid_pixels_masks is not None:
+                x = x * valid_pixels_masks
+
         pads = list(itertools.chain.from_iterable(self._get_pad(m) for m in x.shape[:1:-1]))
         x = F.pad(x, pads)
         num_h_patches, num_w_patches = x.shape[2] // self.vit_patch_size, x.shape[3] // self.vit_patch_size
@@ -98,113 +110,164 @@ class DINOv2Inference:
 
         model_name = f"dinov2_vit{self.size[0]}{self.vit_patch_size}_reg"
 
-        return torch.hub.load('facebookresearch/dinov2', model_name, pretrained=True).to(self.device)
+        return get_dinov2_backbone(model_name).to(self.device)
+
+    def _forward(self, x: torch.Tensor, average_non_masked_patches: bool, valid_pixels_masks: torch.Tensor = None):
+        pp_x, pads, num_h_patches, num_w_patches = self.preprocessor.preprocess(x, valid_pixels_masks=valid_pixels_masks)
+        pp_x = pp_x.to(self.device)
+
+        output = self.model(pp_x, is_training=True)
+
+        if average_non_masked_patches:
+            output = output['x_norm_patchtokens']
+            output_pp = self.preprocessor.postprocess(
+                output,
+                num_h_patches=num_h_patches,
+                num_w_patches=num_w_patches
+            )
+        else:
+            output = output['x_norm_clstoken']
+            output_pp = output
+
+        return output_pp, pads
+
+    def __call__(self, x: torch.Tensor, average_non_masked_patches: bool, valid_pixels_masks: torch.Tensor = None):
+        with torch.inference_mode():
+            output_pp, pads = self._forward(x, average_non_masked_patches, valid_pixels_masks=valid_pixels_masks)
+            return output_pp.cpu().numpy(), pads
+
+    def embed(self, images: torch.Tensor, labels: list, average_non_masked_patches: bool,
+              valid_pixels_masks: torch.Tensor = None):
+        """
+        Computes the embedding of each tile of a batch collated by collate_fn_segmentation.
+        If average_non_masked_patches, the embedding of each polygon of a tile is the sum of its patches embeddings
+        weighted by the polygon mask, divided by the number of patches it covers, otherwise it is the tile CLS token.
+
+        The masks of the batch are down sampled to the patches grid and pooled in a single batched operation on the
+        model device, the tiles with fewer polygons being padded with empty masks.
 
-    def __call__(self, x: torch.Tensor, average_non_masked_patches: bool):
+        Returns:
+        - A list with the embedding and the down sampled masks of each tile.
+        """
         with torch.inference_mode():
-            pp_x, pads, num_h_patches, num_w_patches = self.preprocessor.preprocess(x)
-            pp_x = pp_x.to(self.device)
+            embeddings, image_pads = self._forward(images, average_non_masked_patches=average_non_masked_patches,
+                                                   valid_pixels_masks=valid_pixels_masks)
 
-            output = self.model(pp_x, is_training=True)
+            height, width = images.shape[2:]
+            n_masks = [len(label['masks']) for label in labels]
+            masks = torch.nn.utils.rnn.pad_sequence(
+                [label['masks'].reshape(-1, height, width) for label in labels], batch_first=True
+            ).to(self.device, dtype=torch.float32)
+
+            # (batch, max_n_masks, num_h_patches, num_w_patches) fraction of each patch covered by each mask
+            masks = F.pad(masks, image_pads)
+            down_sampled_masks = F.avg_pool2d(masks, kernel_size=self.vit_patch_size)
 
             if average_non_masked_patches:
-                output = output['x_norm_patchtokens']
-                output_pp = self.preprocessor.postprocess(
-                    output,
-                    num_h_patches=num_h_patches,
-                    num_w_patches=num_w_patches
-                )
-            else:
-                output = output['x_norm_clstoken']
-                output_pp = output
+                masks_embeddings = torch.einsum('bkhw,bhwc->bkc', down_sampled_masks, embeddings)
+                non_zero_count = (down_sampled_masks > 0).sum(dim=(2, 3)).clamp(min=1)
+                embeddings = masks_embeddings / non_zero_count.unsqueeze(-1)
 
-            return output_pp.cpu().numpy(), pads
+            embeddings = embeddings.cpu().numpy()
+            down_sampled_masks = down_sampled_masks.cpu().numpy()
+
+        tiles_embeddings_and_masks = []
+        for j, n in enumerate(n_masks):
+            embedding = embeddings[j, :n] if average_non_masked_patches else embeddings[j]
+            tiles_embeddings_and_masks.append((embedding, down_sampled_masks[j, :n]))
+
+        return tiles_embeddings_and_masks
 
     def infer_on_segmentation_dataset(self,
                                       dataset: DINOv2SegmentationLabeledRasterCocoDataset,
                                       average_non_masked_patches: bool,
-                                      batch_size: int):
-        data_loader = torch.utils.data.DataLoader(dataset,
-                                                  batch_size=batch_size,
-                                                  num_workers=3,
-                                                  collate_fn=collate_fn_segmentation)
+                                      batch_size: int,
+                                      max_batch_pixels: int = None):
+        """
+        Parameters:
+        - batch_size (int): The number of tiles per batch, if max_batch_pixels is None. The tiles must then have
+          the same size, or batch_size be 1.
+        - max_batch_pixels (int or None): If provided, the tiles are grouped by their size padded to the ViT patch
+          size, in batches of at most max_batch_pixels padded pixels (see PaddedSizeBucketBatchSampler), so variable
+          size tiles don't have to be inferred one by one.
+        """
+        if max_batch_pixels:
+            data_loader = torch.utils.data.DataLoader(
+                dataset,
+                batch_sampler=PaddedSizeBucketBatchSampler(tiles_sizes=dataset.get_tiles_sizes(),
+                                                           vit_patch_size=self.vit_patch_size,
+                                                           max_batch_pixels=max_batch_pixels),
+                num_workers=3,
+                collate_fn=partial(collate_fn_segmentation_padded, vit_patch_size=self.vit_patch_size)
+            )
+        else:
+            data_loader = torch.utils.data.DataLoader(dataset,
+                                                      batch_size=batch_size,
+                                                      num_workers=3,
+                                                      collate_fn=collate_fn_segmentation)
+
+        # One row per polygon. The rows of a tile are found from its dataset index,
+        # so the results are in the dataset order whatever the batches order.
+        tiles_n_rows = np.array([len(dataset.tiles[idx]['labels']) for idx in range(len(dataset))])
+        tiles_first_row = np.concatenate([[0], np.cumsum(tiles_n_rows)[:-1]])
+        n_rows = int(tiles_n_rows.sum())
+        tiles_n_writes = np.zeros(len(dataset), dtype=int)
+
+        embeddings = None
+        rows_columns = {column: [None] * n_rows for column in ['geometry', 'down_sampled_masks']}
+        rows_attributes = {'labels': np.zeros(n_rows, dtype=int),
+                           'area': np.zeros(n_rows, dtype=float),
+                           'iscrowd': np.zeros(n_rows, dtype=bool)}
 
-        dfs = []
         tqdm_dataset = tqdm(data_loader, desc="Inferring DINOv2...")
         for i, x in enumerate(tqdm_dataset):
             images = x[0]
             labels = x[1]
-
-            embeddings, image_pads = self(images, average_non_masked_patches=average_non_masked_patches)
-            for j, label in enumerate(labels):
-                embedding = embeddings[j]
-                image_masks = label['masks']
-                image_masks = image_masks.cpu().detach().numpy()
-
-                masks = np.stack(image_masks, axis=0)
-
-                # Applying padding to the masks
-                masks_pads = ((0, 0), (image_pads[0], image_pads[1]), (image_pads[2], image_pads[3]))
-                image_masks = np.pad(masks, masks_pads, mode='constant', constant_values=0)
-
-                down_sampled_masks = block_reduce(
-                    image_masks,
-                    block_size=(1, self.vit_patch_size, self.vit_patch_size),
-                    func=np.mean
-                )
-
-                if average_non_masked_patches:
-                    down_sampled_masks_patches_embeddings = embedding * down_sampled_masks[:, :, :, np.newaxis]
-                    down_sampled_masks_embeddings = np.sum(down_sampled_masks_patches_embeddings, axis=(1, 2))
-
-                    non_zero_mask = down_sampled_masks > 0
-                    non_zero_count = np.sum(non_zero_mask, axis=(1, 2))
-                    non_zero_count = np.where(non_zero_count == 0, 1, non_zero_count)
-                    non_zero_patches_mean = down_sampled_masks_embeddings / non_zero_count[:, np.newaxis]
-                    embedding = non_zero_patches_mean
-
-                df = pd.DataFrame({
-                    'labels': label['labels'].cpu().numpy().tolist(),
-                    'geometry': label['labels_polygons'],
-                    'area': label['area'].cpu().numpy().tolist(),
-                    'iscrowd': label['iscrowd'].cpu().numpy().tolist(),
-                    'image_id': [int(label['image_id'][0])] * len(label['labels']),
-                    'tile_path': [dataset.tiles[int(label['image_id'][0])]['path']] * len(label['labels'].cpu().numpy()),
-                    'embeddings': [embedding.flatten().tolist()],
-                    'down_sampled_masks': down_sampled_masks.tolist()
-                })
-                dfs.append(df)
-
-        final_gdf = gpd.GeoDataFrame(pd.concat(dfs))
+            valid_pixels_masks = x[2] if len(x) > 2 else None
+
+            tiles_embeddings_and_masks = self.embed(images, labels, average_non_masked_patches=average_non_masked_patches,
+                                                    valid_pixels_masks=valid_pixels_masks)
+            for label, (embedding, down_sampled_masks) in zip(labels, tiles_embeddings_and_masks):
+                idx = int(label['image_id'][0])
+                if not 0 <= idx < len(dataset):
+                    raise ValueError(f"Invalid tile index {idx} for a dataset of {len(dataset)} tiles.")
+                tiles_n_writes[idx] += 1
+                rows = slice(tiles_first_row[idx], tiles_first_row[idx] + tiles_n_rows[idx])
+
+                if not average_non_masked_patches:
+                    # the CLS token is shared by all the polygons of the tile
+                    embedding = np.broadcast_to(embedding, (tiles_n_rows[idx], embedding.shape[-1]))
+
+                if embedding.shape[0] != tiles_n_rows[idx]:
+                    raise ValueError(f"Tile {dataset.tiles[idx]['path']} has {len(down_sampled_masks)} polygons, but"
+                                     f" {tiles_n_rows[idx]} embeddings rows are expected.")
+                if embeddings is None:
+                    embeddings = np.zeros((n_rows, embedding.shape[-1]), dtype=embedding.dtype)
+                embeddings[rows] = embedding
+
+                rows_attributes['labels'][rows] = label['labels'].cpu().numpy()
+                rows_attributes['area'][rows] = label['area'].cpu().numpy()
+                rows_attributes['iscrowd'][rows] = label['iscrowd'].cpu().numpy()
+                rows_columns['geometry'][rows] = label['labels_polygons']
+                rows_columns['down_sampled_masks'][rows] = list(down_sampled_masks)
+
+        if not (tiles_n_writes == 1).all():
+            raise ValueError(f"Every tile should be inferred exactly once, but {int((tiles_n_writes == 0).sum())} tiles"
+                             f" were not inferred and {int((tiles_n_writes > 1).sum())} were inferred several times.")
+
+        tiles_paths = [str(dataset.tiles[idx]['path']) for idx in range(len(dataset))]
+        final_gdf = gpd.GeoDataFrame({
+            'labels': rows_attributes['labels'],
+            'geometry': rows_columns['geometry'],
+            'area': rows_attributes['area'],
+            'iscrowd': rows_attributes['iscrowd'],
+            'image_id': np.repeat(np.arange(len(dataset)), tiles_n_rows),
+            'tile_path': np.repeat(tiles_paths, tiles_n_rows),
+            'embeddings': list(embeddings),
+            'down_sampled_masks': rows_columns['down_sampled_masks']
+        })
         final_gdf_crs = tiles_polygons_gdf_to_crs_gdf(final_gdf)
         final_gdf_crs.set_geometry('geometry')
-        final_gdf_crs['embeddings'] = final_gdf_crs['embeddings'].apply(lambda e: str(e))
         print("Done.")
 
         return final_gdf_crs
-
-
-def infer_dinov2(data_roots: str,
-                 image_size_center_crop_pad: int,
-                 size: str,
-                 use_cls_token: bool):
-
-    dataset = DINOv2SegmentationLabeledRasterCocoDataset(
-        root_path=data_roots,
-        fold='infer',
-        image_size_center_crop_pad=image_size_center_crop_pad
-    )
-
-    dinov2 = DINOv2Inference(
-        size=size,
-        normalize=False,
-        instance_segmentation=False
-    )
-
-    embeddings_df = dinov2.infer_on_segmentation_dataset(
-        dataset=dataset,
-        average_non_masked_patches=not use_cls_token,
-        batch_size=1
-    )
-
-    return embeddings_df
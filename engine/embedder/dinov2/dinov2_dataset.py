@@ -1,11 +1,17 @@
+import math
+from collections import defaultdict
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
 
 import albumentations
 import numpy as np
 import rasterio
+import torch
 from geodataset.dataset.base_dataset import BaseLabeledRasterCocoDataset
-from geodataset.utils import rle_segmentation_to_mask, mask_to_polygon
+from geodataset.utils import rle_segmentation_to_mask
+
+from engine.utils.polygons import masks_to_polygons
+from engine.utils.utils import collate_fn_segmentation
 
 
 class DINOv2SegmentationLabeledRasterCocoDataset(BaseLabeledRasterCocoDataset):
@@ -26,26 +32,47 @@ class DINOv2SegmentationLabeledRasterCocoDataset(BaseLabeledRasterCocoDataset):
         Returns:
         - A tuple containing the transformed tile and its segmentations/masks.
         """
-        tile_info = self.tiles[idx]
+        return self.preprocess_tile(idx, self.read_tile(idx))
 
-        with rasterio.open(tile_info['path']) as tile_file:
-            tile = tile_file.read([1, 2, 3])  # Reading the first three bands
+    def get_tiles_sizes(self) -> List[Tuple[int, int]]:
+        """
+        Returns the (height, width) of each tile after preprocess_tile, reading only the tiles headers.
+        """
+        tiles_sizes = []
+        for idx in range(len(self)):
+            with rasterio.open(self.tiles[idx]['path']) as tile_file:
+                height, width = tile_file.height, tile_file.width
+            if self.image_size_center_crop_pad and height != self.image_size_center_crop_pad:
+                height, width = self.image_size_center_crop_pad, self.image_size_center_crop_pad
+            tiles_sizes.append((height, width))
+
+        return tiles_sizes
+
+    def read_tile(self, idx: int) -> np.ndarray:
+        with rasterio.open(self.tiles[idx]['path']) as tile_file:
+            return tile_file.read([1, 2, 3])  # Reading the first three bands
+
+    def preprocess_tile(self, idx: int, tile: np.ndarray):
+        """
+        Decodes the masks of a tile read by read_tile and crops/pads the tile and its masks, so that the tile can be
+        decoded once and shared with other embedders (see engine.embedder.multi_embedder).
+        """
+        tile_info = self.tiles[idx]
 
         labels = tile_info['labels']
         masks = []
-        polygons = []
         for label in labels:
             if 'segmentation' in label:
                 segmentation = label['segmentation']
                 if ('is_rle_format' in label and label['is_rle_format']) or isinstance(segmentation, dict):
                     # RLE format
                     mask = rle_segmentation_to_mask(segmentation)
-                    polygon = mask_to_polygon(mask)
-                    polygons.append(polygon)
                     masks.append(mask)
                 else:
                     raise NotImplementedError("Please make sure that the masks are encoded using RLE.")
 
+        polygons = masks_to_polygons(np.stack(masks, axis=0)) if masks else []
+
         category_ids = np.array([0 if label['category_id'] is None else label['category_id']
                                  for label in labels])
 
@@ -101,3 +128,66 @@ class DINOv2SegmentationLabeledRasterCocoDataset(BaseLabeledRasterCocoDataset):
                              'area': area, 'iscrowd': iscrowd, 'image_id': image_id, 'labels_polygons': polygons}
 
         return transformed_image, transformed_masks
+
+
+def get_padded_size(size: int, vit_patch_size: int) -> int:
+    return math.ceil(size / vit_patch_size) * vit_patch_size
+
+
+class PaddedSizeBucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Groups the tiles by their size padded to a multiple of the ViT patch size, and splits each group into batches
+    of at most max_batch_pixels padded pixels, so that variable size tiles (use_variable_tile_size) can be batched
+    with a single pad per batch (see collate_fn_segmentation_padded).
+
+    Parameters:
+    - tiles_sizes (List[Tuple[int, int]]): The (height, width) of each tile, see DINOv2SegmentationLabeledRasterCocoDataset.get_tiles_sizes.
+    - vit_patch_size (int): The patch size of the ViT.
+    - max_batch_pixels (int): The maximum number of padded pixels in a batch. A batch has at least one tile.
+    """
+    def __init__(self, tiles_sizes: List[Tuple[int, int]], vit_patch_size: int, max_batch_pixels: int):
+        buckets = defaultdict(list)
+        for idx, (height, width) in enumerate(tiles_sizes):
+            buckets[(get_padded_size(height, vit_patch_size), get_padded_size(width, vit_patch_size))].append(idx)
+
+        self.batches = []
+        for (padded_height, padded_width), bucket_ids in sorted(buckets.items()):
+            batch_size = max(1, max_batch_pixels // (padded_height * padded_width))
+            for i in range(0, len(bucket_ids), batch_size):
+                self.batches.append(bucket_ids[i:i + batch_size])
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def collate_fn_segmentation_padded(batch, vit_patch_size: int):
+    """
+    Pads the tiles (and their masks) of a batch to the same size, a multiple of the ViT patch size, before
+    collating them with collate_fn_segmentation. Each tile is centered like DINOv2Preprocessor.preprocess would
+    pad it alone, so batching doesn't change the patches of a tile.
+
+    Returns:
+    - The images, the labels and a (batch, 1, height, width) mask of the pixels which are not padding.
+    """
+    padded_height = max(get_padded_size(item[0].shape[1], vit_patch_size) for item in batch)
+    padded_width = max(get_padded_size(item[0].shape[2], vit_patch_size) for item in batch)
+
+    padded_batch = []
+    valid_pixels_masks = np.zeros((len(batch), 1, padded_height, padded_width), dtype=np.float32)
+    for i, (image, label) in enumerate(batch):
+        top = (padded_height - image.shape[1]) // 2
+        left = (padded_width - image.shape[2]) // 2
+        pads = ((top, padded_height - image.shape[1] - top), (left, padded_width - image.shape[2] - left))
+
+        padded_image = np.pad(image, ((0, 0),) + pads, mode='constant', constant_values=0)
+        padded_label = dict(label)
+        padded_label['masks'] = [np.pad(mask, pads, mode='constant', constant_values=0) for mask in label['masks']]
+        padded_batch.append((padded_image, padded_label))
+        valid_pixels_masks[i, :, top:top + image.shape[1], left:left + image.shape[2]] = 1
+
+    images, labels = collate_fn_segmentation(padded_batch)
+
+    return images, labels, torch.from_numpy(valid_pixels_masks)
@@ -0,0 +1,139 @@
+from abc import ABC, abstractmethod
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+import torch
+from tqdm import tqdm
+
+from engine.embedder.contrastive.contrastive_infer import infer_batch
+from engine.embedder.contrastive.contrastive_utils import contrastive_infer_collate_fn
+from engine.embedder.dinov2.dinov2 import DINOv2Inference
+from engine.embedder.dinov2.dinov2_dataset import PaddedSizeBucketBatchSampler, collate_fn_segmentation_padded
+
+
+class MultiEmbedderDataset(torch.utils.data.Dataset):
+    """
+    Reads each tile once and fans its pixels out to the preprocessing of every embedder dataset.
+    The datasets must be built on the same COCO file and implement read_tile(idx) and preprocess_tile(idx, tile),
+    like ContrastiveInferDataset and DINOv2SegmentationLabeledRasterCocoDataset, so each embedder keeps its own
+    crop/pad/normalize recipe.
+
+    Parameters:
+    - datasets (Dict[str, torch.utils.data.Dataset]): The dataset of each embedder, by embedder name.
+    """
+    def __init__(self, datasets: Dict[str, torch.utils.data.Dataset]):
+        self.datasets = datasets
+        self.reader_dataset = next(iter(datasets.values()))
+
+        for embedder_name, dataset in datasets.items():
+            if len(dataset) != len(self.reader_dataset) or \
+                    any(dataset.tiles[idx]['path'] != self.reader_dataset.tiles[idx]['path'] for idx in range(len(dataset))):
+                raise ValueError(f"The dataset of the {embedder_name} embedder doesn't have the same tiles as the"
+                                 f" other embedders datasets.")
+
+    def __len__(self):
+        return len(self.reader_dataset)
+
+    def __getitem__(self, idx: int):
+        tile = self.reader_dataset.read_tile(idx)
+        return {embedder_name: dataset.preprocess_tile(idx, tile) for embedder_name, dataset in self.datasets.items()}
+
+    @property
+    def tiles_paths(self) -> List[str]:
+        return [str(self.reader_dataset.tiles[idx]['path']) for idx in range(len(self))]
+
+
+def multi_embedder_collate_fn(batch: List[dict]) -> Dict[str, list]:
+    return {embedder_name: [sample[embedder_name] for sample in batch] for embedder_name in batch[0]}
+
+
+class EmbedderHead(ABC):
+    @abstractmethod
+    def embed(self, samples: list) -> List[np.ndarray]:
+        """
+        Returns the embedding of each sample preprocessed by the embedder dataset.
+        """
+        pass
+
+
+class ContrastiveEmbedderHead(EmbedderHead):
+    def __init__(self, model: torch.nn.Module, device: torch.device, use_mixed_precision: bool = False):
+        self.model = model
+        self.device = device
+        self.use_mixed_precision = use_mixed_precision
+
+    def embed(self, samples: list) -> List[np.ndarray]:
+        images, months, days = contrastive_infer_collate_fn(samples)
+        embeddings, _, _ = infer_batch(images=images, months=months, days=days, model=self.model,
+                                       device=self.device, use_mixed_precision=self.use_mixed_precision)
+        return list(embeddings.detach().cpu().numpy())
+
+
+class DINOv2EmbedderHead(EmbedderHead):
+    """
+    Parameters:
+    - dinov2 (DINOv2Inference): The DINOv2 model.
+    - average_non_masked_patches (bool): Whether to average the patches under the masks, or use the CLS token.
+    - max_batch_pixels (int): The samples of a batch are grouped by padded size in sub-batches of at most
+      max_batch_pixels padded pixels (see PaddedSizeBucketBatchSampler), as they can have different sizes.
+    """
+    def __init__(self, dinov2: DINOv2Inference, average_non_masked_patches: bool, max_batch_pixels: int):
+        self.dinov2 = dinov2
+        self.average_non_masked_patches = average_non_masked_patches
+        self.max_batch_pixels = max_batch_pixels
+
+    def embed(self, samples: list) -> List[np.ndarray]:
+        embeddings = [None] * len(samples)
+        batch_sampler = PaddedSizeBucketBatchSampler(tiles_sizes=[sample[0].shape[1:] for sample in samples],
+                                                     vit_patch_size=self.dinov2.vit_patch_size,
+                                                     max_batch_pixels=self.max_batch_pixels)
+        for samples_ids in batch_sampler:
+            images, labels, valid_pixels_masks = collate_fn_segmentation_padded([samples[i] for i in samples_ids],
+                                                                                vit_patch_size=self.dinov2.vit_patch_size)
+            tiles_embeddings_and_masks = self.dinov2.embed(images, labels,
+                                                           average_non_masked_patches=self.average_non_masked_patches,
+                                                           valid_pixels_masks=valid_pixels_masks)
+            for i, (embedding, _) in zip(samples_ids, tiles_embeddings_and_masks):
+                embeddings[i] = embedding.flatten()
+        return embeddings
+
+
+def multi_embedder_infer(datasets: Dict[str, torch.utils.data.Dataset],
+                         heads: Dict[str, EmbedderHead],
+                         batch_size: int,
+                         num_workers: int = 4) -> Dict[str, pd.DataFrame]:
+    """
+    Embeds the tiles with several embedders in a single pass: the tiles are decoded once by a shared DataLoader
+    (batching and prefetching), and each batch is given to every embedder head.
+
+    Parameters:
+    - datasets (Dict[str, torch.utils.data.Dataset]): The dataset of each embedder, see MultiEmbedderDataset.
+    - heads (Dict[str, EmbedderHead]): The head of each embedder, with the same names as the datasets.
+    - batch_size (int): The number of tiles decoded per batch.
+    - num_workers (int): The number of DataLoader workers decoding the tiles.
+
+    Returns:
+    - A DataFrame with the 'tile_path' and 'embeddings' columns for each embedder, in the datasets order.
+    """
+    if datasets.keys() != heads.keys():
+        raise ValueError(f"Each embedder needs a dataset and a head, got datasets for {list(datasets.keys())}"
+                         f" and heads for {list(heads.keys())}.")
+
+    dataset = MultiEmbedderDataset(datasets)
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,  # the embeddings are returned in the dataset order
+        num_workers=num_workers,
+        collate_fn=multi_embedder_collate_fn
+    )
+
+    embeddings = {embedder_name: [] for embedder_name in heads}
+    for batch in tqdm(loader, desc=f"Inferring {', '.join(heads.keys())}..."):
+        for embedder_name, head in heads.items():
+            embeddings[embedder_name].extend(head.embed(batch[embedder_name]))
+
+    tiles_paths = dataset.tiles_paths
+    return {embedder_name: pd.DataFrame({'tile_path': tiles_paths, 'embeddings': embeddings[embedder_name]})
+            for embedder_name in heads}
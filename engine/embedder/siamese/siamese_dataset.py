@@ -1,6 +1,4 @@
-import itertools
 import random
-import time
 from itertools import combinations
 from pathlib import Path
 from typing import List
@@ -14,15 +12,17 @@ import pandas as pd
 import rasterio
 import torch
 import torch.nn.functional as F
-from _datasketches import kll_floats_sketch
 from geodataset.dataset.base_dataset import BaseLabeledCocoDataset
 from geodataset.utils import rle_segmentation_to_mask, decode_rle_to_polygon
 from matplotlib import pyplot as plt
 from scipy.spatial import distance_matrix
 from tqdm import tqdm
 
+from engine.embedder.siamese.siamese_pair_sampler import SiamesePairSampler
 from engine.embedder.siamese.siamese_utils import normalize_non_black_pixels, FOREST_QPEB_MEAN, FOREST_QPEB_STD, \
-    normalize, scale_values, LimitedSizeHeap
+    normalize, LimitedSizeHeap, StreamingPairSelector
+from engine.embedder.utils import get_categories_distances_matrix
+from engine.utils.distances import iter_pairwise_distances
 
 
 class BaseSiameseLabeledCocoDataset(BaseLabeledCocoDataset):
@@ -102,7 +102,8 @@ class SiameseSamplerDataset:
                  mean: np.array = FOREST_QPEB_MEAN,
                  std: np.array = FOREST_QPEB_STD,
                  min_margin: int = 0.5,
-                 max_margin: int = 2):
+                 max_margin: int = 2,
+                 return_indices: bool = False):
         self.dataset_config = dataset_config
         self.image_size = image_size
         self.transform = transform
@@ -116,25 +117,24 @@ class SiameseSamplerDataset:
         self.std = std
         self.min_margin = min_margin
         self.max_margin = max_margin
+        # the global ids of the two samples are also returned, to update the embedding memory bank
+        self.return_indices = return_indices
 
         self.datasets = dataset_config['datasets']
 
         assert 0 <= consider_percentile <= 100, "consider_percentile should be between 0 and 100."
 
-        if self.taxa_distances_df is not None:
-            self.taxa_distances_df = taxa_distances_df.set_index(['canonicalName1', 'canonicalName2'])
-            # scaling negative pairs distances to [min_margin, max_margin]
-            self.taxa_distances_df.loc[self.taxa_distances_df['dist'] > 0, 'dist'] = scale_values(
-                values=self.taxa_distances_df.loc[self.taxa_distances_df['dist'] > 0, 'dist'],
-                old_min=min(self.taxa_distances_df.loc[self.taxa_distances_df['dist'] > 0, 'dist']),
-                old_max=max(self.taxa_distances_df.loc[self.taxa_distances_df['dist'] > 0, 'dist']),
-                new_min=self.min_margin,
-                new_max=self.max_margin
-            )
-
-        self.categories_names, self.categories_dists = self._get_categories_distances()
+        self.categories_names, self.categories_names_to_idx, self.categories_dists = self._get_categories_distances()
         self.all_samples_labels, self.all_samples_indices, self.samples_indices_per_label = self._get_all_samples()
+        self.all_samples_labels_ids = np.array([self.categories_names_to_idx[label] for label in self.all_samples_labels],
+                                               dtype=np.int64)
         self._remove_not_represented_categories()
+        self.pair_sampler = SiamesePairSampler(
+            samples_indices_per_label=self.samples_indices_per_label,
+            n_positive_pairs=self.n_positive_pairs,
+            n_negative_pairs=self.n_negative_pairs,
+            min_positive_pairs_per_category=self.min_positive_pairs_per_category
+        )
 
         sorted_dict = {k: len(v) for k, v in sorted(self.samples_indices_per_label.items(), key=lambda item: len(item[1]), reverse=True)}
         # Print the sorted dictionary
@@ -176,25 +176,19 @@ class SiameseSamplerDataset:
                     else:
                         raise ValueError(f"Unknown category rank: {category['rank']}.")
 
-        print('Generating categories distances...')
-        categories_dists = {}
-        for category_name_1 in categories_names_to_rank.keys():
-            for category_name_2 in categories_names_to_rank.keys():
-                if category_name_1 == category_name_2:
-                    categories_dists[(category_name_1, category_name_2)] = 0
-                elif category_name_1 == 'Dead' or category_name_2 == 'Dead':
-                    categories_dists[(category_name_1, category_name_2)] = self.DEAD_DISTANCE
-                else:
-                    if self.taxa_distances_df is not None:
-                        categories_dists[(category_name_1, category_name_2)] = self.taxa_distances_df.loc[(category_name_1, category_name_2), 'dist']
-                    else:
-                        categories_dists[(category_name_1, category_name_2)] = 1
+        categories_names = set(categories_names_to_rank.keys())
+        categories_names_to_idx = {k: i for i, k in enumerate(categories_names_to_rank.keys())}
 
+        # categories_dists[label_id1, label_id2], with the label ids of categories_names_to_idx
+        print('Generating categories distances...')
+        categories_dists = get_categories_distances_matrix(categories_names_to_idx=categories_names_to_idx,
+                                                           taxa_distances_df=self.taxa_distances_df,
+                                                           dead_distance=self.DEAD_DISTANCE,
+                                                           min_margin=self.min_margin,
+                                                           max_margin=self.max_margin)
         print('Categories distances successfully generated.')
 
-        categories_names = set(categories_names_to_rank.keys())
-
-        return categories_names, categories_dists
+        return categories_names, categories_names_to_idx, categories_dists
 
     def _get_all_samples(self):
         all_samples_indices = {}
@@ -220,199 +214,106 @@ class SiameseSamplerDataset:
         self.samples_indices_per_label = {k: v for k, v in self.samples_indices_per_label.items() if len(v) != 0}
 
     def find_semi_random_siamese_pairs(self):
-        positive_pairs_indices = {}
-        negative_pairs_indices = {}
-        sorted_n_samples_per_label = {k: len(v) for k, v in
-                                      sorted(self.samples_indices_per_label.items(), key=lambda item: len(item[1]),
-                                             reverse=False)}
-
-        n_positive_pairs_added = 0
-        n_negative_pairs_added = 0
-        n_category_pairs_processed = 0
-        for i, label_name_1 in enumerate(sorted_n_samples_per_label.keys()):
-            for j, label_name_2 in enumerate(sorted_n_samples_per_label.keys()):
-                if j > i:
-                    continue
-                elif j == i:
-                    # Positive pairs
-                    n_positive_sample_pairs_per_category_pair = int(
-                        (self.n_positive_pairs - n_positive_pairs_added) / (len(sorted_n_samples_per_label.keys()) - i))
-                    label_samples = self.samples_indices_per_label[label_name_1]
-                    n_possible_pairs = (len(label_samples) ** 2 - len(label_samples)) / 2
-                    if len(label_samples) == 1:
-                        item = label_samples[0]
-                        pairs = [(item, item)] * self.min_positive_pairs_per_category
-                    elif n_possible_pairs < n_positive_sample_pairs_per_category_pair:
-                        pairs = list(itertools.combinations(label_samples, 2))
-                        if len(pairs) < self.min_positive_pairs_per_category:
-                            pairs += [(item, item) for item in self.samples_indices_per_label[label_name_1]]
-                        if len(pairs) < self.min_positive_pairs_per_category:
-                            pairs = (pairs * ((self.min_positive_pairs_per_category + len(pairs) - 1) // len(pairs)))[:self.min_positive_pairs_per_category]
-                    else:
-                        random_label_samples_set1 = random.sample(
-                            self.samples_indices_per_label[label_name_1],
-                            k=min(len(self.samples_indices_per_label[label_name_1]),
-                                  n_positive_sample_pairs_per_category_pair)
-                        )
-                        random_label_samples_set2 = random.sample(
-                            self.samples_indices_per_label[label_name_1],
-                            k=min(len(self.samples_indices_per_label[label_name_1]),
-                                  n_positive_sample_pairs_per_category_pair)
-                        )
-
-                        # we start by adding as many pairs of distinct samples as possible ([x1,y1], [x2, y2],...) where xi != xj and yi != yj
-                        pairs = [(sample1, sample2) for sample1, sample2 in zip(random_label_samples_set1, random_label_samples_set2)]
-
-                        # we then complete with some xi = xj or yi = yj if necessary
-                        if len(pairs) < n_positive_sample_pairs_per_category_pair:
-                            possible_pairs_iterator = itertools.product(random_label_samples_set1, random_label_samples_set2)
-                            pairs += [next(possible_pairs_iterator) for _ in range(n_positive_sample_pairs_per_category_pair - len(pairs))]
-
-                    positive_pairs_indices[(label_name_1, label_name_1)] = list(pairs)
-                    n_positive_pairs_added += len(pairs)
-                else:
-                    # Negative pairs
-                    n_negative_sample_pairs_per_category_pair = int((self.n_negative_pairs - n_negative_pairs_added) / (
-                            (len(sorted_n_samples_per_label.keys()) ** 2 - len(sorted_n_samples_per_label.keys())) / 2 - n_category_pairs_processed))
-                    n_possible_pairs = len(self.samples_indices_per_label[label_name_1]) * len(self.samples_indices_per_label[label_name_2])
-                    if n_possible_pairs < n_negative_sample_pairs_per_category_pair:
-                        pairs = list(itertools.product(self.samples_indices_per_label[label_name_1],
-                                                       self.samples_indices_per_label[label_name_2]))
-                    else:
-                        # we get a random subset of samples of size n_negative_sample_pairs_per_category_pair for each category/label pair
-                        random_label_1_samples = random.sample(
-                            self.samples_indices_per_label[label_name_1],
-                            k=min(len(self.samples_indices_per_label[label_name_1]),
-                                  n_negative_sample_pairs_per_category_pair)
-                        )
-                        random_label_2_samples = random.sample(
-                            self.samples_indices_per_label[label_name_2],
-                            k=min(len(self.samples_indices_per_label[label_name_2]),
-                                  n_negative_sample_pairs_per_category_pair)
-                        )
-
-                        # we start by adding as many pairs of distinct samples as possible ([x1,y1], [x2, y2],...) where xi != xj and yi != yj
-                        pairs = set([(random_label_1_samples[i], random_label_2_samples[i]) for i in range(min(len(random_label_1_samples), len(random_label_2_samples)))])
-
-                        # we then complete with some xi = xj or yi = yj if necessary
-                        if len(pairs) < n_negative_sample_pairs_per_category_pair:
-                            possible_pairs = set(itertools.product(random_label_1_samples, random_label_2_samples))
-                            possible_pairs = possible_pairs - pairs
-                            pairs.update(random.sample(possible_pairs, k=n_negative_sample_pairs_per_category_pair - len(pairs)))
-
-                        assert len(pairs) == n_negative_sample_pairs_per_category_pair
-
-                    negative_pairs_indices[(label_name_1, label_name_2)] = list(pairs)
-                    n_negative_pairs_added += len(pairs)
-                    n_category_pairs_processed += 1
-
-        # for label_1 in self.categories_names:
-        #     print(label_1, 'POSITIVE', sum([len(v) for x, v in positive_pairs_indices.items() if x[0] == label_1 or x[1] == label_1]))
-        #     print(label_1, 'NEGATIVE', sum([len(v) for x, v in negative_pairs_indices.items() if x[0] == label_1 or x[1] == label_1]))
-        #
-        # print(sum([len(x) for x in positive_pairs_indices.values()]))
-        # print(sum([len(x) for x in negative_pairs_indices.values()]))
-
-        all_pairs = (list(itertools.chain.from_iterable(positive_pairs_indices.values()))
-                     + list(itertools.chain.from_iterable(negative_pairs_indices.values())))
+        positive_pairs, _ = self._get_positive_pairs()
+        negative_pairs, _ = self._get_negative_pairs()
 
-        all_pairs_shuffled = random.sample(all_pairs, len(all_pairs))
+        self.pairs_indices = self._shuffle_pairs(np.concatenate([positive_pairs, negative_pairs]))
 
-        self.pairs_indices = all_pairs_shuffled
-
-        return all_pairs_shuffled
+        return self.pairs_indices
 
     def find_optimal_siamese_pairs(self,
                                    embeddings: torch.Tensor,
                                    compute_device: torch.device,
                                    distance_compute_batch_size: int):
-        positive_pairs_indices = {}
-        negative_pairs_indices = {}
-        sorted_n_samples_per_label = {k: len(v) for k, v in
-                                      sorted(self.samples_indices_per_label.items(), key=lambda item: len(item[1]),
-                                             reverse=False)}
-
-        n_positive_pairs_added = 0
-        n_negative_pairs_added = 0
-        n_category_pairs_processed = 0
-        for i, label_name_1 in tqdm(enumerate(sorted_n_samples_per_label.keys()),
-                                    total=len(sorted_n_samples_per_label.keys()),
-                                    desc='Optimal pairs generation'):
-            for j, label_name_2 in enumerate(sorted_n_samples_per_label.keys()):
-                if j > i:
-                    continue
-                elif j == i:
-                    # Positive pairs
-                    n_positive_sample_pairs_per_category_pair = int((self.n_positive_pairs - n_positive_pairs_added)
-                                                                    / (len(sorted_n_samples_per_label.keys()) - i))
-                    label_samples_ids = self.samples_indices_per_label[label_name_1]
-                    n_possible_pairs = (len(label_samples_ids) ** 2 - len(label_samples_ids)) / 2
-
-                    if len(label_samples_ids) == 1:
-                        item = label_samples_ids[0]
-                        pairs = [(item, item)] * self.min_positive_pairs_per_category
-                    elif n_possible_pairs < n_positive_sample_pairs_per_category_pair:
-                        pairs = list(itertools.combinations(label_samples_ids, 2))
-                        if len(pairs) < self.min_positive_pairs_per_category:
-                            pairs += [(item, item) for item in self.samples_indices_per_label[label_name_1]]
-                        if len(pairs) < self.min_positive_pairs_per_category:
-                            pairs = (pairs * ((self.min_positive_pairs_per_category + len(pairs) - 1) // len(pairs)))[:self.min_positive_pairs_per_category]
-                    else:
-                        embeddings_label = embeddings[label_samples_ids]
-                        best_pairs_indices = self._get_best_samples(
-                            embeddings1=embeddings_label,
-                            embeddings2=embeddings_label,
-                            distance_compute_batch_size=distance_compute_batch_size,
-                            compute_device=compute_device,
-                            keep_n=n_positive_sample_pairs_per_category_pair,
-                            metric='farthest'
-                        )
-                        pairs = [(label_samples_ids[i1], label_samples_ids[i2]) for i1, i2 in best_pairs_indices]
-
-                    positive_pairs_indices[(label_name_1, label_name_1)] = list(pairs)
-                    n_positive_pairs_added += len(pairs)
-                else:
-                    n_negative_sample_pairs_per_category_pair = int((self.n_negative_pairs - n_negative_pairs_added) / (
-                            (len(sorted_n_samples_per_label.keys()) ** 2 - len(
-                                sorted_n_samples_per_label.keys())) / 2 - n_category_pairs_processed))
-                    label1_samples_ids = self.samples_indices_per_label[label_name_1]
-                    label2_samples_ids = self.samples_indices_per_label[label_name_2]
-                    n_possible_pairs = len(label1_samples_ids) * len(label2_samples_ids)
-                    if n_possible_pairs < n_negative_sample_pairs_per_category_pair:
-                        pairs = list(itertools.product(label1_samples_ids, label2_samples_ids))
-                    else:
-                        embeddings_label1 = embeddings[label1_samples_ids]
-                        embeddings_label2 = embeddings[label2_samples_ids]
-                        best_pairs_indices = self._get_best_samples(
-                            embeddings1=embeddings_label1,
-                            embeddings2=embeddings_label2,
-                            distance_compute_batch_size=distance_compute_batch_size,
-                            compute_device=compute_device,
-                            keep_n=n_negative_sample_pairs_per_category_pair,
-                            metric='closest'
-                        )
-                        pairs = [(label1_samples_ids[i1], label2_samples_ids[i2]) for (i1, i2) in best_pairs_indices]
-
-                    negative_pairs_indices[(label_name_1, label_name_2)] = list(pairs)
-                    n_negative_pairs_added += len(pairs)
-                    n_category_pairs_processed += 1
-
-        all_pairs = (list(itertools.chain.from_iterable(positive_pairs_indices.values()))
-                     + list(itertools.chain.from_iterable(negative_pairs_indices.values())))
+        def get_positive_best_pairs(label_samples_ids: np.ndarray, keep_n: int):
+            embeddings_label = embeddings[label_samples_ids]
+            best_pairs_indices = self._get_best_samples(
+                embeddings1=embeddings_label,
+                embeddings2=embeddings_label,
+                distance_compute_batch_size=distance_compute_batch_size,
+                compute_device=compute_device,
+                keep_n=keep_n,
+                metric='farthest'
+            )
+            return np.array([(label_samples_ids[i1], label_samples_ids[i2]) for i1, i2 in best_pairs_indices])
+
+        def get_negative_best_pairs(label1_samples_ids: np.ndarray, label2_samples_ids: np.ndarray, keep_n: int):
+            best_pairs_indices = self._get_best_samples(
+                embeddings1=embeddings[label1_samples_ids],
+                embeddings2=embeddings[label2_samples_ids],
+                distance_compute_batch_size=distance_compute_batch_size,
+                compute_device=compute_device,
+                keep_n=keep_n,
+                metric='closest'
+            )
+            return np.array([(label1_samples_ids[i1], label2_samples_ids[i2]) for (i1, i2) in best_pairs_indices])
 
-        all_pairs_shuffled = random.sample(all_pairs, len(all_pairs))
+        positive_pairs, positive_labels = self._get_positive_pairs(get_positive_best_pairs)
+        negative_pairs, negative_category_pairs = self._get_negative_pairs(get_negative_best_pairs)
 
-        for label_1 in self.categories_names:
-            print(label_1, 'POSITIVE', sum([len(v) for x, v in positive_pairs_indices.items() if x[0] == label_1 or x[1] == label_1]))
-            print(label_1, 'NEGATIVE', sum([len(v) for x, v in negative_pairs_indices.items() if x[0] == label_1 or x[1] == label_1]))
+        sampler = self.pair_sampler
+        n_positive_per_label = np.bincount(positive_labels, minlength=len(sampler.labels))
+        n_negative_per_label = (np.bincount(sampler.negative_labels1[negative_category_pairs], minlength=len(sampler.labels))
+                                + np.bincount(sampler.negative_labels2[negative_category_pairs], minlength=len(sampler.labels)))
+        for label_index, label_1 in enumerate(sampler.labels):
+            print(label_1, 'POSITIVE', n_positive_per_label[label_index])
+            print(label_1, 'NEGATIVE', n_negative_per_label[label_index])
 
-        print("Total positive pairs generated:", sum([len(x) for x in positive_pairs_indices.values()]))
-        print("Total negative pairs generated:", sum([len(x) for x in negative_pairs_indices.values()]))
+        print("Total positive pairs generated:", len(positive_pairs))
+        print("Total negative pairs generated:", len(negative_pairs))
 
-        self.pairs_indices = all_pairs_shuffled
+        self.pairs_indices = self._shuffle_pairs(np.concatenate([positive_pairs, negative_pairs]))
 
         return self.pairs_indices
 
+    def _get_positive_pairs(self, get_best_pairs=None):
+        """
+        Returns the (K, 2) positive pairs of all the categories and the index of their category in
+        self.pair_sampler.labels. The categories which do not get all their possible pairs get random pairs, or the
+        pairs returned by get_best_pairs(label_samples_ids, keep_n) if given.
+        """
+        sampler = self.pair_sampler
+        enumerated_pairs, enumerated_labels = sampler.get_enumerated_positive_pairs()
+        if get_best_pairs is None:
+            pairs, labels = sampler.sample_positive_pairs()
+            return np.concatenate([enumerated_pairs, pairs]), np.concatenate([enumerated_labels, labels])
+
+        all_pairs, all_labels = [enumerated_pairs], [enumerated_labels]
+        for label_index in tqdm(np.flatnonzero(~sampler.positive_enumerated & (sampler.positive_counts > 0)),
+                                desc='Optimal positive pairs generation'):
+            pairs = get_best_pairs(sampler.get_label_samples(label_index), int(sampler.positive_counts[label_index]))
+            all_pairs.append(pairs.reshape(-1, 2))
+            all_labels.append(np.full(len(pairs), label_index))
+
+        return np.concatenate(all_pairs), np.concatenate(all_labels)
+
+    def _get_negative_pairs(self, get_best_pairs=None):
+        """
+        Returns the (K, 2) negative pairs of all the category pairs and the index of their category pair in
+        self.pair_sampler.negative_labels1/2. The category pairs which do not get all their possible pairs get random
+        pairs, or the pairs returned by get_best_pairs(label1_samples_ids, label2_samples_ids, keep_n) if given.
+        """
+        sampler = self.pair_sampler
+        enumerated_pairs, enumerated_category_pairs = sampler.get_enumerated_negative_pairs()
+        if get_best_pairs is None:
+            pairs, category_pairs = sampler.sample_negative_pairs()
+            return (np.concatenate([enumerated_pairs, pairs]),
+                    np.concatenate([enumerated_category_pairs, category_pairs]))
+
+        all_pairs, all_category_pairs = [enumerated_pairs], [enumerated_category_pairs]
+        for category_pair in tqdm(np.flatnonzero(~sampler.negative_enumerated & (sampler.negative_counts > 0)),
+                                  desc='Optimal negative pairs generation'):
+            pairs = get_best_pairs(sampler.get_label_samples(sampler.negative_labels1[category_pair]),
+                                   sampler.get_label_samples(sampler.negative_labels2[category_pair]),
+                                   int(sampler.negative_counts[category_pair]))
+            all_pairs.append(pairs.reshape(-1, 2))
+            all_category_pairs.append(np.full(len(pairs), category_pair))
+
+        return np.concatenate(all_pairs), np.concatenate(all_category_pairs)
+
+    def _shuffle_pairs(self, pairs: np.ndarray):
+        return pairs[self.pair_sampler.rng.permutation(len(pairs))]
+
     def _get_best_samples(self,
                           embeddings1: torch.Tensor,
                           embeddings2: torch.Tensor,
@@ -426,69 +327,27 @@ class SiameseSamplerDataset:
         embeddings1 = embeddings1.to(compute_device)
         embeddings2 = embeddings2.to(compute_device)
 
-        n = embeddings1.shape[0]
-        if distance_compute_batch_size < n:
-            raise ValueError("distance_compute_batch_size should be greater than the number of samples.")
-
-        batch_size = distance_compute_batch_size // n
-        values_for_percentile = np.array([])
-        # First loop to calculate the 80th percentile threshold
-        for i in range(0, n, batch_size):
-            end_index = min(i + batch_size, n)
-            batch_embeddings1 = embeddings1[i:end_index]
-            distances = torch.cdist(batch_embeddings1, embeddings2, p=2)
-            distances_flat = distances.view(-1)
-
-            # Update the kll with the new batch of distances. If too many items, randomly sample 1M items
-            keep_per_batch = 1000000
-            if len(distances_flat) > keep_per_batch:
-                distances_flat = distances_flat[torch.randperm(distances_flat.numel())[:keep_per_batch]]
-            values_for_percentile = np.concatenate((values_for_percentile, distances_flat.cpu().numpy()))
-
         total_distances = embeddings1.shape[0] * embeddings2.shape[0]
-        # Get the estimated 80th percentile value
+        # Get the percentile of the distances to consider
         if metric == 'closest':
             if ((self.consider_percentile / 100) * total_distances) < keep_n:
-                threshold_value = np.percentile(values_for_percentile, 100 * (keep_n / total_distances))
+                percentile = min(100., 100 * (keep_n / total_distances))
             else:
-                threshold_value = np.percentile(values_for_percentile, self.consider_percentile)
+                percentile = self.consider_percentile
         else:
             if ((self.consider_percentile / 100) * total_distances) < keep_n:
-                threshold_value = np.percentile(values_for_percentile, 100 * (1 - keep_n / total_distances))
+                percentile = max(0., 100 * (1 - keep_n / total_distances))
             else:
-                threshold_value = np.percentile(values_for_percentile, 100 - self.consider_percentile)
-
-        indices = []
-        values_sum = 0
-        all_distances_sum = 0
-        for i in range(0, n, batch_size):
-            end_index = min(i + batch_size, n)
-            batch_embeddings1 = embeddings1[i:end_index]
-            # Compute distances between the current batch and all embeddings
-            distances = torch.cdist(batch_embeddings1, embeddings2, p=2)
-            this_batch_size_ratio = distances.numel() / total_distances
-            random.seed(time.time())
-            if metric == 'closest':
-                distances_under_threshold = distances < threshold_value
-                indices_under_threshold = torch.nonzero(distances_under_threshold, as_tuple=False)
-                # randomly select this_batch_size_ratio * keep_n closest distances
-                k = min(len(indices_under_threshold), int(this_batch_size_ratio * keep_n), 1)
-                random_indices = torch.randperm(len(indices_under_threshold))[:k]
-                indices_under_threshold_random_selection = indices_under_threshold[random_indices].tolist()
-                indices.extend([(i + idx1, idx2) for (idx1, idx2) in indices_under_threshold_random_selection])
-                for idx in indices_under_threshold_random_selection:
-                    values_sum += distances[idx[0], idx[1]]
-            else:
-                distances_over_threshold = distances > threshold_value
-                indices_over_threshold = torch.nonzero(distances_over_threshold, as_tuple=False)
-                # randomly select this_batch_size_ratio * keep_n farthest distances
-                k = min(len(indices_over_threshold), int(this_batch_size_ratio * keep_n), 1)
-                random_indices = torch.randperm(len(indices_over_threshold))[:k]
-                indices_over_threshold_random_selection = indices_over_threshold[random_indices].tolist()
-                indices.extend([(i + idx1, idx2) for (idx1, idx2) in indices_over_threshold_random_selection])
-                for idx in indices_over_threshold_random_selection:
-                    values_sum += distances[idx[0], idx[1]]
-            all_distances_sum += torch.sum(distances)
+                percentile = 100 - self.consider_percentile
+
+        # Single pass: the threshold is estimated with a KLL sketch while the candidate pairs are kept in a reservoir
+        selector = StreamingPairSelector(percentile=percentile, metric=metric, keep_n=keep_n,
+                                         n_pairs=total_distances)
+        for i, distances in iter_pairwise_distances(embeddings1, embeddings2, metric='euclidean',
+                                                    device=compute_device,
+                                                    max_block_elements=distance_compute_batch_size):
+            selector.update(i, distances)
+        indices = selector.get_pairs()
 
         # there is a bug where for large embeddings, no indices are found?
         if len(indices) == 0:
@@ -500,10 +359,6 @@ class SiameseSamplerDataset:
         # shuffle indices
         random.shuffle(indices)
         indices = (indices * (keep_n // len(indices) + 1))[:keep_n] if len(indices) < keep_n else indices[:keep_n]
-        # if metric == 'closest':
-        #     print('NEGATIVE:', values_sum / len(indices), 'DISTANCE MEAN:', all_distances_sum / total_distances, len(indices), keep_n)
-        # else:
-        #     print('POSITIVE:', values_sum / len(indices), 'DISTANCE MEAN:', all_distances_sum / total_distances, len(indices), keep_n)
         return indices
 
     def __len__(self):
@@ -516,7 +371,8 @@ class SiameseSamplerDataset:
         label_1 = self.all_samples_labels[global_idx_1]
         label_2 = self.all_samples_labels[global_idx_2]
         label = int(label_1 == label_2)
-        margin = self.categories_dists[(label_1, label_2)]
+        margin = self.categories_dists[self.all_samples_labels_ids[global_idx_1],
+                                       self.all_samples_labels_ids[global_idx_2]]
         tile_1 = self.datasets[dataset_1_key][dataset_idx_1]
         tile_2 = self.datasets[dataset_2_key][dataset_idx_2]
         month1, month2 = tile_1['month'], tile_2['month']
@@ -600,6 +456,9 @@ class SiameseSamplerDataset:
             data_1 = normalize(data_1, self.mean, self.std)
             data_2 = normalize(data_2, self.mean, self.std)
 
+        if self.return_indices:
+            return data_1, data_2, month1, month2, day1, day2, label, margin, global_idx_1, global_idx_2
+
         return data_1, data_2, month1, month2, day1, day2, label, margin
 
 
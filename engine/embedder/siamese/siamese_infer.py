@@ -10,6 +10,7 @@ import pandas as pd
 from engine.embedder.siamese.siamese_model import SiameseNetwork
 from engine.embedder.siamese.siamese_train_old import infer_model
 from engine.embedder.siamese.siamese_utils import valid_collate_fn
+from engine.utils.model_registry import load_weights
 from geodataset.dataset.polygon_dataset import SiameseValidationDataset
 
 
@@ -27,9 +28,10 @@ def siamese_infer(siamese_dataset: SiameseValidationDataset,
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-    model = SiameseNetwork(resnet_model=backbone_model_resnet_name, final_embedding_size=final_embedding_size)
+    model = SiameseNetwork(resnet_model=backbone_model_resnet_name, final_embedding_size=final_embedding_size,
+                           pretrained=False)
     print(f'Loading model from {siamese_checkpoint}')
-    weights = torch.load(siamese_checkpoint)
+    weights = load_weights(siamese_checkpoint)
     model.load_state_dict(weights)
     model.to(device)
     model.eval()
@@ -2,22 +2,16 @@ import math
 
 import torch
 import torch.nn as nn
-from torchvision import models
 import torch.nn.functional as F
 
+from engine.utils.model_registry import get_resnet_backbone
+
 
 class SiameseNetwork(nn.Module):
-    def __init__(self, resnet_model: str, final_embedding_size: int):
+    def __init__(self, resnet_model: str, final_embedding_size: int, pretrained: bool = True):
         super(SiameseNetwork, self).__init__()
-        # Load a ResNet50 model pre-trained on ImageNet
-        if resnet_model == 'resnet50':
-            self.backbone = models.resnet50(weights=models.ResNet50_Weights.DEFAULT)
-        elif resnet_model == 'resnet101':
-            self.backbone = models.resnet101(weights=models.ResNet101_Weights.DEFAULT)
-        elif resnet_model == 'resnet152':
-            self.backbone = models.resnet152(weights=models.ResNet152_Weights.DEFAULT)
-        else:
-            raise ValueError(f'Invalid resnet model: {resnet_model}')
+        # Load a ResNet model pre-trained on ImageNet, unless a checkpoint will be loaded afterwards
+        self.backbone = get_resnet_backbone(resnet_model, pretrained=pretrained)
 
         self.final_embedding_size = final_embedding_size
 
@@ -52,17 +46,11 @@ class SiameseNetwork2(nn.Module):
     def __init__(self,
                  resnet_model: str,
                  final_embedding_size: int,
-                 dropout: float):
+                 dropout: float,
+                 pretrained: bool = True):
         super(SiameseNetwork2, self).__init__()
-        # Load a ResNet50 model pre-trained on ImageNet
-        if resnet_model == 'resnet50':
-            self.backbone = models.resnet50(weights=models.ResNet50_Weights.DEFAULT)
-        elif resnet_model == 'resnet101':
-            self.backbone = models.resnet101(weights=models.ResNet101_Weights.DEFAULT)
-        elif resnet_model == 'resnet152':
-            self.backbone = models.resnet152(weights=models.ResNet152_Weights.DEFAULT)
-        else:
-            raise ValueError(f'Invalid resnet model: {resnet_model}')
+        # Load a ResNet model pre-trained on ImageNet, unless a checkpoint will be loaded afterwards
+        self.backbone = get_resnet_backbone(resnet_model, pretrained=pretrained)
 
         self.final_embedding_size = final_embedding_size
 
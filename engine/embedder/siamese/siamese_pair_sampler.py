@@ -0,0 +1,228 @@
+import numpy as np
+
+
+def _triangle_pair(flat_indices: np.ndarray, n: np.ndarray):
+    """
+    Maps flat indices in [0, n * (n - 1) / 2) to the (i, j), i < j, pairs of the upper triangle of an n x n matrix,
+    enumerated row by row like itertools.combinations(range(n), 2).
+    """
+    flat_indices = flat_indices.astype(np.int64)
+    n = n.astype(np.int64)
+    n_pairs = n * (n - 1) // 2
+    i = n - 2 - np.floor(np.sqrt(np.maximum(4 * n * (n - 1) - 8 * flat_indices - 7, 0)) / 2 - 0.5).astype(np.int64)
+    # the square root can be off by one for large n
+    row_start = n_pairs - (n - i) * (n - i - 1) // 2
+    i = np.where(flat_indices < row_start, i - 1, i)
+    row_start = n_pairs - (n - i) * (n - i - 1) // 2
+    next_row_start = n_pairs - (n - i - 1) * (n - i - 2) // 2
+    i = np.where(flat_indices >= next_row_start, i + 1, i)
+    row_start = n_pairs - (n - i) * (n - i - 1) // 2
+    j = flat_indices - row_start + i + 1
+    return i, j
+
+
+def _expand_groups(counts: np.ndarray):
+    """
+    Returns, for groups of the given sizes, the group of each element and its position in its group.
+    """
+    counts = counts.astype(np.int64)
+    groups = np.repeat(np.arange(len(counts)), counts)
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return groups, positions
+
+
+def sample_distinct_flat_indices(sizes: np.ndarray, counts: np.ndarray, rng: np.random.Generator,
+                                 dense_factor: int = 4):
+    """
+    Draws, for all groups at once, counts[g] distinct random indices in [0, sizes[g]).
+    The groups with fewer than dense_factor * counts[g] indices are enumerated and the counts[g] indices with the
+    smallest random keys are kept. The others draw counts[g] indices with replacement, and the duplicates are drawn
+    again until there are none, which takes very few rounds as they are sparse.
+
+    Returns:
+    - The group of each index and the indices, sorted by group.
+    """
+    sizes = sizes.astype(np.int64)
+    counts = np.minimum(counts.astype(np.int64), sizes)
+    dense = sizes < dense_factor * counts
+
+    # dense groups: enumerate, shuffle with random keys, keep the first counts[g] of each group
+    dense_groups = np.flatnonzero(dense)
+    groups, indices = _expand_groups(sizes[dense_groups])
+    groups = dense_groups[groups]
+    order = np.lexsort((rng.random(len(groups)), groups))
+    groups, indices = groups[order], indices[order]
+    _, rank = _expand_groups(sizes[dense_groups])
+    kept = rank < counts[groups]
+    all_groups, all_indices = [groups[kept]], [indices[kept]]
+
+    # sparse groups: draw with replacement and draw the duplicates again
+    sparse_groups = np.flatnonzero(~dense & (counts > 0))
+    groups, _ = _expand_groups(counts[sparse_groups])
+    groups = sparse_groups[groups]
+    indices = rng.integers(0, sizes[groups])
+    # sorting a single (group, index) key is much faster than a lexsort, when it fits in an int64
+    key_stride = int(sizes.max()) if len(sizes) else 1
+    use_single_key = len(sizes) * key_stride < 2 ** 62
+    while True:
+        order = np.argsort(groups * key_stride + indices) if use_single_key else np.lexsort((indices, groups))
+        groups, indices = groups[order], indices[order]
+        duplicates = np.zeros(len(groups), dtype=bool)
+        duplicates[1:] = (groups[1:] == groups[:-1]) & (indices[1:] == indices[:-1])
+        if not duplicates.any():
+            break
+        indices[duplicates] = rng.integers(0, sizes[groups[duplicates]])
+    all_groups.append(groups)
+    all_indices.append(indices)
+
+    groups, indices = np.concatenate(all_groups), np.concatenate(all_indices)
+    order = np.argsort(groups, kind='stable')
+    return groups[order], indices[order]
+
+
+class SiamesePairSampler:
+    """
+    Draws the positive and negative siamese pairs of all the category pairs at once with NumPy, from CSR-style
+    arrays of the samples of each category (the samples of category c are samples[offsets[c]:offsets[c + 1]]).
+
+    The categories are processed from the smallest to the largest, and each category (positive pairs) or category
+    pair (negative pairs) gets an equal share of the pairs left, so the pairs a small category cannot provide go to
+    the next ones:
+    - A category with a single sample, or with fewer possible pairs than its share, gets all its pairs of distinct
+        samples, completed with its (sample, sample) pairs and repeated up to min_positive_pairs_per_category.
+    - A category pair with fewer possible pairs than its share gets all of them.
+    - Otherwise, the category (pair) gets its share of distinct random pairs, which can be drawn by the caller
+        instead, e.g. from the embeddings distances.
+
+    Parameters:
+    - samples_indices_per_label (dict): The global sample ids of each category.
+    - n_positive_pairs (int): The number of positive pairs to draw.
+    - n_negative_pairs (int): The number of negative pairs to draw.
+    - min_positive_pairs_per_category (int): The minimum number of positive pairs of each category.
+    - seed (int or None): The seed of the random generator.
+    """
+    def __init__(self,
+                 samples_indices_per_label: dict,
+                 n_positive_pairs: int,
+                 n_negative_pairs: int,
+                 min_positive_pairs_per_category: int,
+                 seed: int = None):
+        self.n_positive_pairs = n_positive_pairs
+        self.n_negative_pairs = n_negative_pairs
+        self.min_positive_pairs_per_category = min_positive_pairs_per_category
+        self.rng = np.random.default_rng(seed)
+
+        self.labels = sorted(samples_indices_per_label.keys(), key=lambda label: len(samples_indices_per_label[label]))
+        self.sizes = np.array([len(samples_indices_per_label[label]) for label in self.labels], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)])
+        self.samples = np.concatenate([np.asarray(samples_indices_per_label[label], dtype=np.int64)
+                                       for label in self.labels]) if self.labels else np.zeros(0, dtype=np.int64)
+
+        # the negative category pairs (i, j), j < i, in the order they are processed
+        self.negative_labels1, self.negative_labels2 = np.tril_indices(len(self.labels), k=-1)
+
+        self.positive_counts, self.positive_enumerated = self._get_positive_quotas()
+        self.negative_counts, self.negative_enumerated = self._get_negative_quotas()
+
+    def _get_positive_quotas(self):
+        n_combinations = self.sizes * (self.sizes - 1) // 2
+        counts = np.zeros(len(self.labels), dtype=np.int64)
+        enumerated = np.zeros(len(self.labels), dtype=bool)
+        n_added = 0
+        for i in range(len(self.labels)):
+            quota = max(0, int((self.n_positive_pairs - n_added) / (len(self.labels) - i)))
+            if self.sizes[i] == 1 or n_combinations[i] < quota:
+                enumerated[i] = True
+                if n_combinations[i] < self.min_positive_pairs_per_category:
+                    counts[i] = max(n_combinations[i] + self.sizes[i], self.min_positive_pairs_per_category)
+                else:
+                    counts[i] = n_combinations[i]
+            else:
+                counts[i] = quota
+            n_added += counts[i]
+
+        return counts, enumerated
+
+    def _get_negative_quotas(self):
+        n_possible_pairs = self.sizes[self.negative_labels1] * self.sizes[self.negative_labels2]
+        n_category_pairs = len(n_possible_pairs)
+        counts = np.zeros(n_category_pairs, dtype=np.int64)
+        enumerated = np.zeros(n_category_pairs, dtype=bool)
+        n_added = 0
+        for k in range(n_category_pairs):
+            quota = max(0, int((self.n_negative_pairs - n_added) / (n_category_pairs - k)))
+            if n_possible_pairs[k] < quota:
+                enumerated[k] = True
+                counts[k] = n_possible_pairs[k]
+            else:
+                counts[k] = quota
+            n_added += counts[k]
+
+        return counts, enumerated
+
+    def _positive_local_pairs(self, labels: np.ndarray, flat_indices: np.ndarray):
+        # flat indices over the pairs of distinct samples, followed by the (sample, sample) pairs
+        n = self.sizes[labels]
+        n_combinations = n * (n - 1) // 2
+        is_combination = flat_indices < n_combinations
+        i, j = _triangle_pair(np.where(is_combination, flat_indices, 0), np.maximum(n, 2))
+        self_index = flat_indices - n_combinations
+        return np.where(is_combination, i, self_index), np.where(is_combination, j, self_index)
+
+    def _to_global_pairs(self, labels1: np.ndarray, local1: np.ndarray, labels2: np.ndarray, local2: np.ndarray):
+        return np.stack([self.samples[self.offsets[labels1] + local1],
+                         self.samples[self.offsets[labels2] + local2]], axis=1)
+
+    def get_enumerated_positive_pairs(self):
+        """
+        Returns the (K, 2) positive pairs of the categories which get all their possible pairs, and their category.
+        """
+        labels = np.flatnonzero(self.positive_enumerated)
+        n = self.sizes[labels]
+        n_combinations = n * (n - 1) // 2
+        # the (sample, sample) pairs are only added if there are not enough pairs of distinct samples
+        n_available = np.where(n_combinations < self.min_positive_pairs_per_category, n_combinations + n, n_combinations)
+        groups, positions = _expand_groups(self.positive_counts[labels])
+        labels = labels[groups]
+        local1, local2 = self._positive_local_pairs(labels, positions % n_available[groups])
+        return self._to_global_pairs(labels, local1, labels, local2), labels
+
+    def sample_positive_pairs(self):
+        """
+        Returns the (K, 2) random positive pairs of the other categories, and their category.
+        """
+        labels = np.flatnonzero(~self.positive_enumerated)
+        n = self.sizes[labels]
+        groups, flat_indices = sample_distinct_flat_indices(n * (n - 1) // 2, self.positive_counts[labels], self.rng)
+        labels = labels[groups]
+        local1, local2 = self._positive_local_pairs(labels, flat_indices)
+        return self._to_global_pairs(labels, local1, labels, local2), labels
+
+    def get_enumerated_negative_pairs(self):
+        """
+        Returns the (K, 2) negative pairs of the category pairs which get all their possible pairs, and the index of
+        their category pair.
+        """
+        category_pairs = np.flatnonzero(self.negative_enumerated)
+        groups, flat_indices = _expand_groups(self.negative_counts[category_pairs])
+        return self._negative_pairs(category_pairs[groups], flat_indices)
+
+    def sample_negative_pairs(self):
+        """
+        Returns the (K, 2) random negative pairs of the other category pairs, and the index of their category pair.
+        """
+        category_pairs = np.flatnonzero(~self.negative_enumerated)
+        labels1 = self.negative_labels1[category_pairs]
+        labels2 = self.negative_labels2[category_pairs]
+        groups, flat_indices = sample_distinct_flat_indices(self.sizes[labels1] * self.sizes[labels2],
+                                                            self.negative_counts[category_pairs], self.rng)
+        return self._negative_pairs(category_pairs[groups], flat_indices)
+
+    def _negative_pairs(self, category_pairs: np.ndarray, flat_indices: np.ndarray):
+        labels1 = self.negative_labels1[category_pairs]
+        labels2 = self.negative_labels2[category_pairs]
+        n2 = self.sizes[labels2]
+        return self._to_global_pairs(labels1, flat_indices // n2, labels2, flat_indices % n2), category_pairs
+
+    def get_label_samples(self, label_index: int) -> np.ndarray:
+        return self.samples[self.offsets[label_index]:self.offsets[label_index + 1]]
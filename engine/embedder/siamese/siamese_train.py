@@ -13,7 +13,7 @@ from sklearn.metrics import accuracy_score, precision_recall_fscore_support
 from sklearn.preprocessing import StandardScaler
 from sklearn.svm import SVC
 from tensorboardX import SummaryWriter
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 import albumentations as A
 print('First imports done')
@@ -25,6 +25,8 @@ from engine.embedder.siamese.siamese_model import ContrastiveLoss, SiameseNetwor
 from engine.embedder.siamese.siamese_utils import train_collate_fn2, valid_collate_fn2, FOREST_QPEB_MEAN, \
     FOREST_QPEB_STD, valid_collate_fn_string_labels
 from engine.embedder.transforms import embedder_transforms
+from engine.utils.memory_bank import EmbeddingMemoryBank
+from engine.utils.model_registry import load_weights
 
 print('Other imports done')
 
@@ -89,7 +91,8 @@ def train(model: SiameseNetwork2,
           output_dir: Path,
           save_every_n_updates: int,
           num_epochs: int,
-          data_loader_num_workers: int):
+          data_loader_num_workers: int,
+          memory_bank: EmbeddingMemoryBank = None):
 
     if use_multi_gpu and torch.cuda.device_count() > 1:
         model = nn.DataParallel(model)
@@ -109,7 +112,7 @@ def train(model: SiameseNetwork2,
         accumulated_steps = 0
 
         for data in tqdm(data_loader, desc=f'Epoch {epoch}...'):
-            imgs1, imgs2, months1, months2, days1, days2, labels, margins = data
+            imgs1, imgs2, months1, months2, days1, days2, labels, margins = data[:8]
             imgs1, imgs2, labels, margins = imgs1.to(device), imgs2.to(device), labels.to(device), margins.to(device)
             months1, months2, days1, days2 = months1.to(device), months2.to(device), days1.to(device), days2.to(device)
 
@@ -119,6 +122,12 @@ def train(model: SiameseNetwork2,
                 output1, output2 = model(imgs1, imgs2, months1, months2, days1, days2)
                 loss = criterion(output1, output2, labels, margins)
 
+            if memory_bank is not None:
+                # the embeddings of the training samples are kept up to date, so the pairs can be re-mined without
+                # re-inferring the whole dataset at the end of the epoch
+                memory_bank.update(data[8], output1)
+                memory_bank.update(data[9], output2)
+
             scaler.scale(loss).backward()  # Backward pass with scaled loss
 
             total_loss += loss.item()
@@ -187,7 +196,8 @@ def train(model: SiameseNetwork2,
             model=model,
             dataset=train_dataset,
             data_loader_num_workers=data_loader_num_workers,
-            use_multi_gpu=use_multi_gpu
+            use_multi_gpu=use_multi_gpu,
+            memory_bank=memory_bank
         )
         model.train()
 
@@ -197,12 +207,42 @@ def train(model: SiameseNetwork2,
         save_model(model, checkpoint_output_file=checkpoint_output_file, use_multi_gpu=use_multi_gpu)
 
 
-def find_optimal_pairs(model, dataset, data_loader_num_workers, use_multi_gpu):
+def find_optimal_pairs(model, dataset, data_loader_num_workers, use_multi_gpu, memory_bank=None):
+    """
+    Infers all the samples of the dataset and finds the hardest pairs for the next epoch. If a memory bank is given,
+    only the samples which are not in the bank yet (they were not part of any pair) are inferred, the embeddings of
+    the others are the ones of the bank.
+    """
     with torch.no_grad():
         single_item_dataset = SingleItemsSiameseSamplerDatasetWrapper(
             siamese_sampler_dataset=dataset
         )
 
+        if memory_bank is not None:
+            missing_indices = memory_bank.get_missing_indices()
+            print(f'Inferring the {len(missing_indices)} samples missing from the memory bank'
+                  f' out of {len(memory_bank)}...')
+            if len(missing_indices) > 0:
+                data_loader = DataLoader(
+                    Subset(single_item_dataset, missing_indices.tolist()),
+                    batch_size=valid_batch_size,
+                    shuffle=False,
+                    collate_fn=valid_collate_fn_string_labels,
+                    num_workers=data_loader_num_workers,
+                )
+                _, missing_embeddings = infer_model(model, data_loader, device, use_mixed_precision=True,
+                                                    use_multi_gpu=use_multi_gpu,
+                                                    desc='Inferring missing samples to find optimal pairs...')
+                memory_bank.update(missing_indices, torch.from_numpy(missing_embeddings))
+
+            dataset.find_optimal_siamese_pairs(
+                embeddings=memory_bank.embeddings,
+                compute_device=device,
+                distance_compute_batch_size=100000000
+            )
+
+            return dataset
+
         data_loader = DataLoader(
             single_item_dataset,
             batch_size=valid_batch_size,
@@ -344,6 +384,8 @@ if __name__ == '__main__':
     data_loader_num_workers = yaml_config['data_loader_num_workers']
     phylogenetic_tree_distances_path = yaml_config['phylogenetic_tree_distances_path']
     output_folder_root = Path(yaml_config['output_folder_root'])
+    # the pairs are re-mined from a memory bank of the training embeddings instead of a full re-inference, if given
+    memory_bank_momentum = yaml_config.get('memory_bank_momentum', None)
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     output_model_name = f'siamese_{resnet_model}_{image_size}_{final_embedding_size}_{train_batch_size * n_grad_accumulation_steps}_mpt'
@@ -432,7 +474,8 @@ if __name__ == '__main__':
         normalize=True,
         mean=FOREST_QPEB_MEAN,
         std=FOREST_QPEB_STD,
-        taxa_distances_df=pd.read_csv(phylogenetic_tree_distances_path)
+        taxa_distances_df=pd.read_csv(phylogenetic_tree_distances_path),
+        return_indices=memory_bank_momentum is not None
     )
 
     siamese_sampler_dataset_valid = SiameseSamplerDataset(
@@ -470,12 +513,24 @@ if __name__ == '__main__':
     model = SiameseNetwork2(
         resnet_model=resnet_model,
         final_embedding_size=final_embedding_size,
-        dropout=dropout
+        dropout=dropout,
+        pretrained=not start_from_checkpoint
     ).to(device)
 
     if start_from_checkpoint:
-        model.load_state_dict(torch.load(start_from_checkpoint))
+        model.load_state_dict(load_weights(start_from_checkpoint))
     criterion = ContrastiveLoss()
+
+    if memory_bank_momentum is not None:
+        memory_bank = EmbeddingMemoryBank(
+            n_samples=len(siamese_sampler_dataset_train.all_samples_labels),
+            embedding_size=final_embedding_size,
+            momentum=memory_bank_momentum,
+            device=device
+        )
+    else:
+        memory_bank = None
+
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
     scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=scheduler_step_every_n_updates, gamma=scheduler_gamma)
 
@@ -501,7 +556,8 @@ if __name__ == '__main__':
         output_dir=output_dir,
         save_every_n_updates=save_every_n_updates,
         num_epochs=num_epochs,
-        data_loader_num_workers=data_loader_num_workers
+        data_loader_num_workers=data_loader_num_workers,
+        memory_bank=memory_bank
     )
 
 
@@ -2,6 +2,7 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 import heapq
+from datasketches import kll_floats_sketch
 
 IMAGENET_MEAN = np.array([0.485, 0.456, 0.406])
 IMAGENET_STD = np.array([0.229, 0.224, 0.225])
@@ -29,6 +30,145 @@ class LimitedSizeHeap:
         return sorted(self.data)
 
 
+class StreamingPairSelector:
+    """
+    Selects, in a single pass over blocks of pairwise distances, keep_n random pairs among the ones whose distance
+    is under (closest) or over (farthest) a percentile of all the distances. The distances feed a KLL sketch, which
+    gives a running estimate of the threshold, and the pairs beyond a looser running threshold go to a reservoir of
+    candidates (bottom-k sampling on random keys, so it is a uniform sample of bounded size). At the end, the
+    candidates are filtered with the final threshold, so the distances never have to be computed a second time.
+
+    The sketch is fed the same fraction of the distances of every block, so each block weighs in proportion to its
+    size. The sampling rate and the k of the sketch are derived from the tail rank (percentile / 100 for 'closest',
+    1 - percentile / 100 for 'farthest'), so that the rank error of the threshold stays under tail_rank_error times
+    the tail rank. The k of a KLL sketch is capped at 65535 (a rank error of about 5e-5), so under a tail rank of
+    about 5e-5 / tail_rank_error (0.05% with the default) the threshold is coarser than that and some of the
+    selected pairs can be slightly short of the exact percentile.
+
+    Parameters:
+    - percentile (float): The percentile of the distances, in [0, 100], used as threshold.
+    - metric (str): 'closest' to select pairs under the threshold, 'farthest' to select pairs over it.
+    - keep_n (int): The number of pairs to select.
+    - n_pairs (int or None): The total number of distances which will be given to update, all of them are added to
+        the sketch if None.
+    - reservoir_factor (int): The reservoir keeps up to reservoir_factor * keep_n candidates.
+    - admission_slack (float): The candidates are admitted with a percentile admission_slack times looser than the
+        final one, as the running threshold is only estimated from the distances seen so far.
+    - sketch_k (int or None): The k parameter of the KLL sketch, which controls its accuracy, derived from the
+        tail rank if None.
+    - sketch_samples (int): The minimum number of distances added to the sketch over all the blocks, more are added
+        if the tail rank needs it.
+    - tail_rank_error (float): The target rank error of the threshold, relative to the tail rank.
+    """
+    MAX_SKETCH_K = 65535
+
+    def __init__(self,
+                 percentile: float,
+                 metric: str,
+                 keep_n: int,
+                 n_pairs: int = None,
+                 reservoir_factor: int = 4,
+                 admission_slack: float = 2.,
+                 sketch_k: int = None,
+                 sketch_samples: int = 10000000,
+                 tail_rank_error: float = 0.1):
+        assert metric in ['closest', 'farthest']
+        assert 0 <= percentile <= 100, "percentile should be between 0 and 100."
+
+        self.metric = metric
+        self.keep_n = keep_n
+        self.capacity = max(1, reservoir_factor * keep_n)
+
+        self.rank = percentile / 100
+        if metric == 'closest':
+            self.admission_rank = min(1., self.rank * admission_slack)
+            tail_rank = self.rank
+        else:
+            self.admission_rank = max(0., 1 - (1 - self.rank) * admission_slack)
+            tail_rank = 1 - self.rank
+        tail_rank = max(tail_rank, 1 / n_pairs if n_pairs else 1e-9)
+
+        if sketch_k is None:
+            sketch_k = 200
+            while sketch_k < self.MAX_SKETCH_K and \
+                    kll_floats_sketch.get_normalized_rank_error(sketch_k, False) > tail_rank_error * tail_rank:
+                sketch_k = min(self.MAX_SKETCH_K, 2 * sketch_k)
+            if kll_floats_sketch.get_normalized_rank_error(sketch_k, False) > tail_rank_error * tail_rank:
+                print(f"Warning: the tail rank {tail_rank:.2e} of the pairs selection is too small for the KLL sketch,"
+                      f" its threshold will be coarser than the target rank error.")
+        self.sketch = kll_floats_sketch(sketch_k)
+
+        # The sampling error of a rank p estimated from m samples is about sqrt(p / m)
+        sketch_samples = max(sketch_samples, int(np.ceil(1 / (tail_rank * tail_rank_error ** 2))))
+        self.sketch_sampling_rate = 1. if not n_pairs else min(1., sketch_samples / n_pairs)
+
+        self.keys = None
+        self.values = None
+        self.rows = None
+        self.cols = None
+
+    def update(self, row_start: int, distances: torch.Tensor):
+        """
+        Adds a block of distances, distances[i, j] being the distance of the pair (row_start + i, j).
+        """
+        flat_distances = distances.flatten()
+        if self.sketch_sampling_rate < 1:
+            # A fixed rate, with a random rounding of the number of samples, so the small blocks are not over-weighted
+            n_samples = flat_distances.numel() * self.sketch_sampling_rate
+            n_samples = int(n_samples) + int(np.random.rand() < n_samples - int(n_samples))
+            flat_distances = flat_distances[torch.randint(flat_distances.numel(), (n_samples,),
+                                                          device=flat_distances.device)]
+        if flat_distances.numel() > 0:
+            self.sketch.update(flat_distances.float().cpu().numpy())
+
+        if self.sketch.is_empty():
+            # no distance sampled yet, all the pairs of the block are candidates
+            candidates = torch.ones_like(distances, dtype=torch.bool)
+        elif self.metric == 'closest':
+            admission_threshold = self.sketch.get_quantile(self.admission_rank)
+            candidates = distances < admission_threshold
+        else:
+            admission_threshold = self.sketch.get_quantile(self.admission_rank)
+            candidates = distances > admission_threshold
+
+        keys = torch.rand_like(distances, dtype=torch.float32)
+        if self.keys is not None and len(self.keys) == self.capacity:
+            # only the candidates with a smaller key than the ones in the full reservoir can get in
+            candidates &= keys < self.keys.max()
+
+        rows, cols = torch.nonzero(candidates, as_tuple=True)
+        keys = keys[rows, cols]
+        values = distances[rows, cols]
+        rows = rows + row_start
+        if self.keys is not None:
+            keys = torch.cat([self.keys, keys])
+            values = torch.cat([self.values, values])
+            rows = torch.cat([self.rows, rows])
+            cols = torch.cat([self.cols, cols])
+        if len(keys) > self.capacity:
+            keys, kept = torch.topk(keys, k=self.capacity, largest=False)
+            values, rows, cols = values[kept], rows[kept], cols[kept]
+
+        self.keys, self.values, self.rows, self.cols = keys, values, rows, cols
+
+    def get_threshold(self) -> float:
+        return self.sketch.get_quantile(self.rank)
+
+    def get_pairs(self) -> list:
+        """
+        Returns up to keep_n random (row, column) pairs beyond the final threshold, in random order.
+        """
+        if self.keys is None or len(self.keys) == 0:
+            return []
+
+        threshold = self.get_threshold()
+        selected = self.values < threshold if self.metric == 'closest' else self.values > threshold
+        keys, rows, cols = self.keys[selected], self.rows[selected], self.cols[selected]
+
+        order = torch.argsort(keys)[:self.keep_n]
+        return list(zip(rows[order].tolist(), cols[order].tolist()))
+
+
 # Example usage
 def normalize_non_black_pixels(data: np.array, mean: np.array, std: np.array):
     assert data.shape[0] == 3, 'Please make sure that the RGB channel is the first dimension of the image array.'
@@ -76,14 +216,6 @@ def pad_images(images):
     return torch.stack(padded_images)
 
 
-def scale_values(values, old_min, old_max, new_min, new_max):
-    scaled_values = []
-    for value in values:
-        scaled_value = ((value - old_min) / (old_max - old_min)) * (new_max - new_min) + new_min
-        scaled_values.append(scaled_value)
-    return scaled_values
-
-
 def train_collate_fn(batch):
     imgs1 = [torch.Tensor(b[0]) for b in batch]
     imgs2 = [torch.Tensor(b[1]) for b in batch]
@@ -109,6 +241,12 @@ def train_collate_fn2(batch):
     imgs1_padded = pad_images(imgs1)
     imgs2_padded = pad_images(imgs2)
 
+    if len(batch[0]) > 8:
+        # the datasets built with return_indices=True also return the global ids of the two samples
+        indices1 = torch.Tensor([b[8] for b in batch]).long()
+        indices2 = torch.Tensor([b[9] for b in batch]).long()
+        return imgs1_padded, imgs2_padded, months1, months2, days1, days2, labels, margins, indices1, indices2
+
     return imgs1_padded, imgs2_padded, months1, months2, days1, days2, labels, margins
 
 
@@ -2,6 +2,7 @@ from pathlib import Path
 
 import joblib
 import numpy as np
+import pandas as pd
 from sklearn.decomposition import PCA
 
 
@@ -13,6 +14,10 @@ FOREST_QPEB_MEAN = np.array([0.463, 0.537, 0.363])
 FOREST_QPEB_STD = np.array([0.207, 0.206, 0.162])
 
 
+def scale_values(values, old_min, old_max, new_min, new_max):
+    return ((np.asarray(values, dtype=np.float64) - old_min) / (old_max - old_min)) * (new_max - new_min) + new_min
+
+
 def apply_pca_to_images(embeddings: np.ndarray, pca_model_path: str, n_patches: int, n_features: int):
     n, h, w, d = embeddings.shape
     embeddings_array_flat = embeddings.reshape(-1, embeddings.shape[-1])
@@ -43,3 +48,59 @@ def apply_pca_to_images(embeddings: np.ndarray, pca_model_path: str, n_patches:
     pca_result = pca_result.reshape(n, h, w, n_features)
     print('Done.')
     return pca_result
+
+
+def get_categories_distances_matrix(categories_names_to_idx: dict,
+                                    taxa_distances_df: pd.DataFrame or None,
+                                    dead_distance: float,
+                                    min_margin: float,
+                                    max_margin: float):
+    """
+    Builds the dense matrix of the distances between categories, indexed by their integer ids, in one vectorized
+    pass over the taxa distances instead of one DataFrame lookup per pair of categories.
+
+    Parameters:
+    - categories_names_to_idx (dict): The integer id of each category name, used as row/column of the matrix.
+        The rows/columns of unused ids (e.g. 0 if the ids start at 1) are zeros.
+    - taxa_distances_df (pd.DataFrame or None): The 'canonicalName1', 'canonicalName2', 'dist' phylogenetic
+        distances. Their positive distances are scaled to [min_margin, max_margin].
+        If None, all the distances between different categories are 1.
+    - dead_distance (float): The distance between the 'Dead' category and any other category.
+    - min_margin, max_margin (float): The range of the scaled positive taxa distances.
+
+    Returns:
+    - A (max_id + 1, max_id + 1) float np.ndarray, with categories_dists[id1, id2] the distance between the categories.
+    """
+    n_ids = max(categories_names_to_idx.values(), default=-1) + 1
+    names_ids = pd.Series(categories_names_to_idx, dtype=np.int64)
+
+    if taxa_distances_df is None:
+        categories_dists = np.ones((n_ids, n_ids))
+    else:
+        dists = taxa_distances_df['dist'].to_numpy(dtype=np.float64).copy()
+        positive = dists > 0
+        if positive.any():
+            dists[positive] = scale_values(dists[positive], dists[positive].min(), dists[positive].max(), min_margin, max_margin)
+
+        ids_1 = taxa_distances_df['canonicalName1'].map(names_ids).to_numpy()
+        ids_2 = taxa_distances_df['canonicalName2'].map(names_ids).to_numpy()
+        known = ~(np.isnan(ids_1) | np.isnan(ids_2))
+        categories_dists = np.full((n_ids, n_ids), np.nan)
+        categories_dists[ids_1[known].astype(np.int64), ids_2[known].astype(np.int64)] = dists[known]
+
+    ids = names_ids.to_numpy()
+    if 'Dead' in categories_names_to_idx:
+        categories_dists[categories_names_to_idx['Dead'], ids] = dead_distance
+        categories_dists[ids, categories_names_to_idx['Dead']] = dead_distance
+    categories_dists[ids, ids] = 0
+
+    used = np.zeros(n_ids, dtype=bool)
+    used[ids] = True
+    missing = np.isnan(categories_dists) & used[:, None] & used[None, :]
+    if missing.any():
+        idx_to_names = {idx: name for name, idx in categories_names_to_idx.items()}
+        missing_pairs = [(idx_to_names[i], idx_to_names[j]) for i, j in zip(*np.nonzero(missing))]
+        raise ValueError(f"No taxa distance for {len(missing_pairs)} pairs of categories,"
+                         f" e.g. {missing_pairs[:5]}.")
+
+    return np.nan_to_num(categories_dists, nan=0.)
@@ -1,13 +1,24 @@
 from pathlib import Path
 import time
+from typing import Dict
+
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import torch
 
 from geodataset.utils import GeoPackageNameConvention
 
-from engine.embedder.contrastive.contrastive_infer import contrastive_classifier_embedder_infer
-from engine.embedder.dinov2.dinov2 import infer_dinov2
+from engine.embedder.contrastive.contrastive_infer import get_contrastive_infer_dataset, load_contrastive_embedder
+from engine.embedder.dinov2.dinov2 import DINOv2Inference
+from engine.embedder.dinov2.dinov2_dataset import DINOv2SegmentationLabeledRasterCocoDataset
+from engine.embedder.multi_embedder import multi_embedder_infer, ContrastiveEmbedderHead, DINOv2EmbedderHead
 from engine.embedder.siamese.siamese_infer import siamese_classifier
 from engine.pipelines.pipeline_base import BaseRasterPipeline
+from engine.utils.coco import coco_to_tiles_attributes_df
+from engine.utils.embeddings_store import gdf_embeddings_to_stores
+from engine.utils.geopackage import write_geopackage
+from engine.utils.geoparquet import is_geoparquet_path, geoparquet_to_crs_gdf
 
 from config.config_parsers.pipeline_parsers import PipelineClassifierIOConfig
 
@@ -32,15 +43,24 @@ class PipelineClassifier(BaseRasterPipeline):
     def from_config(cls, pipeline_classifier_config: PipelineClassifierIOConfig):
         return cls(pipeline_classifier_config)
 
-    def run(self):
+    def run(self, save_geopackage: bool = True):
+        """
+        Parameters:
+        - save_geopackage (bool): Whether to write the classifier geopackage. The embeddings stores are always saved.
+          PipelineXPrize sets it to False as it adds columns to the returned GeoDataFrame and writes the final
+          geopackage itself.
+        """
         start_time = time.time()
 
+        # The polygon ids are carried to the tiles, to map them back to their polygons without decoding their masks
+        segmentations_gdf, segmentations_geopackage_path = self._load_segmentations_with_polygon_ids()
+
         embedder_tilerizer_config = self._get_tilerizer_config(
             tilerizer_config=self.config.classifier_tilerizer_config,
             output_folder=self.classifier_tilerizer_output_folder,
-            labels_path=self.config.segmentations_geopackage_path,
+            labels_path=segmentations_geopackage_path,
             main_label_category_column_name=None,
-            other_labels_attributes_column_names=['detector_score', 'segmenter_score']
+            other_labels_attributes_column_names=['detector_score', 'segmenter_score', 'polygon_id']
         )
 
         embedder_tiles_path, coco_paths = tilerizer_main(
@@ -49,45 +69,25 @@ class PipelineClassifier(BaseRasterPipeline):
 
         data_roots = [coco_paths['infer'].parent, embedder_tiles_path]
 
-        if self.config.classifier_contrastive_embedder_config:
-            tiles_polygons_gdf_crs = contrastive_classifier_embedder_infer(
-                backbone_name=self.config.classifier_contrastive_embedder_config.backbone_name,
-                final_embedding_size=self.config.classifier_contrastive_embedder_config.final_embedding_size,
-                data_roots=data_roots,
-                fold=self.AOI_NAME,
-                day_month_year=self.config.day_month_year,
-                image_size=self.config.classifier_contrastive_embedder_config.image_size,
-                mean_std_descriptor=self.config.classifier_contrastive_embedder_config.mean_std_descriptor,
-                contrastive_checkpoint=self.config.classifier_contrastive_embedder_config.checkpoint_path,
-                batch_size=self.config.classifier_contrastive_embedder_config.batch_size
-            )
-
-        if self.config.classifier_dinov2_embedder_config:
-            dinov2_embeddings_gdf = infer_dinov2(
-                data_roots=data_roots,
-                image_size_center_crop_pad=self.config.classifier_dinov2_embedder_config.image_size_center_crop_pad,
-                size=self.config.classifier_dinov2_embedder_config.size,
-                use_cls_token=self.config.classifier_dinov2_embedder_config.use_cls_token,
-            )
-            dinov2_embeddings_gdf.drop('down_sampled_masks', axis=1, inplace=True)
-
-        if self.config.classifier_contrastive_embedder_config and self.config.classifier_dinov2_embedder_config:
-            tiles_polygons_gdf_crs.rename(columns={'embeddings': 'embeddings_contrastive'}, inplace=True)
-            dinov2_embeddings_gdf.rename(columns={'embeddings': 'embeddings_dinov2'}, inplace=True)
-            tiles_polygons_gdf_crs['tile_path'] = tiles_polygons_gdf_crs['tile_path'].astype(str)
-            dinov2_embeddings_gdf['tile_path'] = dinov2_embeddings_gdf['tile_path'].astype(str)
-            gdf = tiles_polygons_gdf_crs.merge(dinov2_embeddings_gdf, on='tile_path')
-            gdf.rename({'geometry_x': 'geometry', 'area_x': 'area'}, axis=1, inplace=True)
-            gdf.drop(['geometry_y', 'area_y'], axis=1, inplace=True)
-            gdf = gpd.GeoDataFrame(gdf)
-            gdf.set_geometry('geometry')
-        elif self.config.classifier_contrastive_embedder_config:
-            gdf = tiles_polygons_gdf_crs
-        elif self.config.classifier_dinov2_embedder_config:
-            gdf = dinov2_embeddings_gdf
-        else:
+        if not self.config.classifier_contrastive_embedder_config and not self.config.classifier_dinov2_embedder_config:
             raise ValueError("At least one of the embedder configurations must be provided.")
 
+        # Each tile is decoded once and embedded by all the embedders. The embeddings are then aligned to the
+        # segmentations polygons through the polygon id of their tile
+        datasets, heads = self._get_embedders(data_roots=data_roots)
+        embeddings_dfs = multi_embedder_infer(
+            datasets=datasets,
+            heads=heads,
+            batch_size=(self.config.classifier_contrastive_embedder_config
+                        or self.config.classifier_dinov2_embedder_config).batch_size
+        )
+
+        gdf = self._join_embeddings(
+            polygons_gdf=segmentations_gdf,
+            tiles_attributes_df=coco_to_tiles_attributes_df(coco_paths['infer'], images_directory=embedder_tiles_path),
+            embeddings_dfs=embeddings_dfs
+        )
+
         geopackage_name = GeoPackageNameConvention.create_name(
             product_name=self.raster_name,
             fold='inferembedderclassifier',
@@ -98,10 +98,116 @@ class PipelineClassifier(BaseRasterPipeline):
         self.classifier_output_folder.mkdir(parents=True, exist_ok=True)
         output_path = self.classifier_output_folder / geopackage_name
 
-        gdf.to_file(output_path, driver='GPKG')
-        print(f"Successfully saved the embeddings and classification predictions at {output_path}.")
+        # The embeddings are saved as binary stores next to the geopackage, keyed by polygon_id
+        gdf = gdf_embeddings_to_stores(gdf, geopackage_path=output_path)
+        if save_geopackage:
+            write_geopackage(gdf, output_path)
+            print(f"Successfully saved the embeddings and classification predictions at {output_path}.")
 
         end_time = time.time()
         print(f"It took {end_time - start_time} seconds to run the raster through the Embedder/Classifier pipeline.")
 
         return gdf, output_path
+
+    def _get_embedders(self, data_roots: list):
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+        datasets = {}
+        heads = {}
+        if self.config.classifier_contrastive_embedder_config:
+            contrastive_config = self.config.classifier_contrastive_embedder_config
+            datasets['contrastive'] = get_contrastive_infer_dataset(
+                data_roots=data_roots,
+                fold=self.AOI_NAME,
+                day_month_year=self.config.day_month_year,
+                image_size=contrastive_config.image_size
+            )
+            heads['contrastive'] = ContrastiveEmbedderHead(
+                model=load_contrastive_embedder(
+                    backbone_name=contrastive_config.backbone_name,
+                    final_embedding_size=contrastive_config.final_embedding_size,
+                    contrastive_checkpoint=contrastive_config.checkpoint_path,
+                    mean_std_descriptor=contrastive_config.mean_std_descriptor,
+                    device=device
+                ),
+                device=device
+            )
+
+        if self.config.classifier_dinov2_embedder_config:
+            dinov2_config = self.config.classifier_dinov2_embedder_config
+            datasets['dinov2'] = DINOv2SegmentationLabeledRasterCocoDataset(
+                root_path=data_roots,
+                fold=self.AOI_NAME,
+                image_size_center_crop_pad=dinov2_config.image_size_center_crop_pad
+            )
+            heads['dinov2'] = DINOv2EmbedderHead(
+                dinov2=DINOv2Inference(size=dinov2_config.size, normalize=False, instance_segmentation=False),
+                average_non_masked_patches=not dinov2_config.use_cls_token,
+                max_batch_pixels=dinov2_config.max_batch_pixels
+            )
+
+        return datasets, heads
+
+    def _load_segmentations_with_polygon_ids(self):
+        segmentations_path = self.config.segmentations_geopackage_path
+        if is_geoparquet_path(segmentations_path):
+            segmentations_gdf = geoparquet_to_crs_gdf(segmentations_path)
+        else:
+            segmentations_gdf = gpd.read_file(segmentations_path)
+
+        if 'polygon_id' in segmentations_gdf.columns:
+            return segmentations_gdf, segmentations_path
+
+        # The segmentations weren't created by coco_to_geopackage_main, saving a copy with polygon ids for the tilerizer
+        segmentations_gdf['polygon_id'] = range(len(segmentations_gdf))
+        segmentations_geopackage_path = Path(self.output_folder) / f"{Path(segmentations_path).stem}_polygon_ids.gpkg"
+        write_geopackage(segmentations_gdf, segmentations_geopackage_path)
+
+        return segmentations_gdf, segmentations_geopackage_path
+
+    @staticmethod
+    def _join_embeddings(polygons_gdf: gpd.GeoDataFrame,
+                         tiles_attributes_df: pd.DataFrame,
+                         embeddings_dfs: Dict[str, pd.DataFrame]) -> gpd.GeoDataFrame:
+        """
+        Joins the embeddings of each embedder to the polygons they were computed for, through the polygon id of
+        their tile (one polygon per tile) in the classifier tilerizer COCO, instead of a string merge. The polygons
+        are already in the CRS, so no mask has to be decoded. The embeddings columns are named 'embeddings' for a
+        single embedder, and 'embeddings_{embedder name}' otherwise. Only the polygons embedded by all the
+        embedders are kept.
+        """
+        tiles_polygons_ids = pd.Series(
+            tiles_attributes_df['polygon_id'].to_numpy(),
+            index=tiles_attributes_df['tile_path'].map(lambda tile_path: Path(tile_path).name)
+        )
+        if not tiles_polygons_ids.index.is_unique:
+            raise ValueError("The classifier tilerizer is expected to output exactly one polygon per tile.")
+        polygons_ids = pd.Index(polygons_gdf['polygon_id'])
+
+        embedders_rows = {}
+        keep = np.ones(len(polygons_gdf), dtype=bool)
+        for embedder_name, embeddings_df in embeddings_dfs.items():
+            embedded_polygons_ids = tiles_polygons_ids.reindex(
+                embeddings_df['tile_path'].map(lambda tile_path: Path(tile_path).name))
+            positions = polygons_ids.get_indexer(embedded_polygons_ids)
+            if (positions < 0).any():
+                raise ValueError(f"The {embedder_name} embedder returned tiles which don't match any segmentation polygon.")
+            rows = np.full(len(polygons_gdf), -1)
+            rows[positions] = np.arange(len(embeddings_df))
+            keep &= rows >= 0
+            embedders_rows[embedder_name] = rows
+
+        gdf = polygons_gdf[keep].reset_index(drop=True)
+        for embedder_name, embeddings_df in embeddings_dfs.items():
+            rows = embedders_rows[embedder_name][keep]
+            if not np.array_equal(rows, np.arange(len(embeddings_df))):
+                embeddings_df = embeddings_df.iloc[rows]
+            for column in embeddings_df.columns.drop('tile_path'):
+                gdf_column = f"{column}_{embedder_name}" if column == 'embeddings' and len(embeddings_dfs) > 1 else column
+                gdf[gdf_column] = embeddings_df[column].to_numpy()
+            # The classifier tile of each polygon, the same for all the embedders
+            gdf['tile_path'] = embeddings_df['tile_path'].to_numpy()
+
+        gdf['area'] = gdf.geometry.area
+
+        return gdf
@@ -7,6 +7,8 @@ from engine.estimators.biomass_estimator import BrazilRainforestBiomassEstimator
 from engine.pipelines.pipeline_classifier import PipelineClassifier
 from engine.pipelines.pipeline_detector import PipelineDetector
 from engine.pipelines.pipeline_segmenter import PipelineSegmenter
+from engine.utils.embeddings_store import get_embeddings_columns_names, link_embeddings_stores
+from engine.utils.geopackage import write_geopackage
 
 
 class PipelineXPrize:
@@ -30,9 +32,8 @@ class PipelineXPrize:
 
         pipeline_classifier_config = self._get_pipeline_classifier_config(segmentations_geopackage_path=segmentations_geopackage_path)
         pipeline_classifier = PipelineClassifier(pipeline_classifier_config=pipeline_classifier_config)
-        classifier_geopackage, classifier_geopackage_path = pipeline_classifier.run()
+        classifier_geopackage, classifier_geopackage_path = pipeline_classifier.run(save_geopackage=False)
 
-        classifier_geopackage['polygon_id'] = range(len(classifier_geopackage))
         classifier_geopackage['Shape_Area'] = classifier_geopackage.area    # for Vincent's pipeline
 
         print(f"\nRunning the biomass estimator...")
@@ -41,7 +42,10 @@ class PipelineXPrize:
         print(f"\nBiomass estimation is done.\n")
 
         final_geopackage_path = Path(self.config.output_folder) / f"{pipeline_detector.raster_name}_final.gpkg"
-        classifier_geopackage.to_file(final_geopackage_path, driver='GPKG')
+        write_geopackage(classifier_geopackage, final_geopackage_path)
+        link_embeddings_stores(source_geopackage_path=classifier_geopackage_path,
+                               target_geopackage_path=final_geopackage_path,
+                               columns_names=get_embeddings_columns_names(classifier_geopackage_path))
 
         end_time = time.time()
         print(f"\nThe final geopackage is saved at {final_geopackage_path}.")
@@ -1,6 +1,7 @@
 from pathlib import Path
 import time
 
+import geopandas as gpd
 from geodataset.utils.file_name_conventions import CocoNameConvention
 
 from config.config_parsers.segmenter_parsers import SegmenterInferIOConfig
@@ -23,8 +24,10 @@ class PipelineSegmenter(BaseRasterPipeline):
         self.config = pipeline_segmenter_config
         self.scores_weights_config = self.config.segmenter_aggregator_config.scores_weights
 
+        self.segmenter_boxes_pruning_output_folder = Path(self.output_folder) / 'segmenter_boxes_pruning_output'
         self.segmenter_tilerizer_output_folder = Path(self.output_folder) / 'segmenter_tilerizer_output'
         self.segmenter_output_folder = Path(self.output_folder) / 'segmenter_output'
+        self.segmenter_masks_cache_output_folder = Path(self.output_folder) / 'segmenter_masks_cache'
         self.segmenter_aggregator_output_folder = Path(self.output_folder) / 'segmenter_aggregator_output'
 
     @classmethod
@@ -34,10 +37,13 @@ class PipelineSegmenter(BaseRasterPipeline):
     def run(self):
         start_time = time.time()
 
+        # Removing the boxes that can't pass the aggregator score_threshold before SAM has to segment them
+        boxes_geopackage_path = self._prune_boxes_below_min_detector_score()
+
         segmenter_tilerizer_config = self._get_tilerizer_config(
             tilerizer_config=self.config.segmenter_tilerizer_config,
             output_folder=self.segmenter_tilerizer_output_folder,
-            labels_path=self.config.boxes_geopackage_path,
+            labels_path=boxes_geopackage_path,
             main_label_category_column_name=None,
             other_labels_attributes_column_names=['detector_score'] if self.scores_weights_config and 'detector_score' in self.scores_weights_config else None,
         )
@@ -72,10 +78,15 @@ class PipelineSegmenter(BaseRasterPipeline):
         segmenter_aggregator_output_path = self.segmenter_aggregator_output_folder / segmenter_aggregator_output_file
 
         polygons_scores = {'segmenter_score': segmenter_masks_scores}
-        polygons_scores_weights = {'segmenter_score': self.scores_weights_config['segmenter_score'] if self.scores_weights_config and 'segmenter_score' in self.scores_weights_config else 1.0}
-        if self.scores_weights_config and 'detector_score' in self.scores_weights_config:
+        min_detector_score = self._get_min_detector_score()
+        if min_detector_score is not None and min_detector_score > 0:
+            # SAM's predicted IoUs are not bounded, they are clamped to the [0, 1] range assumed by the boxes pruning
+            # bound, so that no pruned box could have passed the score_threshold
+            polygons_scores['segmenter_score'] = [[min(max(score, 0.0), 1.0) for score in tile_scores]
+                                                  for tile_scores in segmenter_masks_scores]
+        polygons_scores_weights = self._get_polygons_scores_weights()
+        if 'detector_score' in polygons_scores_weights:
             polygons_scores['detector_score'] = segmenter_boxes_scores
-            polygons_scores_weights['detector_score'] = self.scores_weights_config['detector_score'] if self.scores_weights_config and 'detector_score' in self.scores_weights_config else 1.0
 
         aggregator_main_with_polygons_input(
             config=self.config.segmenter_aggregator_config,
@@ -101,6 +112,50 @@ class PipelineSegmenter(BaseRasterPipeline):
 
         return segmenter_aggregator_geopackage_path
 
+    def _get_polygons_scores_weights(self):
+        polygons_scores_weights = {'segmenter_score': self.scores_weights_config['segmenter_score'] if self.scores_weights_config and 'segmenter_score' in self.scores_weights_config else 1.0}
+        if self.scores_weights_config and 'detector_score' in self.scores_weights_config:
+            polygons_scores_weights['detector_score'] = self.scores_weights_config['detector_score']
+
+        return polygons_scores_weights
+
+    def _get_min_detector_score(self):
+        polygons_scores_weights = self._get_polygons_scores_weights()
+        if 'detector_score' not in polygons_scores_weights or polygons_scores_weights['detector_score'] <= 0:
+            return None
+
+        # The best aggregated score a box can get is when all the other scores (segmenter_score) are at their max of 1.0,
+        # the segmenter scores are clamped to [0, 1] before the aggregation when the boxes are pruned (see run).
+        # This bound uses the weighted arithmetic mean of the scores, which is >= their weighted geometric mean,
+        # so a pruned box can never pass the score_threshold whichever of the two the aggregator uses.
+        total_weight = sum(polygons_scores_weights.values())
+        detector_weight = polygons_scores_weights['detector_score']
+        other_weights = total_weight - detector_weight
+        min_detector_score = (self.config.segmenter_aggregator_config.score_threshold * total_weight - other_weights) / detector_weight
+
+        return min_detector_score
+
+    def _prune_boxes_below_min_detector_score(self):
+        min_detector_score = self._get_min_detector_score()
+        if min_detector_score is None or min_detector_score <= 0:
+            return self.config.boxes_geopackage_path
+
+        boxes_gdf = gpd.read_file(self.config.boxes_geopackage_path)
+        keep = boxes_gdf['detector_score'] >= min_detector_score
+        n_pruned = int((~keep).sum())
+        print(f"Pruned {n_pruned}/{len(boxes_gdf)} boxes with a detector_score < {min_detector_score:.4f} before SAM,"
+              f" as they could never pass the segmenter aggregator score_threshold"
+              f" of {self.config.segmenter_aggregator_config.score_threshold}.")
+
+        if n_pruned == 0:
+            return self.config.boxes_geopackage_path
+
+        self.segmenter_boxes_pruning_output_folder.mkdir(parents=True, exist_ok=False)
+        pruned_boxes_geopackage_path = self.segmenter_boxes_pruning_output_folder / Path(self.config.boxes_geopackage_path).name
+        boxes_gdf[keep].to_file(pruned_boxes_geopackage_path, driver='GPKG')
+
+        return str(pruned_boxes_geopackage_path)
+
     def _get_segmenter_infer_config(self,
                                     tiles_path: Path,
                                     coco_path: Path):
@@ -115,6 +170,9 @@ class PipelineSegmenter(BaseRasterPipeline):
             input_tiles_root=str(tiles_path),
             coco_path=str(coco_path),
             output_folder=output_folder,
+            masks_cache_output_path=str(self.segmenter_masks_cache_output_folder / f"{self.raster_name}_segmenter_masks_cache.gpkg"),
+            previous_masks_cache_path=self.config.previous_masks_cache_path,
+            incremental_iou_threshold=self.config.incremental_iou_threshold,
         )
 
         return segmenter_infer_config
@@ -0,0 +1,92 @@
+from pathlib import Path
+from typing import List, Dict, Tuple
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import Polygon
+
+BOX_COLUMNS = ['box_xmin', 'box_ymin', 'box_xmax', 'box_ymax']
+
+
+def save_masks_cache(output_path: Path,
+                     tiles_paths: List[Path],
+                     tiles_boxes: List[np.ndarray],
+                     tiles_masks_polygons: List[List[Polygon]],
+                     tiles_masks_scores: List[List[float]]):
+    """
+    Saves the SAM boxes and masks of each tile, in tile pixel coordinates, so that a later run on the same raster and
+    tiles can carry forward the masks of the boxes that didn't change instead of segmenting them again.
+
+    Parameters:
+    - output_path (Path): The path of the output geopackage.
+    - tiles_paths (List[Path]): The paths of the tiles.
+    - tiles_boxes (List[np.ndarray]): The (N, 4) xyxy boxes given to SAM for each tile.
+    - tiles_masks_polygons (List[List[Polygon]]): The masks polygons of each tile, in the same order as the boxes.
+    - tiles_masks_scores (List[List[float]]): The masks scores of each tile, in the same order as the boxes.
+    """
+    tiles_names = [Path(tile_path).name for tile_path, tile_boxes in zip(tiles_paths, tiles_boxes) for _ in tile_boxes]
+    # the (0, 4) array keeps the columns when there are no tiles or no boxes, an empty cache is then written
+    boxes = np.concatenate([np.zeros((0, 4), dtype=np.float64)] +
+                           [np.asarray(tile_boxes, dtype=np.float64).reshape(-1, 4) for tile_boxes in tiles_boxes])
+
+    gdf = gpd.GeoDataFrame({
+        'tile_name': tiles_names,
+        **{column: boxes[:, i] for i, column in enumerate(BOX_COLUMNS)},
+        'segmenter_score': [score for tile_scores in tiles_masks_scores for score in tile_scores],
+    }, geometry=[polygon for tile_polygons in tiles_masks_polygons for polygon in tile_polygons])
+
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    gdf.to_file(output_path, driver='GPKG')
+    print(f"Saved the SAM masks cache of {len(gdf)} boxes at {output_path}.")
+
+
+def load_masks_cache(masks_cache_path: Path) -> Dict[str, Tuple[np.ndarray, List[Polygon], List[float]]]:
+    """
+    Loads a masks cache saved by save_masks_cache.
+
+    Parameters:
+    - masks_cache_path (Path): The path of the masks cache geopackage.
+
+    Returns:
+    - A dict mapping each tile name to its (N, 4) xyxy boxes, masks polygons and masks scores.
+    """
+    gdf = gpd.read_file(masks_cache_path)
+
+    masks_cache = {}
+    for tile_name, tile_gdf in gdf.groupby('tile_name', sort=False):
+        polygons = [polygon if polygon is not None else Polygon() for polygon in tile_gdf.geometry]
+        masks_cache[tile_name] = (tile_gdf[BOX_COLUMNS].to_numpy(dtype=np.float64),
+                                  polygons,
+                                  tile_gdf['segmenter_score'].tolist())
+
+    return masks_cache
+
+
+def match_boxes_with_cache(boxes: np.ndarray, cached_boxes: np.ndarray, iou_threshold: float) -> np.ndarray:
+    """
+    Matches each box to its best cached box of the same tile.
+
+    Parameters:
+    - boxes (np.ndarray): The (N, 4) xyxy boxes to match.
+    - cached_boxes (np.ndarray): The (M, 4) xyxy boxes of the cache.
+    - iou_threshold (float): The minimum IoU for a box to be considered unchanged.
+
+    Returns:
+    - An array of N indices into cached_boxes, -1 for the boxes without a match (added or moved boxes).
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if len(boxes) == 0 or len(cached_boxes) == 0:
+        return np.full(len(boxes), -1, dtype=np.int64)
+
+    inter_w = np.clip(np.minimum(boxes[:, None, 2], cached_boxes[None, :, 2]) - np.maximum(boxes[:, None, 0], cached_boxes[None, :, 0]), 0, None)
+    inter_h = np.clip(np.minimum(boxes[:, None, 3], cached_boxes[None, :, 3]) - np.maximum(boxes[:, None, 1], cached_boxes[None, :, 1]), 0, None)
+    intersection = inter_w * inter_h
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    cached_areas = (cached_boxes[:, 2] - cached_boxes[:, 0]) * (cached_boxes[:, 3] - cached_boxes[:, 1])
+    union = areas[:, None] + cached_areas[None, :] - intersection
+    iou = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+    best_matches = iou.argmax(axis=1)
+    best_matches[iou[np.arange(len(boxes)), best_matches] < iou_threshold] = -1
+
+    return best_matches
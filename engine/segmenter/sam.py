@@ -1,5 +1,6 @@
 import time
-from typing import List
+from pathlib import Path
+from typing import List, Dict, Tuple
 
 import numpy as np
 import psutil
@@ -7,13 +8,16 @@ import torch
 from geodataset.dataset import DetectionLabeledRasterCocoDataset
 import multiprocessing
 
-from geodataset.utils import mask_to_polygon
+from shapely.geometry import Polygon
+
 from segment_anything import SamPredictor, sam_model_registry
 
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
+from engine.segmenter.masks_cache import match_boxes_with_cache
 from engine.segmenter.utils import sam_collate_fn
+from engine.utils.polygons import masks_to_polygons
 
 
 def get_memory_usage():
@@ -30,8 +34,8 @@ def process_masks(queue, output_dict, simplify_tolerance, processed_counter):
         if item is None:
             break
         tile_idx, masks, scores = item
-        masks_polygons = [mask_to_polygon(mask.squeeze(), simplify_tolerance=simplify_tolerance) for mask in masks]
-        results.append((tile_idx, masks_polygons, scores.squeeze().tolist()))
+        masks_polygons = masks_to_polygons(masks, simplify_tolerance=simplify_tolerance)
+        results.append((tile_idx, masks_polygons, scores.reshape(-1).tolist()))
         masks = None  # releasing memory?
         queue.task_done()  # Indicate that the task is complete
         with processed_counter.get_lock():
@@ -83,7 +87,19 @@ class SamPredictorWrapper:
 
         return all_masks, all_scores
 
-    def infer_on_multi_box_dataset(self, dataset: DetectionLabeledRasterCocoDataset):
+    def infer_on_multi_box_dataset(self,
+                                   dataset: DetectionLabeledRasterCocoDataset,
+                                   previous_masks_cache: Dict[str, Tuple[np.ndarray, List[Polygon], List[float]]] = None,
+                                   incremental_iou_threshold: float = 0.95):
+        """
+        Segments the boxes of each tile of the dataset.
+        If a previous_masks_cache is given (see engine.segmenter.masks_cache), the boxes matching a cached box of
+        the same tile with an IoU >= incremental_iou_threshold get the cached mask instead of being segmented again,
+        and SAM only runs on the added or moved boxes.
+
+        Returns:
+        - The tiles paths, the (N, 4) xyxy boxes given to SAM for each tile, the masks polygons and the masks scores.
+        """
         infer_dl = DataLoader(dataset, batch_size=1, shuffle=False,
                               collate_fn=sam_collate_fn,
                               num_workers=3, persistent_workers=True)
@@ -93,6 +109,9 @@ class SamPredictorWrapper:
                                      leave=True)
 
         tiles_paths = []
+        tiles_boxes = []
+        tiles_inferred_boxes_ids = []
+        tiles_carried_masks = []
         tiles_masks_polygons = []
         tiles_masks_scores = []
         queue = multiprocessing.JoinableQueue()  # Create a JoinableQueue
@@ -116,13 +135,32 @@ class SamPredictorWrapper:
                 queue.join()
 
             image, boxes_data = sample
+            boxes = np.array(boxes_data['boxes']).reshape(-1, 4)
+            tiles_paths.append(dataset.tiles[tile_idx]['path'])
+            tiles_boxes.append(boxes)
+
+            inferred_boxes_ids = np.arange(len(boxes))
+            carried_masks = {}
+            tile_name = Path(dataset.tiles[tile_idx]['path']).name
+            if previous_masks_cache is not None and tile_name in previous_masks_cache:
+                cached_boxes, cached_polygons, cached_scores = previous_masks_cache[tile_name]
+                matches = match_boxes_with_cache(boxes, cached_boxes, iou_threshold=incremental_iou_threshold)
+                carried_masks = {box_id: (cached_polygons[match], cached_scores[match])
+                                 for box_id, match in enumerate(matches) if match >= 0}
+                inferred_boxes_ids = np.flatnonzero(matches < 0)
+            tiles_inferred_boxes_ids.append(inferred_boxes_ids)
+            tiles_carried_masks.append(carried_masks)
+
+            if len(inferred_boxes_ids) == 0:
+                # All the boxes of the tile are unchanged, no need to run SAM on it
+                continue
+
             image = image[:3, :, :]
             image_hwc = image.transpose((1, 2, 0))
             image_hwc = (image_hwc * 255).astype(np.uint8)
-            masks, scores = self._infer(image=image_hwc, boxes=boxes_data['boxes'])
+            masks, scores = self._infer(image=image_hwc, boxes=boxes[inferred_boxes_ids])
             masks = masks.numpy()
             scores = scores.numpy()
-            tiles_paths.append(dataset.tiles[tile_idx]['path'])
 
             # Put masks and scores into the queue for post-processing
             queue.put((tile_idx, masks, scores))
@@ -142,10 +180,25 @@ class SamPredictorWrapper:
         # Close the queue
         queue.close()
 
-        # Assemble the results into tiles_masks_polygons
-        for tile_idx in sorted(output_dict.keys()):
-            masks_polygons, scores = output_dict[tile_idx]
+        # Assemble the inferred and carried forward results into tiles_masks_polygons
+        for tile_idx, (tile_boxes, inferred_boxes_ids, carried_masks) in enumerate(zip(tiles_boxes, tiles_inferred_boxes_ids, tiles_carried_masks)):
+            masks_polygons = [None] * len(tile_boxes)
+            scores = [None] * len(tile_boxes)
+            if tile_idx in output_dict:
+                inferred_polygons, inferred_scores = output_dict[tile_idx]
+                for box_id, polygon, score in zip(inferred_boxes_ids, inferred_polygons, inferred_scores):
+                    masks_polygons[box_id] = polygon
+                    scores[box_id] = score
+            for box_id, (polygon, score) in carried_masks.items():
+                masks_polygons[box_id] = polygon
+                scores[box_id] = score
             tiles_masks_polygons.append(masks_polygons)
             tiles_masks_scores.append(scores)
 
-        return tiles_paths, tiles_masks_polygons, tiles_masks_scores
+        if previous_masks_cache is not None:
+            n_carried = sum(len(carried_masks) for carried_masks in tiles_carried_masks)
+            n_boxes = sum(len(tile_boxes) for tile_boxes in tiles_boxes)
+            print(f"Carried forward {n_carried}/{n_boxes} masks from the previous run,"
+                  f" SAM segmented the {n_boxes - n_carried} added or moved boxes.")
+
+        return tiles_paths, tiles_boxes, tiles_masks_polygons, tiles_masks_scores
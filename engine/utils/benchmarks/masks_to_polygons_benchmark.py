@@ -0,0 +1,47 @@
+import argparse
+import time
+
+import numpy as np
+from geodataset.utils import mask_to_polygon
+
+from engine.utils.polygons import masks_to_polygons
+
+
+def generate_crown_masks(n_masks: int, mask_size: int, min_radius: int, max_radius: int, seed: int = 0):
+    # SAM-like masks: one (sometimes two) blob per full-size tile mask
+    rng = np.random.default_rng(seed)
+    masks = np.zeros((n_masks, 1, mask_size, mask_size), dtype=bool)
+    yy, xx = np.mgrid[:mask_size, :mask_size]
+    for i in range(n_masks):
+        for _ in range(rng.integers(1, 3)):
+            cx, cy = rng.integers(0, mask_size, size=2)
+            radius = rng.integers(min_radius, max_radius)
+            masks[i, 0][(xx - cx) ** 2 + (yy - cy) ** 2 < radius ** 2] = True
+    return masks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput of masks_to_polygons vs geodataset's per-mask mask_to_polygon.")
+    parser.add_argument('--n_masks', type=int, default=2000)
+    parser.add_argument('--mask_size', type=int, default=1024)
+    parser.add_argument('--min_radius', type=int, default=10)
+    parser.add_argument('--max_radius', type=int, default=80)
+    parser.add_argument('--simplify_tolerance', type=float, default=1.0)
+    parser.add_argument('--batch_size', type=int, default=256)
+    args = parser.parse_args()
+
+    masks = generate_crown_masks(args.n_masks, args.mask_size, args.min_radius, args.max_radius)
+
+    start_time = time.time()
+    per_mask_polygons = [mask_to_polygon(mask.squeeze(), simplify_tolerance=args.simplify_tolerance) for mask in masks]
+    per_mask_time = time.time() - start_time
+
+    start_time = time.time()
+    batched_polygons = masks_to_polygons(masks, simplify_tolerance=args.simplify_tolerance, batch_size=args.batch_size)
+    batched_time = time.time() - start_time
+
+    n_different = sum(abs(p1.area - p2.area) > 1e-6 for p1, p2 in zip(per_mask_polygons, batched_polygons))
+
+    print(f"Per-mask mask_to_polygon: {per_mask_time:.3f}s ({args.n_masks / per_mask_time:.1f} masks/s)")
+    print(f"Batched masks_to_polygons: {batched_time:.3f}s ({args.n_masks / batched_time:.1f} masks/s)")
+    print(f"Speedup: {per_mask_time / batched_time:.2f}x. Polygons with a different area: {n_different}/{args.n_masks}.")
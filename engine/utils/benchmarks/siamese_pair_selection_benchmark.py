@@ -0,0 +1,89 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from engine.embedder.siamese.siamese_utils import StreamingPairSelector
+from engine.utils.distances import iter_pairwise_distances, pairwise_distances_quantiles
+
+
+def generate_embeddings(n_embeddings: int, embedding_size: int, n_clusters: int, seed: int = 0):
+    # Clustered embeddings, like the ones of a few species, so the distances are not all alike
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, embedding_size))
+    embeddings = centers[rng.integers(0, n_clusters, n_embeddings)] + 0.5 * rng.normal(size=(n_embeddings, embedding_size))
+    return torch.from_numpy(embeddings.astype(np.float32))
+
+
+def two_pass_selection(embeddings1, embeddings2, percentile, metric, keep_n, device, max_block_elements):
+    # First pass for the threshold, second pass to compute the distances again and select the pairs beyond it
+    threshold = float(pairwise_distances_quantiles(embeddings1, embeddings2, q=percentile / 100, device=device,
+                                                   max_block_elements=max_block_elements))
+    rows, cols = [], []
+    for row_start, distances in iter_pairwise_distances(embeddings1, embeddings2, device=device,
+                                                        max_block_elements=max_block_elements):
+        selected = distances < threshold if metric == 'closest' else distances > threshold
+        block_rows, block_cols = torch.nonzero(selected, as_tuple=True)
+        kept = torch.randperm(len(block_rows), device=block_rows.device)[:keep_n]
+        rows.append(block_rows[kept] + row_start)
+        cols.append(block_cols[kept])
+    rows, cols = torch.cat(rows), torch.cat(cols)
+    kept = torch.randperm(len(rows), device=rows.device)[:keep_n]
+    return list(zip(rows[kept].tolist(), cols[kept].tolist())), threshold
+
+
+def single_pass_selection(embeddings1, embeddings2, percentile, metric, keep_n, device, max_block_elements):
+    selector = StreamingPairSelector(percentile=percentile, metric=metric, keep_n=keep_n,
+                                     n_pairs=len(embeddings1) * len(embeddings2))
+    for row_start, distances in iter_pairwise_distances(embeddings1, embeddings2, device=device,
+                                                        max_block_elements=max_block_elements):
+        selector.update(row_start, distances)
+    return selector.get_pairs(), selector.get_threshold()
+
+
+def pairs_distances(embeddings1, embeddings2, pairs):
+    rows = torch.tensor([pair[0] for pair in pairs])
+    cols = torch.tensor([pair[1] for pair in pairs])
+    return (embeddings1[rows] - embeddings2[cols]).norm(dim=1).numpy()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput of the single-pass KLL + reservoir siamese pair selection"
+                                                 " vs the two-pass percentile then selection.")
+    parser.add_argument('--n_embeddings', type=int, default=200000, help='Split in two halves, all the pairs between'
+                                                                         ' the halves are considered.')
+    parser.add_argument('--embedding_size', type=int, default=1024)
+    parser.add_argument('--n_clusters', type=int, default=20)
+    parser.add_argument('--percentile', type=float, default=25)
+    parser.add_argument('--metric', type=str, default='closest', choices=['closest', 'farthest'])
+    parser.add_argument('--keep_n', type=int, default=10000)
+    parser.add_argument('--max_block_elements', type=int, default=100000000)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    embeddings = generate_embeddings(args.n_embeddings, args.embedding_size, args.n_clusters)
+    embeddings1, embeddings2 = embeddings[:args.n_embeddings // 2], embeddings[args.n_embeddings // 2:]
+    n_distances = len(embeddings1) * len(embeddings2)
+    device = torch.device(args.device)
+
+    results = {}
+    for name, selection in [('Two-pass', two_pass_selection), ('Single-pass', single_pass_selection)]:
+        start_time = time.time()
+        pairs, threshold = selection(embeddings1, embeddings2, args.percentile, args.metric, args.keep_n, device,
+                                     args.max_block_elements)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed_time = time.time() - start_time
+        results[name] = (pairs, threshold)
+        print(f"{name}: {elapsed_time:.3f}s ({n_distances / elapsed_time / 1e6:.1f}M distances/s),"
+              f" threshold={threshold:.4f}, {len(pairs)} pairs,"
+              f" mean pair distance={pairs_distances(embeddings1, embeddings2, pairs).mean():.4f}")
+
+    reference_threshold = results['Two-pass'][1]
+    single_pass_distances = pairs_distances(embeddings1, embeddings2, results['Single-pass'][0])
+    if args.metric == 'closest':
+        beyond_reference = (single_pass_distances < reference_threshold).mean()
+    else:
+        beyond_reference = (single_pass_distances > reference_threshold).mean()
+    print(f"Single-pass pairs beyond the two-pass threshold: {100 * beyond_reference:.2f}%")
@@ -0,0 +1,67 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+import shapely
+from geodataset.utils import tiles_polygons_gdf_to_crs_gdf as geodataset_tiles_polygons_gdf_to_crs_gdf
+from affine import Affine
+
+from engine.utils.polygons import tiles_polygons_gdf_to_crs_gdf
+
+
+def generate_tiles(output_folder: Path, n_tiles: int, tile_size: int, ground_resolution: float):
+    # Tiny single band GeoTIFFs, only their affine transform and CRS are used by the conversion
+    tiles_paths = []
+    for i in range(n_tiles):
+        tile_path = output_folder / f"tile_{i}.tif"
+        transform = Affine(ground_resolution, 0, 500000 + (i % 100) * tile_size * ground_resolution,
+                           0, -ground_resolution, 9000000 - (i // 100) * tile_size * ground_resolution)
+        with rasterio.open(tile_path, 'w', driver='GTiff', height=1, width=1, count=1, dtype='uint8',
+                           crs='EPSG:32718', transform=transform) as dst:
+            dst.write(np.zeros((1, 1, 1), dtype=np.uint8))
+        tiles_paths.append(str(tile_path))
+    return tiles_paths
+
+
+def generate_crowns_gdf(tiles_paths: list, n_crowns: int, tile_size: int, seed: int = 0):
+    # Crown-like polygons: buffered points with ~30 vertices each, in tile pixel coordinates
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0, tile_size, size=(n_crowns, 2))
+    radii = rng.uniform(10, 80, size=n_crowns)
+    crowns = shapely.buffer(shapely.points(centers), radii, quad_segs=8)
+    return gpd.GeoDataFrame({
+        'tile_path': np.array(tiles_paths, dtype=object)[rng.integers(0, len(tiles_paths), size=n_crowns)],
+        'segmenter_score': rng.random(n_crowns),
+    }, geometry=crowns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput of the vectorized tile to CRS conversion vs geodataset's per-geometry one.")
+    parser.add_argument('--n_crowns', type=int, default=500000)
+    parser.add_argument('--n_tiles', type=int, default=2000)
+    parser.add_argument('--tile_size', type=int, default=1024)
+    parser.add_argument('--ground_resolution', type=float, default=0.05)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tiles_paths = generate_tiles(Path(temp_dir), args.n_tiles, args.tile_size, args.ground_resolution)
+        gdf = generate_crowns_gdf(tiles_paths, args.n_crowns, args.tile_size)
+
+        start_time = time.time()
+        reference_gdf = geodataset_tiles_polygons_gdf_to_crs_gdf(gdf)
+        reference_time = time.time() - start_time
+
+        start_time = time.time()
+        vectorized_gdf = tiles_polygons_gdf_to_crs_gdf(gdf)
+        vectorized_time = time.time() - start_time
+
+    max_difference = np.abs(shapely.get_coordinates(reference_gdf.geometry.values)
+                            - shapely.get_coordinates(vectorized_gdf.geometry.values)).max()
+
+    print(f"Per-geometry tiles_polygons_gdf_to_crs_gdf: {reference_time:.3f}s ({args.n_crowns / reference_time:.0f} crowns/s)")
+    print(f"Vectorized tiles_polygons_gdf_to_crs_gdf: {vectorized_time:.3f}s ({args.n_crowns / vectorized_time:.0f} crowns/s)")
+    print(f"Speedup: {reference_time / vectorized_time:.2f}x. Max coordinates difference: {max_difference}.")
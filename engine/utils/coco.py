@@ -0,0 +1,314 @@
+import json
+import multiprocessing
+import shutil
+import tempfile
+from collections import deque
+from pathlib import Path
+from typing import List
+
+import geopandas as gpd
+import pandas as pd
+from geodataset.utils import COCOGenerator
+from shapely.geometry import Polygon, MultiPolygon
+
+from engine.utils.polygons import rle_segmentations_to_polygons
+
+
+class StreamingCOCOWriter:
+    """
+    Writes a COCO file incrementally instead of building the whole document in memory like COCOGenerator.
+
+    Tiles are appended with add_tiles and grouped in chunks. Each chunk is encoded (RLE, bbox, area...) by geodataset's
+    COCOGenerator in a pool of worker processes, so the annotations content is exactly the one COCOGenerator produces.
+    The images and annotations of the chunks are then re-numbered and written to disk as soon as they are ready,
+    in order, with the same json formatting as COCOGenerator, so the output file is byte-compatible with a
+    single COCOGenerator call over all the tiles.
+    Only the image entries (one small dict per tile) and a bounded number of chunks are kept in memory,
+    the annotations are streamed through a temporary file until the images list is complete.
+
+    Parameters:
+    - output_path (Path): The path of the output COCO json file.
+    - description (str): The description of the COCO file.
+    - use_rle_for_labels (bool): Whether to encode the polygons as RLE or as coordinates.
+    - n_workers (int): The number of processes encoding the chunks in parallel.
+    - chunk_size (int): The number of tiles per chunk.
+    - coco_categories_list (List[dict] or None): The COCO categories, required if categories are given to add_tiles.
+    """
+    FORMAT_CANDIDATES = [(2, True), (2, False), (None, True), (None, False), (4, True), (4, False), (1, True), (1, False)]
+
+    def __init__(self,
+                 output_path: Path,
+                 description: str,
+                 use_rle_for_labels: bool = True,
+                 n_workers: int = 5,
+                 chunk_size: int = 64,
+                 coco_categories_list: List[dict] or None = None):
+        self.output_path = Path(output_path)
+        self.description = description
+        self.use_rle_for_labels = use_rle_for_labels
+        self.n_workers = max(1, n_workers)
+        self.chunk_size = chunk_size
+        self.coco_categories_list = coco_categories_list
+
+        self.temp_dir = Path(tempfile.mkdtemp(prefix='streaming_coco_', dir=self.output_path.parent))
+        self.annotations_file = open(self.temp_dir / 'annotations.json.part', 'w', encoding='utf-8')
+        self.pool = multiprocessing.Pool(self.n_workers)
+        self.pending_chunks = deque()
+        self.buffer = []
+        self.n_chunks = 0
+
+        self.skeleton = None
+        self.document_keys = None
+        self.indent = None
+        self.ensure_ascii = True
+        self.trailing = ''
+        self.images = []
+        self.n_annotations = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+    def add_tiles(self,
+                  tiles_paths: List[Path],
+                  polygons: List[List[Polygon]],
+                  scores: List[List[float]] or None = None,
+                  categories: List[List[int or str]] or None = None,
+                  other_attributes: List[List[dict]] or None = None):
+        """
+        Appends tiles and their polygons to the COCO file. The arguments have the same format as COCOGenerator's.
+        """
+        if categories is not None and self.coco_categories_list is None:
+            raise NotImplementedError("The categories ids of COCOGenerator depend on the categories found in each"
+                                      " chunk, please provide a coco_categories_list to stream categories.")
+
+        for i, tile_path in enumerate(tiles_paths):
+            self.buffer.append((tile_path,
+                                polygons[i],
+                                scores[i] if scores is not None else None,
+                                categories[i] if categories is not None else None,
+                                other_attributes[i] if other_attributes is not None else None))
+            if len(self.buffer) >= self.chunk_size:
+                self._submit_chunk()
+
+    def close(self):
+        if self.buffer:
+            self._submit_chunk()
+        while self.pending_chunks:
+            self._write_chunk(self.pending_chunks.popleft().get())
+        self.pool.close()
+        self.pool.join()
+        self.annotations_file.close()
+
+        if self.skeleton is None:
+            # No tiles at all, letting COCOGenerator write its empty document
+            self._generate_chunk_coco(self.temp_dir / 'empty.json', [])
+            shutil.move(self.temp_dir / 'empty.json', self.output_path)
+        else:
+            self._write_document()
+
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        print(f"Saved {len(self.images)} tiles and {self.n_annotations} annotations to {self.output_path}.")
+
+    def _abort(self):
+        self.pool.terminate()
+        self.annotations_file.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _submit_chunk(self):
+        chunk_path = self.temp_dir / f'chunk_{self.n_chunks}.json'
+        self.pending_chunks.append(self.pool.apply_async(self._encode_chunk, args=(self, chunk_path, self.buffer)))
+        self.buffer = []
+        self.n_chunks += 1
+
+        # Bounding the memory to the chunks being encoded, by writing the oldest ones as soon as they are ready
+        while len(self.pending_chunks) > 2 * self.n_workers or (self.pending_chunks and self.pending_chunks[0].ready()):
+            self._write_chunk(self.pending_chunks.popleft().get())
+
+    @staticmethod
+    def _encode_chunk(writer: 'StreamingCOCOWriter', chunk_path: Path, chunk: list) -> str:
+        writer._generate_chunk_coco(chunk_path, chunk)
+        text = chunk_path.read_text(encoding='utf-8')
+        chunk_path.unlink()
+        return text
+
+    def _generate_chunk_coco(self, chunk_path: Path, chunk: list):
+        has_scores = any(tile[2] is not None for tile in chunk)
+        has_categories = any(tile[3] is not None for tile in chunk)
+        has_other_attributes = any(tile[4] is not None for tile in chunk)
+        COCOGenerator(description=self.description,
+                      tiles_paths=[tile[0] for tile in chunk],
+                      polygons=[tile[1] for tile in chunk],
+                      scores=[tile[2] for tile in chunk] if has_scores else None,
+                      categories=[tile[3] for tile in chunk] if has_categories else None,
+                      other_attributes=[tile[4] for tile in chunk] if has_other_attributes else None,
+                      output_path=chunk_path,
+                      use_rle_for_labels=self.use_rle_for_labels,
+                      n_workers=1,
+                      coco_categories_list=self.coco_categories_list).generate_coco()
+
+    def __getstate__(self):
+        # Only the encoding parameters are needed by the worker processes
+        return {'description': self.description,
+                'use_rle_for_labels': self.use_rle_for_labels,
+                'coco_categories_list': self.coco_categories_list}
+
+    def _write_chunk(self, text: str):
+        chunk_coco = json.loads(text)
+        if self.skeleton is None:
+            self._detect_format(chunk_coco, text)
+            self.skeleton = {key: value for key, value in chunk_coco.items() if key not in ('images', 'annotations')}
+            self.document_keys = list(chunk_coco.keys())
+
+        images_offset = len(self.images)
+        for image in chunk_coco['images']:
+            image['id'] += images_offset
+            self.images.append(image)
+
+        annotations_offset = self.n_annotations
+        for annotation in chunk_coco['annotations']:
+            annotation['image_id'] += images_offset
+            if 'id' in annotation:
+                annotation['id'] += annotations_offset
+            self.annotations_file.write(',' if self.n_annotations > 0 else '')
+            self.annotations_file.write(self._dumps_list_item(annotation))
+            self.n_annotations += 1
+
+    def _detect_format(self, chunk_coco: dict, text: str):
+        for indent, ensure_ascii in self.FORMAT_CANDIDATES:
+            dumped = json.dumps(chunk_coco, indent=indent, ensure_ascii=ensure_ascii)
+            if text.startswith(dumped) and text[len(dumped):].strip() == '':
+                self.indent, self.ensure_ascii, self.trailing = indent, ensure_ascii, text[len(dumped):]
+                return
+
+        print(f"Warning: couldn't detect the json formatting of COCOGenerator, falling back to indent=2."
+              f" The output will be equivalent but not byte-compatible.")
+        self.indent, self.ensure_ascii, self.trailing = 2, True, ''
+
+    def _dumps_list_item(self, item) -> str:
+        # An element of a top-level list is nested 2 levels deep in the document
+        if self.indent is None:
+            return ' ' + json.dumps(item, ensure_ascii=self.ensure_ascii)
+        prefix = '\n' + ' ' * (2 * self.indent)
+        return prefix + json.dumps(item, indent=self.indent, ensure_ascii=self.ensure_ascii).replace('\n', prefix)
+
+    def _write_document(self):
+        with open(self.output_path, 'w', encoding='utf-8') as f:
+            f.write('{')
+            for i, key in enumerate(self.document_keys):
+                if i > 0:
+                    f.write(',')
+                f.write(' ' if self.indent is None and i > 0 else '')
+                if self.indent is not None:
+                    f.write('\n' + ' ' * self.indent)
+                f.write(json.dumps(key, ensure_ascii=self.ensure_ascii) + ': ')
+                if key == 'images':
+                    self._write_list(f, [self._dumps_list_item(image) for image in self.images])
+                elif key == 'annotations':
+                    self._write_annotations(f)
+                else:
+                    value_text = json.dumps(self.skeleton[key], indent=self.indent, ensure_ascii=self.ensure_ascii)
+                    if self.indent is not None:
+                        value_text = value_text.replace('\n', '\n' + ' ' * self.indent)
+                    f.write(value_text)
+            f.write('\n}' if self.indent is not None else '}')
+            f.write(self.trailing)
+
+    def _write_list(self, f, items_texts: List[str]):
+        if not items_texts:
+            f.write('[]')
+            return
+        f.write('[')
+        f.write(','.join(items_texts)[1 if self.indent is None else 0:])
+        f.write('\n' + ' ' * self.indent + ']' if self.indent is not None else ']')
+
+    def _write_annotations(self, f):
+        if self.n_annotations == 0:
+            f.write('[]')
+            return
+        f.write('[')
+        with open(self.temp_dir / 'annotations.json.part', 'r', encoding='utf-8') as annotations_file:
+            if self.indent is None:
+                annotations_file.read(1)  # the space of the first item
+            shutil.copyfileobj(annotations_file, f)
+        f.write('\n' + ' ' * self.indent + ']' if self.indent is not None else ']')
+
+
+def coco_to_tiles_attributes_df(coco_json_path: str or Path, images_directory: str or Path) -> pd.DataFrame:
+    """
+    Loads the tile, category and 'other_attributes' of each annotation of a COCO file, without decoding the
+    segmentations.
+    This is enough to map the tiles to the polygons they were created from, when the polygons ids were saved as
+    'other_attributes' by the tilerizer.
+
+    Parameters:
+    - coco_json_path (str or Path): The path of the COCO json file.
+    - images_directory (str or Path): The folder containing the tiles of the COCO file.
+
+    Returns:
+    - A DataFrame with 'tile_id', 'tile_path', 'category_id' and the 'other_attributes' columns, with one row per
+      annotation.
+    """
+    with open(coco_json_path, 'r') as f:
+        coco = json.load(f)
+
+    return _annotations_attributes_df(coco, images_directory)
+
+
+def _annotations_attributes_df(coco: dict, images_directory: str or Path) -> pd.DataFrame:
+    images_paths = {image['id']: str(Path(images_directory) / image['file_name']) for image in coco['images']}
+    annotations = coco['annotations']
+
+    other_attributes = [annotation.get('other_attributes') or {} for annotation in annotations]
+    other_attributes_names = list(dict.fromkeys(name for attributes in other_attributes for name in attributes))
+
+    return pd.DataFrame({
+        'tile_id': [annotation['image_id'] for annotation in annotations],
+        'tile_path': [images_paths[annotation['image_id']] for annotation in annotations],
+        'category_id': [annotation.get('category_id') for annotation in annotations],
+        **{name: [attributes.get(name) for attributes in other_attributes] for name in other_attributes_names},
+    })
+
+
+def coco_to_tiles_polygons_gdf(coco_json_path: str or Path, images_directory: str or Path) -> gpd.GeoDataFrame:
+    """
+    Loads the annotations of a COCO file as polygons in tile pixel coordinates, with one column per 'other_attributes'
+    key of the annotations. The RLE segmentations are decoded by batches of same-size masks (see
+    engine.utils.polygons.rle_segmentations_to_polygons) instead of one by one. The polygon segmentations made of
+    several parts are loaded as a MultiPolygon.
+
+    Parameters:
+    - coco_json_path (str or Path): The path of the COCO json file.
+    - images_directory (str or Path): The folder containing the tiles of the COCO file.
+
+    Returns:
+    - A GeoDataFrame with 'tile_id', 'tile_path', 'category_id' and the 'other_attributes' columns, without CRS.
+    """
+    with open(coco_json_path, 'r') as f:
+        coco = json.load(f)
+
+    annotations = coco['annotations']
+
+    polygons = [None] * len(annotations)
+    rle_ids = []
+    for i, annotation in enumerate(annotations):
+        segmentation = annotation['segmentation']
+        if isinstance(segmentation, dict):
+            rle_ids.append(i)
+        elif isinstance(segmentation, list) and len(segmentation) > 0:
+            parts = [Polygon(list(zip(part[::2], part[1::2]))) for part in segmentation]
+            polygons[i] = parts[0] if len(parts) == 1 else MultiPolygon(parts)
+        else:
+            raise NotImplementedError(f"Unsupported COCO segmentation format for annotation {annotation.get('id')}.")
+
+    for i, polygon in zip(rle_ids, rle_segmentations_to_polygons([annotations[i]['segmentation'] for i in rle_ids])):
+        polygons[i] = polygon
+
+    gdf = gpd.GeoDataFrame(_annotations_attributes_df(coco, images_directory), geometry=polygons)
+
+    return gdf
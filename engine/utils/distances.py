@@ -0,0 +1,202 @@
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import torch
+from scipy import sparse
+
+SUPPORTED_METRICS = ['euclidean', 'cosine']
+
+
+def _to_tensor(x: torch.Tensor or np.ndarray, device: torch.device) -> torch.Tensor:
+    if isinstance(x, np.ndarray):
+        x = torch.from_numpy(np.ascontiguousarray(x))
+    return x.to(device=device, dtype=torch.float32)
+
+
+def _l2_normalize(x: torch.Tensor) -> torch.Tensor:
+    return x / x.norm(dim=1, keepdim=True).clamp(min=1e-12)
+
+
+def pairwise_distances_block(x: torch.Tensor,
+                             y: torch.Tensor,
+                             metric: str = 'euclidean',
+                             x_sq_norms: torch.Tensor = None,
+                             y_sq_norms: torch.Tensor = None) -> torch.Tensor:
+    """
+    Computes the (len(x), len(y)) distances between two blocks of embeddings from their Gram matrix x @ y.T,
+    without the (len(x), len(y), D) broadcast of x[:, None] - y.
+
+    Parameters:
+    - x (torch.Tensor): The (N, D) embeddings. For the 'cosine' metric, they must be L2 normalized.
+    - y (torch.Tensor): The (M, D) embeddings. For the 'cosine' metric, they must be L2 normalized.
+    - metric (str): 'euclidean' or 'cosine' (1 - cosine similarity).
+    - x_sq_norms, y_sq_norms (torch.Tensor or None): The squared norms of the embeddings, if already computed.
+    """
+    if metric == 'cosine':
+        return (1 - x @ y.T).clamp_(min=0)
+
+    if x_sq_norms is None:
+        x_sq_norms = (x * x).sum(dim=1)
+    if y_sq_norms is None:
+        y_sq_norms = (y * y).sum(dim=1)
+
+    sq_distances = x_sq_norms[:, None] + y_sq_norms[None, :] - 2 * (x @ y.T)
+    return sq_distances.clamp_(min=0).sqrt_()
+
+
+def iter_pairwise_distances(x: torch.Tensor or np.ndarray,
+                            y: torch.Tensor or np.ndarray = None,
+                            metric: str = 'euclidean',
+                            device: torch.device = None,
+                            max_block_elements: int = 2 ** 24) -> Iterator[Tuple[int, torch.Tensor]]:
+    """
+    Iterates over the distances between x and y (or x and itself), by blocks of rows of x, so that at most
+    max_block_elements distances are in memory at once.
+
+    Parameters:
+    - x (torch.Tensor or np.ndarray): The (N, D) embeddings.
+    - y (torch.Tensor or np.ndarray or None): The (M, D) embeddings, x if None.
+    - metric (str): 'euclidean' or 'cosine'.
+    - device (torch.device or None): The device of the computations, the device of x if None.
+    - max_block_elements (int): The maximum number of distances per block.
+
+    Returns:
+    - An iterator of (row_start, distances), distances being the (rows, M) distances of x[row_start:row_start + rows].
+    """
+    if metric not in SUPPORTED_METRICS:
+        raise ValueError(f"Unsupported metric '{metric}', valid values are {SUPPORTED_METRICS}.")
+
+    device = device or (x.device if isinstance(x, torch.Tensor) else torch.device('cpu'))
+    x = _to_tensor(x, device)
+    y = x if y is None else _to_tensor(y, device)
+    if metric == 'cosine':
+        x = _l2_normalize(x)
+        y = x if y is x else _l2_normalize(y)
+
+    y_sq_norms = (y * y).sum(dim=1) if metric == 'euclidean' else None
+    rows_per_block = max(1, max_block_elements // max(1, len(y)))
+    for row_start in range(0, len(x), rows_per_block):
+        yield row_start, pairwise_distances_block(x[row_start:row_start + rows_per_block], y, metric=metric,
+                                                  y_sq_norms=y_sq_norms)
+
+
+def pairwise_distances_mean(x: torch.Tensor or np.ndarray,
+                            y: torch.Tensor or np.ndarray = None,
+                            metric: str = 'euclidean',
+                            device: torch.device = None,
+                            max_block_elements: int = 2 ** 24) -> float:
+    """
+    Returns the mean of all the distances between x and y (or x and itself, including the zero self-distances).
+    """
+    total = 0.
+    count = 0
+    for _, distances in iter_pairwise_distances(x, y, metric=metric, device=device,
+                                                max_block_elements=max_block_elements):
+        total += distances.sum(dtype=torch.float64).item()
+        count += distances.numel()
+
+    return total / count
+
+
+def pairwise_distances_top_k(x: torch.Tensor or np.ndarray,
+                             y: torch.Tensor or np.ndarray,
+                             k: int,
+                             largest: bool = False,
+                             metric: str = 'euclidean',
+                             device: torch.device = None,
+                             y_block_size: int = 65536) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns the k smallest (or largest) distances between each embedding of x and the embeddings of y, with their
+    indices in y. y is processed by blocks of y_block_size embeddings, so it can be a large NumPy array (even
+    memory-mapped) which is moved to the device one block at a time, the top-k of each block being merged with the
+    current one.
+
+    Returns:
+    - The (len(x), min(k, len(y))) sorted distances and indices, on the device.
+    """
+    if metric not in SUPPORTED_METRICS:
+        raise ValueError(f"Unsupported metric '{metric}', valid values are {SUPPORTED_METRICS}.")
+
+    device = device or (x.device if isinstance(x, torch.Tensor) else torch.device('cpu'))
+    x = _to_tensor(x, device)
+    if metric == 'cosine':
+        x = _l2_normalize(x)
+    x_sq_norms = (x * x).sum(dim=1) if metric == 'euclidean' else None
+
+    best_distances = torch.zeros((len(x), 0), device=device)
+    best_indices = torch.zeros((len(x), 0), dtype=torch.long, device=device)
+    for start in range(0, len(y), y_block_size):
+        block = _to_tensor(y[start:start + y_block_size], device)
+        if metric == 'cosine':
+            block = _l2_normalize(block)
+        distances = pairwise_distances_block(x, block, metric=metric, x_sq_norms=x_sq_norms)
+
+        distances = torch.cat([best_distances, distances], dim=1)
+        indices = torch.cat([best_indices,
+                             torch.arange(start, start + len(block), device=device).expand(len(x), -1)], dim=1)
+        best_distances, top_k = torch.topk(distances, k=min(k, distances.shape[1]), dim=1, largest=largest)
+        best_indices = torch.gather(indices, 1, top_k)
+
+    return best_distances, best_indices
+
+
+def pairwise_distances_quantiles(x: torch.Tensor or np.ndarray,
+                                 y: torch.Tensor or np.ndarray = None,
+                                 q: List[float] or float = 0.5,
+                                 metric: str = 'euclidean',
+                                 device: torch.device = None,
+                                 max_samples: int = 1000000,
+                                 max_block_elements: int = 2 ** 24,
+                                 seed: int = None) -> np.ndarray:
+    """
+    Estimates quantiles of the distances between x and y (or x and itself) from a uniform sample of at most
+    max_samples distances, drawn while streaming over the distances blocks: each distance gets a random key and the
+    max_samples distances with the smallest keys are kept (bottom-k sampling), so the memory is bounded whatever the
+    number of pairs. The quantiles are exact if there are fewer than max_samples distances.
+
+    Parameters:
+    - q (List[float] or float): The quantiles, in [0, 1].
+
+    Returns:
+    - The quantiles, with the shape of q.
+    """
+    generator = torch.Generator(device='cpu')
+    if seed is not None:
+        generator.manual_seed(seed)
+
+    sample_keys = None
+    sample_values = None
+    for _, distances in iter_pairwise_distances(x, y, metric=metric, device=device,
+                                                max_block_elements=max_block_elements):
+        values = distances.flatten()
+        keys = torch.rand(len(values), generator=generator).to(values.device)
+        if sample_keys is not None:
+            keys = torch.cat([sample_keys, keys])
+            values = torch.cat([sample_values, values])
+        if len(keys) > max_samples:
+            keys, kept = torch.topk(keys, k=max_samples, largest=False)
+            values = values[kept]
+        sample_keys, sample_values = keys, values
+
+    return np.quantile(sample_values.cpu().numpy(), q)
+
+
+def radius_neighbors_graph(x: torch.Tensor or np.ndarray,
+                           radius: float,
+                           metric: str = 'euclidean',
+                           device: torch.device = None,
+                           max_block_elements: int = 2 ** 24) -> sparse.csr_matrix:
+    """
+    Returns the sparse (N, N) matrix of the distances between the embeddings of x which are at most radius apart
+    (including each embedding and itself), built block by block. It can be given to DBSCAN with metric='precomputed'.
+    """
+    rows, cols, values = [], [], []
+    for row_start, distances in iter_pairwise_distances(x, metric=metric, device=device,
+                                                        max_block_elements=max_block_elements):
+        block_rows, block_cols = torch.nonzero(distances <= radius, as_tuple=True)
+        values.append(distances[block_rows, block_cols].cpu().numpy())
+        rows.append(block_rows.cpu().numpy() + row_start)
+        cols.append(block_cols.cpu().numpy())
+
+    n = len(x)
+    return sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n))
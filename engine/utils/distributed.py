@@ -0,0 +1,132 @@
+import os
+from datetime import timedelta
+from typing import Iterator
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+def init_distributed(backend: str = None, timeout_minutes: int = 120):
+    """
+    Initializes the default process group if the script was launched by torchrun (or any launcher setting the RANK,
+    WORLD_SIZE, LOCAL_RANK, MASTER_ADDR and MASTER_PORT environment variables) with more than one process.
+
+    Parameters:
+    - backend (str or None): The torch.distributed backend, 'nccl' if CUDA is available and 'gloo' otherwise if None.
+        'gloo' also works on CPU-only machines.
+    - timeout_minutes (int): The timeout of the collective operations, long enough for the other processes to wait
+        for the validation done by the main process.
+
+    Returns:
+    - The rank of the process, the number of processes and the device of the process.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1, torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    backend = backend or ('nccl' if torch.cuda.is_available() else 'gloo')
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available():
+        device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+
+    dist.init_process_group(backend=backend, timeout=timedelta(minutes=timeout_minutes))
+    rank = dist.get_rank()
+    print(f'Initialized process {rank}/{world_size} with the {backend} backend on {device}.')
+
+    return rank, world_size, device
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def all_gather_tensor(tensor: torch.Tensor) -> torch.Tensor:
+    """
+    Concatenates, along the first dimension, a tensor of the same shape from all the processes (no gradient flows
+    through the gathered tensor).
+    """
+    if not is_distributed():
+        return tensor
+
+    tensor = tensor.detach().contiguous()
+    gathered = [torch.empty_like(tensor) for _ in range(get_world_size())]
+    dist.all_gather(gathered, tensor)
+    return torch.cat(gathered)
+
+
+class DistributedBatchShardSampler(Sampler):
+    """
+    Shards the indices of a batch-structured sampler, like MPerClassSampler whose batches of batch_size indices each
+    hold m samples of a few classes, between the processes by whole batches, so every process keeps that structure.
+    All the processes draw the same indices with the same NumPy seed (the sampler must use np.random, as the
+    pytorch-metric-learning samplers do) and process i keeps the batches i, i + world_size, ... The batches left over
+    at the end are dropped, so all the processes do the same number of steps.
+
+    Parameters:
+    - sampler (Sampler): The sampler to shard, whose length is a multiple of batch_size.
+    - batch_size (int): The batch size of each process.
+    - rank (int or None): The rank of the process, the one of the default process group if None.
+    - world_size (int or None): The number of processes, the one of the default process group if None.
+    - seed (int): The seed of the sampler, it is offset by the epoch (see set_epoch).
+    """
+    def __init__(self,
+                 sampler: Sampler,
+                 batch_size: int,
+                 rank: int = None,
+                 world_size: int = None,
+                 seed: int = 0):
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+        self.seed = seed
+        self.epoch = 0
+
+        if not 0 <= self.rank < self.world_size:
+            raise ValueError(f"Invalid rank {self.rank} for a world size of {self.world_size}.")
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _n_batches_per_process(self) -> int:
+        return len(self.sampler) // self.batch_size // self.world_size
+
+    def __len__(self):
+        return self._n_batches_per_process() * self.batch_size
+
+    def __iter__(self) -> Iterator[int]:
+        # the global NumPy state is restored, so the other users of np.random are not affected
+        numpy_state = np.random.get_state()
+        np.random.seed(self.seed + self.epoch)
+        indices = list(iter(self.sampler))
+        np.random.set_state(numpy_state)
+
+        for batch in range(self.rank, self._n_batches_per_process() * self.world_size, self.world_size):
+            yield from indices[batch * self.batch_size:(batch + 1) * self.batch_size]
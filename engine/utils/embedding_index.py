@@ -0,0 +1,323 @@
+import json
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import numpy as np
+import torch
+from sklearn.cluster import MiniBatchKMeans
+
+from engine.utils.distances import SUPPORTED_METRICS, pairwise_distances_top_k
+
+
+class EmbeddingIndex(ABC):
+    """
+    Nearest neighbors index over embeddings, for kNN classification and retrieval against a reference library
+    which can grow over time (add), be saved and be reloaded without recomputing anything.
+
+    Parameters:
+    - metric (str): 'euclidean' or 'cosine' (1 - cosine similarity, as in sklearn).
+    - device (str or torch.device): The device of the distance computations, e.g. 'cuda'. The index itself is stored
+      in NumPy arrays on the CPU.
+    - block_size (int): The number of reference embeddings compared to a batch of queries at once, which bounds
+      the memory used by the (queries, block_size) distance matrices.
+    """
+    INDEX_TYPE = None
+
+    def __init__(self, metric: str = 'euclidean', device: str or torch.device = 'cpu', block_size: int = 65536):
+        if metric not in SUPPORTED_METRICS:
+            raise ValueError(f"Unsupported metric '{metric}', valid values are {SUPPORTED_METRICS}.")
+
+        self.metric = metric
+        self.device = torch.device(device)
+        self.block_size = block_size
+
+    def _prepare(self, embeddings: np.ndarray) -> np.ndarray:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2:
+            raise ValueError(f"Expected an (N, D) embeddings matrix, got shape {embeddings.shape}.")
+        if self.metric == 'cosine':
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings = embeddings / np.where(norms == 0, 1, norms)
+        return embeddings
+
+    def _blocked_top_k(self, queries: torch.Tensor, references: np.ndarray, k: int):
+        """
+        Returns the (distances, positions) of the k nearest references of each query, computing the distances from
+        the Gram matrix one block of references at a time and merging the top-k of each block with the current one.
+        """
+        return pairwise_distances_top_k(queries, references, k, metric=self.metric, device=self.device,
+                                        y_block_size=self.block_size)
+
+    @abstractmethod
+    def add(self, embeddings: np.ndarray, ids: np.ndarray = None):
+        """
+        Adds embeddings to the index. The ids default to consecutive integers following the ids already added.
+        """
+        pass
+
+    @abstractmethod
+    def search(self, queries: np.ndarray, k: int, batch_size: int = 4096):
+        """
+        Finds the k nearest neighbors of each query, batch_size queries at a time.
+
+        Returns:
+        - The (n_queries, k) distances, sorted in increasing order, and the (n_queries, k) ids of the neighbors.
+          If the index has fewer than k candidates for a query, the missing neighbors have an inf distance and a -1 id.
+        """
+        pass
+
+    @abstractmethod
+    def _get_arrays(self) -> dict:
+        pass
+
+    @abstractmethod
+    def _set_arrays(self, arrays: dict):
+        pass
+
+    def _get_params(self) -> dict:
+        return {'metric': self.metric, 'block_size': self.block_size}
+
+    def _next_ids(self, n: int, ids: np.ndarray or None) -> np.ndarray:
+        if ids is None:
+            start = int(self.ids.max()) + 1 if len(self.ids) else 0
+            return np.arange(start, start + n, dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) != n:
+            raise ValueError(f"Got {len(ids)} ids for {n} embeddings.")
+        return ids
+
+    def save(self, path: str or Path):
+        """
+        Saves the index to a .npz file.
+        """
+        metadata = {'index_type': self.INDEX_TYPE, 'params': self._get_params()}
+        np.savez(path, metadata=np.array(json.dumps(metadata)), **self._get_arrays())
+
+    @staticmethod
+    def load(path: str or Path, device: str or torch.device = 'cpu') -> 'EmbeddingIndex':
+        """
+        Loads an index saved by save, whatever its type.
+        """
+        with np.load(path) as data:
+            metadata = json.loads(str(data['metadata']))
+            index_classes = {index_class.INDEX_TYPE: index_class for index_class in [ExactEmbeddingIndex, IVFEmbeddingIndex]}
+            if metadata['index_type'] not in index_classes:
+                raise ValueError(f"Unknown index type '{metadata['index_type']}' in {path}.")
+            index = index_classes[metadata['index_type']](device=device, **metadata['params'])
+            index._set_arrays({key: data[key] for key in data.files if key != 'metadata'})
+
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class ExactEmbeddingIndex(EmbeddingIndex):
+    """
+    Brute-force index: the exact k nearest neighbors, computed by blocked matrix products (see EmbeddingIndex).
+    """
+    INDEX_TYPE = 'exact'
+
+    def __init__(self, metric: str = 'euclidean', device: str or torch.device = 'cpu', block_size: int = 65536):
+        super().__init__(metric=metric, device=device, block_size=block_size)
+        self.embeddings = np.zeros((0, 0), dtype=np.float32)
+        self.ids = np.zeros((0,), dtype=np.int64)
+
+    def add(self, embeddings: np.ndarray, ids: np.ndarray = None):
+        embeddings = self._prepare(embeddings)
+        ids = self._next_ids(len(embeddings), ids)
+        self.embeddings = np.concatenate([self.embeddings, embeddings]) if len(self.embeddings) else embeddings
+        self.ids = np.concatenate([self.ids, ids])
+
+    def search(self, queries: np.ndarray, k: int, batch_size: int = 4096):
+        queries = self._prepare(queries)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        if len(self) == 0:
+            return distances, ids
+
+        for start in range(0, len(queries), batch_size):
+            batch = torch.from_numpy(queries[start:start + batch_size]).to(self.device)
+            batch_distances, batch_positions = self._blocked_top_k(batch, self.embeddings, k)
+            n_found = batch_distances.shape[1]
+            distances[start:start + len(batch), :n_found] = batch_distances.cpu().numpy()
+            ids[start:start + len(batch), :n_found] = self.ids[batch_positions.cpu().numpy()]
+
+        return distances, ids
+
+    def _get_arrays(self) -> dict:
+        return {'embeddings': self.embeddings, 'ids': self.ids}
+
+    def _set_arrays(self, arrays: dict):
+        self.embeddings = arrays['embeddings']
+        self.ids = arrays['ids']
+
+
+class IVFEmbeddingIndex(EmbeddingIndex):
+    """
+    Approximate index with an inverted file (IVF): the embeddings are partitioned into n_lists clusters by k-means,
+    and a query is only compared to the embeddings of its n_probe nearest clusters, so a search costs about
+    n_probe / n_lists of an exact one. The clusters are learned by train (or by the first add, on its embeddings),
+    the next embeddings are only assigned to them.
+
+    Parameters:
+    - n_lists (int): The number of clusters, usually around sqrt(N).
+    - n_probe (int): The number of clusters searched per query, trading recall for speed.
+    """
+    INDEX_TYPE = 'ivf'
+
+    def __init__(self, metric: str = 'euclidean', device: str or torch.device = 'cpu', block_size: int = 65536,
+                 n_lists: int = 1024, n_probe: int = 16):
+        super().__init__(metric=metric, device=device, block_size=block_size)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+
+        self.centroids = None
+        self.lists_embeddings = []
+        self.lists_ids = []
+        self.ids = np.zeros((0,), dtype=np.int64)
+
+    def train(self, embeddings: np.ndarray, seed: int = 0):
+        embeddings = self._prepare(embeddings)
+        n_lists = min(self.n_lists, len(embeddings))
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=seed, n_init=3,
+                                 batch_size=max(1024, 4 * n_lists)).fit(embeddings)
+        self.centroids = self._prepare(kmeans.cluster_centers_)
+        self.lists_embeddings = [np.zeros((0, embeddings.shape[1]), dtype=np.float32) for _ in range(n_lists)]
+        self.lists_ids = [np.zeros((0,), dtype=np.int64) for _ in range(n_lists)]
+
+    def _nearest_lists(self, embeddings: np.ndarray, n: int, batch_size: int = 4096) -> np.ndarray:
+        nearest_lists = np.zeros((len(embeddings), min(n, len(self.centroids))), dtype=np.int64)
+        for start in range(0, len(embeddings), batch_size):
+            batch = torch.from_numpy(embeddings[start:start + batch_size]).to(self.device)
+            _, positions = self._blocked_top_k(batch, self.centroids, n)
+            nearest_lists[start:start + len(batch)] = positions.cpu().numpy()
+        return nearest_lists
+
+    def add(self, embeddings: np.ndarray, ids: np.ndarray = None):
+        if self.centroids is None:
+            self.train(embeddings)
+
+        embeddings = self._prepare(embeddings)
+        ids = self._next_ids(len(embeddings), ids)
+        lists = self._nearest_lists(embeddings, 1)[:, 0]
+
+        order = np.argsort(lists, kind='stable')
+        lists_ids, lists_starts = np.unique(lists[order], return_index=True)
+        for list_id, rows in zip(lists_ids, np.split(order, lists_starts[1:])):
+            self.lists_embeddings[list_id] = np.concatenate([self.lists_embeddings[list_id], embeddings[rows]])
+            self.lists_ids[list_id] = np.concatenate([self.lists_ids[list_id], ids[rows]])
+        self.ids = np.concatenate([self.ids, ids])
+
+    def search(self, queries: np.ndarray, k: int, batch_size: int = 4096):
+        queries = self._prepare(queries)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        if len(self) == 0:
+            return distances, ids
+
+        # the queries are grouped by probed list, so each list is compared to all its queries with one matmul
+        probed_lists = self._nearest_lists(queries, self.n_probe, batch_size=batch_size)
+        queries_positions = np.repeat(np.arange(len(queries)), probed_lists.shape[1])
+        probed_lists = probed_lists.ravel()
+        order = np.argsort(probed_lists, kind='stable')
+        lists_ids, lists_starts = np.unique(probed_lists[order], return_index=True)
+
+        for list_id, list_queries in zip(lists_ids, np.split(queries_positions[order], lists_starts[1:])):
+            if len(self.lists_ids[list_id]) == 0:
+                continue
+            for start in range(0, len(list_queries), batch_size):
+                batch_queries = list_queries[start:start + batch_size]
+                batch = torch.from_numpy(queries[batch_queries]).to(self.device)
+                batch_distances, batch_positions = self._blocked_top_k(batch, self.lists_embeddings[list_id], k)
+
+                # merging with the neighbors found in the previously searched lists
+                merged_distances = np.concatenate([distances[batch_queries], batch_distances.cpu().numpy()], axis=1)
+                merged_ids = np.concatenate([ids[batch_queries], self.lists_ids[list_id][batch_positions.cpu().numpy()]],
+                                            axis=1)
+                top_k = np.argsort(merged_distances, axis=1, kind='stable')[:, :k]
+                distances[batch_queries] = np.take_along_axis(merged_distances, top_k, axis=1)
+                ids[batch_queries] = np.take_along_axis(merged_ids, top_k, axis=1)
+
+        return distances, ids
+
+    def _get_params(self) -> dict:
+        return {**super()._get_params(), 'n_lists': self.n_lists, 'n_probe': self.n_probe}
+
+    def _get_arrays(self) -> dict:
+        if self.centroids is None:
+            return {'ids': self.ids}
+        lists_sizes = np.array([len(list_ids) for list_ids in self.lists_ids], dtype=np.int64)
+        return {'centroids': self.centroids,
+                'lists_sizes': lists_sizes,
+                'lists_embeddings': np.concatenate(self.lists_embeddings),
+                'lists_ids': np.concatenate(self.lists_ids),
+                'ids': self.ids}
+
+    def _set_arrays(self, arrays: dict):
+        self.ids = arrays['ids']
+        if 'centroids' not in arrays:
+            return
+        self.centroids = arrays['centroids']
+        splits = np.cumsum(arrays['lists_sizes'])[:-1]
+        self.lists_embeddings = np.split(arrays['lists_embeddings'], splits)
+        self.lists_ids = np.split(arrays['lists_ids'], splits)
+
+
+class EmbeddingKNNClassifier:
+    """
+    k nearest neighbors classifier (majority vote, like sklearn's KNeighborsClassifier with uniform weights) backed
+    by an EmbeddingIndex, so it scales to large reference libraries and can be extended with add without refitting.
+
+    Parameters:
+    - n_neighbors (int): The number of neighbors voting for the label of a query.
+    - metric (str): 'euclidean' or 'cosine'.
+    - index_type (str): 'exact' or 'ivf'.
+    - index_params: The other parameters of the index (device, block_size, n_lists, n_probe...).
+    """
+    def __init__(self, n_neighbors: int = 5, metric: str = 'euclidean', index_type: str = 'exact', **index_params):
+        if index_type == ExactEmbeddingIndex.INDEX_TYPE:
+            self.index = ExactEmbeddingIndex(metric=metric, **index_params)
+        elif index_type == IVFEmbeddingIndex.INDEX_TYPE:
+            self.index = IVFEmbeddingIndex(metric=metric, **index_params)
+        else:
+            raise ValueError(f"Unknown index type '{index_type}', valid values are ['exact', 'ivf'].")
+
+        self.n_neighbors = n_neighbors
+        self.classes_ = np.zeros((0,))
+        self.labels_ids = np.zeros((0,), dtype=np.int64)
+
+    def fit(self, embeddings: np.ndarray, labels: np.ndarray):
+        self.classes_ = np.zeros((0,))
+        self.labels_ids = np.zeros((0,), dtype=np.int64)
+        self.index = type(self.index)(**{**self.index._get_params(), 'device': self.index.device})
+        return self.add(embeddings, labels)
+
+    def add(self, embeddings: np.ndarray, labels: np.ndarray):
+        """
+        Adds labeled embeddings to the reference library.
+        """
+        labels = np.asarray(labels)
+        classes = np.unique(np.concatenate([self.classes_, labels]) if len(self.classes_) else labels)
+        if len(self.classes_) and not np.array_equal(classes, self.classes_):
+            # keeping the classes sorted, so ties are broken towards the smallest label like sklearn
+            self.labels_ids = np.searchsorted(classes, self.classes_[self.labels_ids])
+        self.classes_ = classes
+
+        self.index.add(embeddings, ids=np.arange(len(self.labels_ids), len(self.labels_ids) + len(labels)))
+        self.labels_ids = np.concatenate([self.labels_ids, np.searchsorted(self.classes_, labels)])
+        return self
+
+    def kneighbors(self, embeddings: np.ndarray, batch_size: int = 4096):
+        return self.index.search(embeddings, k=self.n_neighbors, batch_size=batch_size)
+
+    def predict(self, embeddings: np.ndarray, batch_size: int = 4096) -> np.ndarray:
+        _, neighbors_ids = self.kneighbors(embeddings, batch_size=batch_size)
+        found = neighbors_ids >= 0
+        neighbors_labels = self.labels_ids[np.where(found, neighbors_ids, 0)]
+
+        votes = np.zeros((len(neighbors_labels), len(self.classes_)), dtype=np.int64)
+        rows = np.repeat(np.arange(len(neighbors_labels)), neighbors_labels.shape[1])
+        np.add.at(votes, (rows, neighbors_labels.ravel()), found.ravel())
+
+        return self.classes_[np.argmax(votes, axis=1)]
@@ -0,0 +1,149 @@
+import os
+import shutil
+from pathlib import Path
+from typing import List
+
+import geopandas as gpd
+import numpy as np
+
+EMBEDDINGS_COLUMNS_PREFIX = 'embeddings'
+POLYGON_ID_COLUMN = 'polygon_id'
+
+
+def get_embeddings_store_path(geopackage_path: str or Path, column_name: str) -> Path:
+    """
+    Returns the path of the embeddings store of a geopackage column, saved next to the geopackage.
+    """
+    geopackage_path = Path(geopackage_path)
+    return geopackage_path.parent / f"{geopackage_path.stem}_{column_name}.npy"
+
+
+def _get_polygon_ids_path(store_path: Path) -> Path:
+    return store_path.parent / f"{store_path.stem}_{POLYGON_ID_COLUMN}.npy"
+
+
+def save_embeddings_store(store_path: str or Path,
+                          embeddings: np.ndarray,
+                          polygon_ids: np.ndarray,
+                          dtype: np.dtype = np.float32):
+    """
+    Saves an (N, D) embeddings matrix as a binary .npy file, with the polygon_id of each row in a second .npy file.
+
+    Parameters:
+    - store_path (str or Path): The path of the embeddings .npy file.
+    - embeddings (np.ndarray): The (N, D) embeddings.
+    - polygon_ids (np.ndarray): The N polygon ids, in the same order as the embeddings rows.
+    - dtype (np.dtype): The dtype of the stored embeddings, np.float32 or np.float16 to halve the size.
+    """
+    embeddings = np.asarray(embeddings)
+    if embeddings.ndim != 2 or len(embeddings) != len(polygon_ids):
+        raise ValueError(f"Expected an (N, D) embeddings matrix with N={len(polygon_ids)} polygon ids,"
+                         f" got shape {embeddings.shape}.")
+
+    store_path = Path(store_path)
+    np.save(store_path, embeddings.astype(dtype, copy=False))
+    np.save(_get_polygon_ids_path(store_path), np.asarray(polygon_ids, dtype=np.int64))
+
+
+def load_embeddings_store(store_path: str or Path):
+    """
+    Loads an embeddings store saved by save_embeddings_store. The matrix is memory-mapped, so nothing is read
+    from disk until the rows are accessed.
+
+    Returns:
+    - The (N, D) read-only memory-mapped embeddings and the N polygon ids of its rows.
+    """
+    store_path = Path(store_path)
+    embeddings = np.load(store_path, mmap_mode='r')
+    polygon_ids = np.load(_get_polygon_ids_path(store_path))
+
+    return embeddings, polygon_ids
+
+
+def gdf_embeddings_to_stores(gdf: gpd.GeoDataFrame,
+                             geopackage_path: str or Path,
+                             dtype: np.dtype = np.float32) -> gpd.GeoDataFrame:
+    """
+    Moves the embeddings columns (the columns starting with 'embeddings') of a GeoDataFrame to binary stores saved
+    next to its geopackage, keyed by its 'polygon_id' column, instead of writing them as stringified lists.
+
+    Parameters:
+    - gdf (gpd.GeoDataFrame): The GeoDataFrame, with a 'polygon_id' column and embeddings columns of lists or arrays.
+    - geopackage_path (str or Path): The path of the geopackage the GeoDataFrame will be saved to.
+    - dtype (np.dtype): The dtype of the stored embeddings.
+
+    Returns:
+    - The GeoDataFrame without its embeddings columns, ready to be saved to the geopackage.
+    """
+    if POLYGON_ID_COLUMN not in gdf.columns:
+        raise ValueError(f"The GeoDataFrame must have a '{POLYGON_ID_COLUMN}' column to key the embeddings.")
+
+    embeddings_columns = [column for column in gdf.columns if column.startswith(EMBEDDINGS_COLUMNS_PREFIX)]
+    for column in embeddings_columns:
+        store_path = get_embeddings_store_path(geopackage_path, column)
+        save_embeddings_store(store_path,
+                              embeddings=np.stack(gdf[column].to_numpy()),
+                              polygon_ids=gdf[POLYGON_ID_COLUMN].to_numpy(),
+                              dtype=dtype)
+        print(f"Saved the '{column}' embeddings at {store_path}.")
+
+    return gdf.drop(columns=embeddings_columns)
+
+
+def link_embeddings_stores(source_geopackage_path: str or Path,
+                           target_geopackage_path: str or Path,
+                           columns_names: List[str]):
+    """
+    Makes the embeddings stores of a geopackage available to another geopackage with the same polygon ids,
+    with hard links when possible to avoid copying the matrices.
+    """
+    for column in columns_names:
+        source_store_path = get_embeddings_store_path(source_geopackage_path, column)
+        target_store_path = get_embeddings_store_path(target_geopackage_path, column)
+        for source_path, target_path in [(source_store_path, target_store_path),
+                                         (_get_polygon_ids_path(source_store_path), _get_polygon_ids_path(target_store_path))]:
+            if target_path.exists():
+                target_path.unlink()
+            try:
+                os.link(source_path, target_path)
+            except OSError:
+                shutil.copyfile(source_path, target_path)
+
+
+def get_embeddings_columns_names(geopackage_path: str or Path) -> List[str]:
+    """
+    Returns the names of the embeddings columns stored next to a geopackage.
+    """
+    geopackage_path = Path(geopackage_path)
+    prefix = f"{geopackage_path.stem}_"
+    return sorted(path.stem[len(prefix):] for path in geopackage_path.parent.glob(f"{prefix}{EMBEDDINGS_COLUMNS_PREFIX}*.npy")
+                  if not path.stem.endswith(f"_{POLYGON_ID_COLUMN}"))
+
+
+def load_gdf_embeddings(gdf: gpd.GeoDataFrame, geopackage_path: str or Path, column_name: str) -> np.ndarray:
+    """
+    Loads the embeddings of the polygons of a GeoDataFrame read from a geopackage, from its embeddings store.
+
+    Parameters:
+    - gdf (gpd.GeoDataFrame): The GeoDataFrame, with a 'polygon_id' column.
+    - geopackage_path (str or Path): The path of the geopackage the GeoDataFrame was read from.
+    - column_name (str): The name of the embeddings column, e.g. 'embeddings_dinov2'.
+
+    Returns:
+    - The (len(gdf), D) embeddings, in the order of the GeoDataFrame rows. This is the memory-mapped store itself
+      (zero-copy) when the GeoDataFrame rows are in the store order, and a copy of the selected rows otherwise.
+    """
+    embeddings, polygon_ids = load_embeddings_store(get_embeddings_store_path(geopackage_path, column_name))
+    gdf_polygon_ids = gdf[POLYGON_ID_COLUMN].to_numpy()
+
+    if len(gdf_polygon_ids) == len(polygon_ids) and np.array_equal(gdf_polygon_ids, polygon_ids):
+        return embeddings
+
+    sorter = np.argsort(polygon_ids)
+    positions = np.searchsorted(polygon_ids, gdf_polygon_ids, sorter=sorter)
+    positions = np.clip(positions, 0, len(polygon_ids) - 1)
+    rows = sorter[positions]
+    if not np.array_equal(polygon_ids[rows], gdf_polygon_ids):
+        raise ValueError(f"Some polygon ids of the GeoDataFrame are not in the '{column_name}' embeddings store.")
+
+    return embeddings[rows]
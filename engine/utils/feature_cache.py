@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+
+def module_fingerprint(module: torch.nn.Module) -> str:
+    """
+    Returns a hash of the names, shapes, dtypes and values of the parameters and buffers of a module (including the
+    non-persistent buffers, like the input normalization of the contrastive models), to identify a frozen backbone.
+    """
+    sha = hashlib.sha256()
+    for name, tensor in list(module.named_parameters()) + list(module.named_buffers()):
+        tensor = tensor.detach().cpu().contiguous()
+        sha.update(f'{name}:{tuple(tensor.shape)}:{tensor.dtype};'.encode())
+        sha.update(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()
+
+
+def _samples_ids_hash(samples_ids: list) -> str:
+    return hashlib.sha256(json.dumps([str(sample_id) for sample_id in samples_ids]).encode()).hexdigest()
+
+
+def _get_metadata_path(cache_path: Path) -> Path:
+    return cache_path.with_suffix('.json')
+
+
+def _get_cache_mismatch(cache_path: Path, metadata: dict) -> str or None:
+    metadata_path = _get_metadata_path(cache_path)
+    if not metadata_path.exists():
+        return f'there is no metadata file {metadata_path}'
+
+    with open(metadata_path, 'r') as f:
+        cached_metadata = json.load(f)
+    for key, value in metadata.items():
+        if cached_metadata.get(key) != value:
+            return f"its {key} doesn't match"
+
+    features = np.load(cache_path, mmap_mode='r')
+    if list(features.shape) != cached_metadata.get('feature_shape') or features.dtype.str != metadata['dtype']:
+        return f'its {features.dtype} features of shape {features.shape} don\'t match its metadata'
+
+    return None
+
+
+def build_features_cache(feature_extractor: Callable[[tuple], torch.Tensor],
+                         data_loader: DataLoader,
+                         n_samples: int,
+                         cache_path: Path,
+                         backbone_id: str,
+                         samples_ids: list,
+                         dtype: np.dtype = np.float16,
+                         desc: str = 'Caching backbone features...') -> Path:
+    """
+    Runs a frozen backbone once on all the samples of a data loader and stores the features in a memory-mapped .npy
+    file, so that a head can be trained directly from the cached features. The file is written under a temporary
+    name and renamed once complete, with a .json metadata file next to it (backbone id, hash of the samples ids,
+    dtype and features shape). An existing cache is reused only if all its metadata match, and rebuilt otherwise.
+
+    Parameters:
+    - feature_extractor (Callable): Returns the (B, ...) features of a batch of the data loader.
+    - data_loader (DataLoader): The data loader of the samples, which must not be shuffled nor augmented.
+    - n_samples (int): The number of samples of the data loader.
+    - cache_path (Path): The path of the .npy file.
+    - backbone_id (str): Identifies the backbone and its preprocessing, see module_fingerprint.
+    - samples_ids (list): The id of each sample of the data loader (a tile path for example), in order.
+    - dtype (np.dtype): The dtype of the stored features.
+
+    Returns:
+    - The path of the cache.
+    """
+    if len(samples_ids) != n_samples:
+        raise ValueError(f'Got {len(samples_ids)} samples ids for {n_samples} samples.')
+
+    cache_path = Path(cache_path)
+    metadata_path = _get_metadata_path(cache_path)
+    metadata = {
+        'backbone_id': backbone_id,
+        'n_samples': n_samples,
+        'samples_ids_hash': _samples_ids_hash(samples_ids),
+        'dtype': np.dtype(dtype).str
+    }
+
+    if cache_path.exists():
+        mismatch = _get_cache_mismatch(cache_path, metadata)
+        if mismatch is None:
+            print(f'Reusing the features cached in {cache_path}.')
+            return cache_path
+        print(f'The features cached in {cache_path} can\'t be reused as {mismatch}, rebuilding it.')
+    if metadata_path.exists():
+        metadata_path.unlink()
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_cache_path = cache_path.with_name(cache_path.stem + '_tmp.npy')
+
+    features = None
+    row = 0
+    with torch.no_grad():
+        for batch in tqdm(data_loader, desc=desc):
+            batch_features = feature_extractor(batch).float().cpu().numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(tmp_cache_path, mode='w+', dtype=dtype,
+                                                     shape=(n_samples,) + batch_features.shape[1:])
+            features[row:row + len(batch_features)] = batch_features
+            row += len(batch_features)
+
+    if row != n_samples:
+        raise ValueError(f'The data loader returned {row} samples, expected {n_samples}.')
+
+    features.flush()
+    metadata['feature_shape'] = list(features.shape)
+    del features
+    os.replace(tmp_cache_path, cache_path)
+    with open(metadata_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    print(f'Cached the features of {n_samples} samples in {cache_path}.')
+
+    return cache_path
+
+
+class MemmapFeatures:
+    """
+    Read-only access to the features of a cache built by build_features_cache. The file is memory-mapped lazily, so
+    that the DataLoader workers each open it instead of receiving a copy of the features.
+    """
+    def __init__(self, cache_path: Path):
+        self.cache_path = Path(cache_path)
+        self._features = None
+
+    @property
+    def features(self) -> np.ndarray:
+        if self._features is None:
+            self._features = np.load(self.cache_path, mmap_mode='r')
+        return self._features
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_features'] = None
+        return state
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        return np.asarray(self.features[idx], dtype=np.float32)
+
+
+class CachedFeaturesDataset:
+    """
+    Dataset of (features, label) items, the features of sample idx being row idx of the cache.
+    """
+    def __init__(self, cache_path: Path, labels: list):
+        self.features = MemmapFeatures(cache_path)
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx: int):
+        return self.features[idx], self.labels[idx]
@@ -0,0 +1,32 @@
+from pathlib import Path
+
+import geopandas as gpd
+
+from engine.utils.embeddings_store import EMBEDDINGS_COLUMNS_PREFIX
+
+
+def write_geopackage(gdf: gpd.GeoDataFrame, output_path: str or Path):
+    """
+    Writes a GeoDataFrame to a geopackage in a single bulk write, through pyogrio's Arrow writer when the installed
+    GDAL supports it. The R-tree spatial index is built by GDAL while the layer is written, so the file is ready to be
+    queried spatially (QGIS, gpd.read_file(bbox=...)) without an extra indexing pass.
+
+    The embeddings columns must be externalized to binary stores beforehand
+    (see engine.utils.embeddings_store.gdf_embeddings_to_stores), they are not written to the geopackage.
+
+    Parameters:
+    - gdf (gpd.GeoDataFrame): The GeoDataFrame to save.
+    - output_path (str or Path): The path of the output .gpkg file.
+    """
+    embeddings_columns = [column for column in gdf.columns if column.startswith(EMBEDDINGS_COLUMNS_PREFIX)]
+    if embeddings_columns:
+        print(f"Warning: the embeddings columns {embeddings_columns} are not saved to the geopackage,"
+              f" please save them with engine.utils.embeddings_store.gdf_embeddings_to_stores.")
+        gdf = gdf.drop(columns=embeddings_columns)
+
+    try:
+        gdf.to_file(output_path, driver='GPKG', engine='pyogrio', use_arrow=True, SPATIAL_INDEX='YES')
+    except RuntimeError as e:
+        # pyogrio needs GDAL >= 3.8 to write from Arrow
+        print(f"Couldn't write {output_path} with the Arrow writer ({e}), falling back to the default writer.")
+        gdf.to_file(output_path, driver='GPKG', engine='pyogrio', SPATIAL_INDEX='YES')
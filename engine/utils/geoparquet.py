@@ -0,0 +1,178 @@
+import json
+from pathlib import Path
+from typing import List, Dict
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import shapely
+from geodataset.utils import CocoNameConvention
+from shapely.geometry import Polygon
+
+from engine.utils.coco import StreamingCOCOWriter
+from engine.utils.polygons import tiles_polygons_gdf_to_crs_gdf
+
+GEOPARQUET_SUFFIX = '.parquet'
+TILES_COLUMNS = ['tile_id', 'tile_path']
+
+
+def is_geoparquet_path(path: str or Path) -> bool:
+    return Path(path).suffix == GEOPARQUET_SUFFIX
+
+
+def create_geoparquet_name(product_name: str, fold: str, scale_factor: float = None, ground_resolution: float = None):
+    """
+    Creates a GeoParquet file name following the same convention as the COCO files, with a .parquet extension.
+    """
+    coco_name = CocoNameConvention.create_name(product_name=product_name,
+                                               fold=fold,
+                                               scale_factor=scale_factor,
+                                               ground_resolution=ground_resolution)
+    return str(Path(coco_name).with_suffix(GEOPARQUET_SUFFIX))
+
+
+def parse_geoparquet_name(geoparquet_name: str):
+    """
+    Parses a GeoParquet file name created by create_geoparquet_name.
+
+    Returns:
+    - The product_name, scale_factor, ground_resolution and fold, like CocoNameConvention.parse_name.
+    """
+    return CocoNameConvention.parse_name(Path(geoparquet_name).with_suffix('.json').name)
+
+
+def tiles_polygons_to_geoparquet(output_path: str or Path,
+                                 tiles_paths: List[Path],
+                                 polygons: List[List[Polygon]],
+                                 polygons_scores: Dict[str, List[List[float]]] or None = None):
+    """
+    Saves the polygons of each tile, in tile pixel coordinates, to a columnar GeoParquet file (WKB geometries),
+    with one row per polygon and its tile id, tile path and scores columns.
+    This is the intermediate format between the pipeline stages, replacing COCO files which have to be fully
+    parsed and RLE decoded again by the next stage.
+
+    Parameters:
+    - output_path (str or Path): The path of the output .parquet file.
+    - tiles_paths (List[Path]): The paths of the tiles.
+    - polygons (List[List[Polygon]]): The polygons of each tile, in tile pixel coordinates.
+    - polygons_scores (Dict[str, List[List[float]]] or None): The scores of each polygon of each tile, by score name.
+    """
+    n_polygons_per_tile = [len(tile_polygons) for tile_polygons in polygons]
+    tile_ids = np.repeat(np.arange(len(tiles_paths)), n_polygons_per_tile)
+    tiles_paths_str = np.array([str(tile_path) for tile_path in tiles_paths], dtype=object)
+
+    columns = {
+        'tile_id': tile_ids,
+        'tile_path': tiles_paths_str[tile_ids] if len(tile_ids) > 0 else [],
+    }
+    if polygons_scores:
+        for score_name, tiles_scores in polygons_scores.items():
+            columns[score_name] = [score for tile_scores in tiles_scores for score in tile_scores]
+
+    gdf = gpd.GeoDataFrame(columns, geometry=[polygon for tile_polygons in polygons for polygon in tile_polygons])
+    gdf.to_parquet(output_path, index=False)
+
+    return gdf
+
+
+def geoparquet_to_tiles_polygons(geoparquet_path: str or Path):
+    """
+    Loads a GeoParquet file saved by tiles_polygons_to_geoparquet.
+
+    Returns:
+    - The tiles paths, the polygons of each tile and the scores of each polygon of each tile by score name,
+      in the format expected by aggregator_main_with_polygons_input.
+    """
+    gdf = gpd.read_parquet(geoparquet_path)
+    scores_names = [column for column in gdf.columns if column not in TILES_COLUMNS and column != gdf.geometry.name]
+
+    tiles_paths = []
+    polygons = []
+    polygons_scores = {score_name: [] for score_name in scores_names}
+    for _, tile_gdf in gdf.groupby('tile_id', sort=True):
+        tiles_paths.append(Path(tile_gdf['tile_path'].iloc[0]))
+        polygons.append(list(tile_gdf.geometry))
+        for score_name in scores_names:
+            polygons_scores[score_name].append(tile_gdf[score_name].tolist())
+
+    return tiles_paths, polygons, polygons_scores
+
+
+def geoparquet_to_crs_gdf(geoparquet_path: str or Path) -> gpd.GeoDataFrame:
+    """
+    Loads a GeoParquet file and converts its polygons from tile pixel coordinates to the CRS of the tiles.
+    """
+    gdf = gpd.read_parquet(geoparquet_path)
+    if gdf.crs is None and 'tile_path' in gdf.columns:
+        gdf = tiles_polygons_gdf_to_crs_gdf(gdf)
+
+    return gdf
+
+
+def iter_geoparquet_tiles(geoparquet_path: str or Path, batch_size: int = 65536):
+    """
+    Iterates over the tiles of a GeoParquet file saved by tiles_polygons_to_geoparquet, reading it by batches of
+    batch_size rows, so that only the polygons of one batch are decoded and held in memory at a time.
+    The rows are expected to be sorted by tile id, as tiles_polygons_to_geoparquet writes them.
+
+    Returns:
+    - An iterator of (tile_path, tile_polygons, tile_polygons_scores) tuples, tile_polygons_scores being a dict of
+      the scores of each polygon of the tile by score name.
+    """
+    parquet_file = pq.ParquetFile(geoparquet_path)
+    geometry_column = json.loads(parquet_file.schema_arrow.metadata[b'geo'])['primary_column']
+    scores_names = [name for name in parquet_file.schema_arrow.names
+                    if name not in TILES_COLUMNS and name != geometry_column]
+
+    def tile_rows_to_tile(tile_df):
+        return (Path(tile_df['tile_path'].iloc[0]),
+                list(shapely.from_wkb(tile_df[geometry_column].to_numpy())),
+                {score_name: tile_df[score_name].tolist() for score_name in scores_names})
+
+    previous_tile_id = None
+    pending_tile_dfs = []
+    for record_batch in parquet_file.iter_batches(batch_size=batch_size):
+        batch_df = record_batch.to_pandas()
+        for tile_id, tile_df in batch_df.groupby('tile_id', sort=False):
+            if previous_tile_id is not None and tile_id != previous_tile_id:
+                if tile_id < previous_tile_id:
+                    raise ValueError(f"The rows of {geoparquet_path} are not sorted by tile id.")
+                yield tile_rows_to_tile(pd.concat(pending_tile_dfs))
+                pending_tile_dfs = []
+            # The last tile of a batch can continue in the next one
+            pending_tile_dfs.append(tile_df)
+            previous_tile_id = tile_id
+
+    if pending_tile_dfs:
+        yield tile_rows_to_tile(pd.concat(pending_tile_dfs))
+
+
+def geoparquet_to_coco(geoparquet_path: str or Path,
+                       coco_output_path: str or Path,
+                       description: str,
+                       n_workers: int = 5,
+                       batch_size: int = 65536):
+    """
+    Exports a GeoParquet file saved by tiles_polygons_to_geoparquet to a COCO file, for training purposes.
+    The scores are saved as 'other_attributes' of the annotations.
+    The GeoParquet file is read by batches of batch_size rows and each tile is handed to the streaming COCO writer
+    as soon as it is read, so the polygons of the whole file are never held in memory at once.
+    """
+    with StreamingCOCOWriter(output_path=Path(coco_output_path),
+                             description=description,
+                             use_rle_for_labels=True,
+                             n_workers=n_workers,
+                             coco_categories_list=None) as coco_writer:
+        for tile_path, tile_polygons, tile_polygons_scores in iter_geoparquet_tiles(geoparquet_path,
+                                                                                    batch_size=batch_size):
+            other_attributes = [{score_name: tile_polygons_scores[score_name][j]
+                                 for score_name in tile_polygons_scores}
+                                for j in range(len(tile_polygons))]
+            coco_writer.add_tiles(tiles_paths=[tile_path],
+                                  polygons=[tile_polygons],
+                                  scores=None,
+                                  categories=None,
+                                  other_attributes=[other_attributes] if tile_polygons_scores else None)
+
+    return coco_output_path
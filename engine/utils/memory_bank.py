@@ -0,0 +1,142 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from engine.utils.distances import SUPPORTED_METRICS, pairwise_distances_block
+
+
+class EmbeddingMemoryBank:
+    """
+    Embeddings of all the samples of a training set, kept on the training device and refreshed as the samples pass
+    through the model: the embedding of a sample already in the bank is updated with a momentum (exponential moving
+    average), which smooths the drift of the model between two visits of the sample, the others are just stored.
+    It can be queried for hard cross-batch references (the closest samples of other labels and the farthest samples
+    of the same labels) for the miners, or give the embeddings of the whole training set without re-inferring it.
+
+    Parameters:
+    - n_samples (int): The number of samples of the training set, which are indexed from 0 to n_samples - 1.
+    - embedding_size (int): The size of the embeddings.
+    - momentum (float): The bank embedding of a sample becomes momentum * bank + (1 - momentum) * new.
+    - labels (np.ndarray or torch.Tensor or None): The integer label of each sample, needed by get_hard_references.
+    - metric (str): The distance of get_hard_references, 'euclidean' or 'cosine'.
+    - normalize (bool): Whether to L2 normalize the embeddings stored in the bank.
+    - device (torch.device): The device of the bank.
+    """
+    def __init__(self,
+                 n_samples: int,
+                 embedding_size: int,
+                 momentum: float,
+                 labels: np.ndarray or torch.Tensor = None,
+                 metric: str = 'euclidean',
+                 normalize: bool = False,
+                 device: torch.device = torch.device('cpu')):
+        if not 0 <= momentum < 1:
+            raise ValueError(f"The momentum should be in [0, 1), got {momentum}.")
+        if metric not in SUPPORTED_METRICS:
+            raise ValueError(f"Unsupported metric '{metric}', valid values are {SUPPORTED_METRICS}.")
+
+        self.momentum = momentum
+        self.metric = metric
+        self.normalize = normalize
+        self.device = torch.device(device)
+
+        self.embeddings = torch.zeros((n_samples, embedding_size), dtype=torch.float32, device=self.device)
+        self.initialized = torch.zeros(n_samples, dtype=torch.bool, device=self.device)
+        self.labels = None if labels is None else torch.as_tensor(labels, device=self.device).long()
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    @torch.no_grad()
+    def update(self, indices: torch.Tensor or np.ndarray, embeddings: torch.Tensor):
+        """
+        Updates the bank embeddings of the samples of indices with their new embeddings (no gradient flows through
+        the bank).
+        """
+        indices = torch.as_tensor(indices, device=self.device).long()
+        embeddings = embeddings.detach().to(self.device, dtype=torch.float32)
+        if self.normalize:
+            embeddings = F.normalize(embeddings, dim=1)
+
+        initialized = self.initialized[indices].unsqueeze(1)
+        updated = torch.where(initialized,
+                              self.momentum * self.embeddings[indices] + (1 - self.momentum) * embeddings,
+                              embeddings)
+        if self.normalize:
+            updated = F.normalize(updated, dim=1)
+
+        self.embeddings[indices] = updated
+        self.initialized[indices] = True
+
+    def get_missing_indices(self) -> np.ndarray:
+        """
+        Returns the indices of the samples which never passed through the model.
+        """
+        return torch.nonzero(~self.initialized).flatten().cpu().numpy()
+
+    @torch.no_grad()
+    def get_hard_references(self,
+                            embeddings: torch.Tensor,
+                            labels: torch.Tensor,
+                            n_negatives: int,
+                            n_positives: int = 0,
+                            indices: torch.Tensor = None,
+                            block_size: int = 65536):
+        """
+        Returns the bank embeddings which are the n_negatives closest samples with another label and the n_positives
+        farthest samples with the same label of at least one of the query embeddings, among the samples already in
+        the bank. The bank is processed by blocks of block_size samples.
+
+        Parameters:
+        - embeddings (torch.Tensor): The (B, D) query embeddings.
+        - labels (torch.Tensor): The (B,) labels of the queries.
+        - n_negatives (int): The number of hard negatives per query.
+        - n_positives (int): The number of hard positives per query.
+        - indices (torch.Tensor or None): The (B,) bank indices of the queries, so a query is not its own positive.
+
+        Returns:
+        - The (R, D) reference embeddings, their (R,) labels and their (R,) bank indices.
+        """
+        if self.labels is None:
+            raise ValueError("The memory bank needs the labels of the samples to find hard references.")
+
+        queries = embeddings.detach().to(self.device, dtype=torch.float32)
+        if self.normalize or self.metric == 'cosine':
+            queries = F.normalize(queries, dim=1)
+        labels = torch.as_tensor(labels, device=self.device).long()
+        queries_sq_norms = (queries * queries).sum(dim=1) if self.metric == 'euclidean' else None
+
+        best = {'negatives': (torch.zeros((len(queries), 0), device=self.device),
+                              torch.zeros((len(queries), 0), dtype=torch.long, device=self.device)),
+                'positives': (torch.zeros((len(queries), 0), device=self.device),
+                              torch.zeros((len(queries), 0), dtype=torch.long, device=self.device))}
+        for start in range(0, len(self), block_size):
+            block = self.embeddings[start:start + block_size]
+            if self.metric == 'cosine' and not self.normalize:
+                block = F.normalize(block, dim=1)
+            distances = pairwise_distances_block(queries, block, metric=self.metric, x_sq_norms=queries_sq_norms)
+            block_indices = torch.arange(start, start + len(block), device=self.device)
+
+            valid = self.initialized[start:start + len(block)].unsqueeze(0)
+            if indices is not None:
+                valid = valid & (block_indices.unsqueeze(0) != torch.as_tensor(indices, device=self.device).unsqueeze(1))
+            same_label = labels.unsqueeze(1) == self.labels[start:start + len(block)].unsqueeze(0)
+
+            for name, k, mask, largest in [('negatives', n_negatives, valid & ~same_label, False),
+                                           ('positives', n_positives, valid & same_label, True)]:
+                if k == 0:
+                    continue
+                masked_distances = distances.masked_fill(~mask, float('-inf') if largest else float('inf'))
+                best_distances, best_indices = best[name]
+                masked_distances = torch.cat([best_distances, masked_distances], dim=1)
+                all_indices = torch.cat([best_indices, block_indices.expand(len(queries), -1)], dim=1)
+                best_distances, top_k = torch.topk(masked_distances, k=min(k, masked_distances.shape[1]), dim=1,
+                                                   largest=largest)
+                best[name] = (best_distances, torch.gather(all_indices, 1, top_k))
+
+        references = []
+        for best_distances, best_indices in best.values():
+            references.append(best_indices[torch.isfinite(best_distances)])
+        references = torch.unique(torch.cat(references))
+
+        return self.embeddings[references], self.labels[references], references
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import torch
+from torch import nn
+from torchvision import models
+
+MODEL_REGISTRY_ENV_VAR = 'XPRIZE_MODEL_REGISTRY'
+REGISTRY_MANIFEST_NAME = 'registry.json'
+DINOV2_HUB_REPO = 'facebookresearch/dinov2'
+DINOV2_ARCHITECTURE_FOLDER_NAME = 'dinov2'
+
+RESNET_MODELS = {
+    'resnet50': (models.resnet50, models.ResNet50_Weights.DEFAULT),
+    'resnet101': (models.resnet101, models.ResNet101_Weights.DEFAULT),
+    'resnet152': (models.resnet152, models.ResNet152_Weights.DEFAULT),
+}
+
+# The weights files already hashed by this process, with their (size, mtime) when they were verified
+_verified_weights_files = {}
+
+
+def get_model_registry_root() -> Path or None:
+    """
+    Returns the local model registry folder, set by the XPRIZE_MODEL_REGISTRY environment variable, or None.
+
+    The registry is a folder holding the pretrained weights files of the backbones (saved state dicts),
+    a 'registry.json' manifest with the file name and sha256 of each weights file,
+    and the 'dinov2' architecture code (a copy of the facebookresearch/dinov2 torch hub repository).
+    It is built by download_to_model_registry on a machine with internet access and copied to the offline nodes.
+    """
+    registry_root = os.environ.get(MODEL_REGISTRY_ENV_VAR)
+    return Path(registry_root) if registry_root else None
+
+
+def _read_manifest(registry_root: Path) -> dict:
+    manifest_path = registry_root / REGISTRY_MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def _sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def register_model_weights(model_name: str, state_dict: dict, registry_root: str or Path):
+    """
+    Saves the weights of a model to the registry and adds them to its manifest with their sha256.
+    """
+    registry_root = Path(registry_root)
+    registry_root.mkdir(exist_ok=True, parents=True)
+
+    weights_file_name = f"{model_name}.pth"
+    torch.save(state_dict, registry_root / weights_file_name)
+
+    manifest = _read_manifest(registry_root)
+    manifest[model_name] = {'file': weights_file_name, 'sha256': _sha256(registry_root / weights_file_name)}
+    with open(registry_root / REGISTRY_MANIFEST_NAME, 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    print(f"Registered the '{model_name}' weights in {registry_root}.")
+
+
+def get_registered_weights_path(model_name: str) -> Path or None:
+    """
+    Returns the path of the weights of a model in the local model registry, after checking their sha256,
+    or None if there is no registry or the model is not in it.
+    """
+    registry_root = get_model_registry_root()
+    if registry_root is None:
+        return None
+
+    manifest = _read_manifest(registry_root)
+    if model_name not in manifest:
+        return None
+
+    weights_path = registry_root / manifest[model_name]['file']
+    if not weights_path.exists():
+        raise ValueError(f"The weights of '{model_name}' are in the model registry manifest, but {weights_path}"
+                         f" doesn't exist.")
+
+    file_stat = weights_path.stat()
+    if _verified_weights_files.get(weights_path) != (file_stat.st_size, file_stat.st_mtime):
+        if _sha256(weights_path) != manifest[model_name]['sha256']:
+            raise ValueError(f"The sha256 of {weights_path} doesn't match the model registry manifest,"
+                             f" the file is corrupted or was modified.")
+        _verified_weights_files[weights_path] = (file_stat.st_size, file_stat.st_mtime)
+
+    return weights_path
+
+
+def load_weights(weights_path: str or Path, map_location: str or torch.device = 'cpu'):
+    """
+    Loads a checkpoint or state dict saved with torch.save. The file is memory-mapped when possible, so the tensors
+    are paged in from the disk cache as load_state_dict copies them into the model, instead of being read up front.
+    """
+    try:
+        return torch.load(weights_path, map_location=map_location, mmap=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.1 has no mmap argument, and files saved in the legacy (non zip) format can't be memory-mapped
+        return torch.load(weights_path, map_location=map_location)
+
+
+def get_resnet_backbone(resnet_model: str, pretrained: bool = True) -> nn.Module:
+    """
+    Builds a torchvision ResNet with the ImageNet weights of the local model registry, or downloaded by torchvision
+    if the registry doesn't have them.
+
+    Parameters:
+    - resnet_model (str): 'resnet50', 'resnet101' or 'resnet152'.
+    - pretrained (bool): Whether to load the ImageNet weights. Should be False when a checkpoint is loaded afterwards.
+    """
+    if resnet_model not in RESNET_MODELS:
+        raise ValueError(f'Invalid resnet model: {resnet_model}')
+
+    architecture, default_weights = RESNET_MODELS[resnet_model]
+    if not pretrained:
+        return architecture(weights=None)
+
+    weights_path = get_registered_weights_path(resnet_model)
+    if weights_path is None:
+        return architecture(weights=default_weights)
+
+    backbone = architecture(weights=None)
+    backbone.load_state_dict(load_weights(weights_path))
+    return backbone
+
+
+def get_dinov2_backbone(model_name: str, pretrained: bool = True) -> nn.Module:
+    """
+    Builds a DINOv2 ViT from the architecture code and weights of the local model registry,
+    or from torch hub if the registry doesn't have them.
+
+    Parameters:
+    - model_name (str): The torch hub name of the model, e.g. 'dinov2_vitb14_reg'.
+    - pretrained (bool): Whether to load the pretrained weights.
+    """
+    registry_root = get_model_registry_root()
+    architecture_path = registry_root / DINOV2_ARCHITECTURE_FOLDER_NAME if registry_root else None
+    if architecture_path is None or not architecture_path.exists():
+        return torch.hub.load(DINOV2_HUB_REPO, model_name, pretrained=pretrained)
+
+    model = torch.hub.load(str(architecture_path), model_name, source='local', pretrained=False)
+    if pretrained:
+        weights_path = get_registered_weights_path(model_name)
+        if weights_path is None:
+            raise ValueError(f"The weights of '{model_name}' are not in the model registry {registry_root}.")
+        model.load_state_dict(load_weights(weights_path))
+
+    return model
+
+
+def download_to_model_registry(registry_root: str or Path, resnet_models: list, dinov2_models: list):
+    """
+    Downloads the pretrained weights of the given backbones, and the DINOv2 architecture code, to a registry folder
+    which can then be copied to the offline nodes and pointed to with the XPRIZE_MODEL_REGISTRY environment variable.
+
+    Parameters:
+    - registry_root (str or Path): The registry folder.
+    - resnet_models (list): The names of the ResNets, e.g. ['resnet50'].
+    - dinov2_models (list): The torch hub names of the DINOv2 models, e.g. ['dinov2_vitb14_reg'].
+    """
+    registry_root = Path(registry_root)
+
+    for resnet_model in resnet_models:
+        architecture, default_weights = RESNET_MODELS[resnet_model]
+        register_model_weights(resnet_model, architecture(weights=default_weights).state_dict(), registry_root)
+
+    for model_name in dinov2_models:
+        model = torch.hub.load(DINOV2_HUB_REPO, model_name, pretrained=True)
+        register_model_weights(model_name, model.state_dict(), registry_root)
+
+    if dinov2_models:
+        hub_repo_path = Path(torch.hub.get_dir()) / f"{DINOV2_HUB_REPO.replace('/', '_')}_main"
+        shutil.copytree(hub_repo_path, registry_root / DINOV2_ARCHITECTURE_FOLDER_NAME, dirs_exist_ok=True)
+
+
+if __name__ == '__main__':
+    download_to_model_registry(registry_root='./model_registry',
+                               resnet_models=['resnet50'],
+                               dinov2_models=['dinov2_vits14_reg', 'dinov2_vitb14_reg', 'dinov2_vitl14_reg'])
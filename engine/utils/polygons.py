@@ -0,0 +1,230 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import cv2
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from pycocotools import mask as mask_utils
+from shapely.geometry import Polygon
+
+
+def masks_to_polygons(masks: np.ndarray, simplify_tolerance: float = 1.0, batch_size: int = 256) -> List[Polygon]:
+    """
+    Converts a stack of binary masks to simplified shapely Polygons in a few vectorized calls.
+    Produces the same output as calling geodataset's mask_to_polygon on each mask (largest external contour,
+    simplified with preserve_topology=True, empty Polygon if the mask is empty), but instead of tracing every
+    full-size mask separately, each mask is cropped to its bounding box, all the crops of a batch are packed into
+    a single canvas traced by one cv2.findContours call, and the simplification is done by shapely on all
+    the polygons at once.
+
+    Parameters:
+    - masks (np.ndarray): The masks, in NHW or N1HW format.
+    - simplify_tolerance (float): The tolerance used to simplify the polygons.
+    - batch_size (int): The number of masks packed in the same canvas, which bounds the canvas memory.
+
+    Returns:
+    - A list of N shapely Polygons, in the same order as the masks.
+    """
+    masks = np.asarray(masks)
+    if masks.ndim == 4:
+        masks = masks.reshape(masks.shape[0], masks.shape[2], masks.shape[3])
+    if masks.ndim != 3:
+        raise ValueError(f"Masks must be in NHW or N1HW format, got shape {masks.shape}.")
+
+    polygons = []
+    for i in range(0, len(masks), batch_size):
+        polygons.extend(_masks_batch_to_polygons(masks[i:i + batch_size], simplify_tolerance=simplify_tolerance))
+
+    return polygons
+
+
+def rle_segmentations_to_polygons(segmentations: List[dict],
+                                  simplify_tolerance: float = 1.0,
+                                  batch_size: int = 256) -> List[Polygon]:
+    """
+    Converts a list of COCO RLE segmentations to simplified shapely Polygons.
+    The RLEs are decoded by batches of masks having the same size, and each batch goes through masks_to_polygons.
+
+    Parameters:
+    - segmentations (List[dict]): The COCO RLE segmentations, with 'size' and 'counts' keys.
+    - simplify_tolerance (float): The tolerance used to simplify the polygons.
+    - batch_size (int): The number of masks decoded at once, which bounds the decoded masks memory.
+
+    Returns:
+    - A list of shapely Polygons, in the same order as the segmentations.
+    """
+    polygons = [None] * len(segmentations)
+
+    indices_per_size = {}
+    for i, segmentation in enumerate(segmentations):
+        indices_per_size.setdefault(tuple(segmentation['size']), []).append(i)
+
+    for indices in indices_per_size.values():
+        for i in range(0, len(indices), batch_size):
+            batch_indices = indices[i:i + batch_size]
+            # pycocotools decodes a list of same-size RLEs into a single HWN array
+            masks = mask_utils.decode([segmentations[idx] for idx in batch_indices])
+            masks = masks.transpose((2, 0, 1))
+            batch_polygons = _masks_batch_to_polygons(masks, simplify_tolerance=simplify_tolerance)
+            for idx, polygon in zip(batch_indices, batch_polygons):
+                polygons[idx] = polygon
+
+    return polygons
+
+
+def tiles_polygons_gdf_to_crs_gdf(dataframe: gpd.GeoDataFrame, n_workers: int = None) -> gpd.GeoDataFrame:
+    """
+    Converts polygons from tile pixel coordinates to the CRS of their tiles, as a vectorized drop-in replacement of
+    geodataset's tiles_polygons_gdf_to_crs_gdf.
+    Each tile is opened once to get its affine transform, then the coordinates of all the polygons are extracted in a
+    single packed array, transformed at once with the affine of their tile, and written back into the geometries.
+    If the tiles don't all share the same CRS, the polygons are reprojected to the CRS of the first tile.
+
+    Parameters:
+    - dataframe (gpd.GeoDataFrame): The polygons in tile pixel coordinates, with a 'tile_path' column.
+    - n_workers (int): The number of processes reading the tiles affine transforms. Defaults to the number of CPUs, up to 8.
+
+    Returns:
+    - A GeoDataFrame with the same columns, with the polygons in CRS coordinates.
+    """
+    if 'tile_path' not in dataframe.columns:
+        raise ValueError("The dataframe must have a 'tile_path' column to get the affine transform of each polygon.")
+
+    tiles_ids, unique_tiles_paths = pd.factorize(dataframe['tile_path'].astype(str))
+
+    # rasterio holds the GIL while opening a tile (~2ms each), so the tiles headers are read by several processes
+    n_workers = n_workers if n_workers is not None else min(8, os.cpu_count() or 1)
+    if n_workers > 1 and len(unique_tiles_paths) > 4 * n_workers:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            tiles_headers = list(pool.map(_read_tile_affine_and_crs, unique_tiles_paths,
+                                          chunksize=math.ceil(len(unique_tiles_paths) / n_workers)))
+    else:
+        tiles_headers = [_read_tile_affine_and_crs(tile_path) for tile_path in unique_tiles_paths]
+    tiles_affines = np.array([tile_header[0] for tile_header in tiles_headers], dtype=np.float64).reshape(-1, 6)
+    tiles_crs = [tile_header[1] for tile_header in tiles_headers]
+
+    # set_coordinates replaces the geometries of the array it is given, so it works on a copy of the array
+    geometries = np.array(dataframe.geometry.values, dtype=object)
+    coords = shapely.get_coordinates(geometries)
+    n_coords = shapely.get_num_coordinates(geometries)
+    # The coordinates of each geometry are contiguous, so repeating the affine of each geometry is much cheaper
+    # than gathering the affine of each coordinate
+    geometries_affines = tiles_affines[tiles_ids]
+    if np.all(tiles_affines[:, [1, 3]] == 0):
+        # North-up tiles, the affine is only a scale and an offset on each axis
+        crs_coords = coords * np.repeat(geometries_affines[:, [0, 4]], n_coords, axis=0)
+        crs_coords += np.repeat(geometries_affines[:, [2, 5]], n_coords, axis=0)
+    else:
+        coords_affines = np.repeat(geometries_affines, n_coords, axis=0)
+        crs_coords = np.empty_like(coords)
+        crs_coords[:, 0] = coords_affines[:, 0] * coords[:, 0] + coords_affines[:, 1] * coords[:, 1] + coords_affines[:, 2]
+        crs_coords[:, 1] = coords_affines[:, 3] * coords[:, 0] + coords_affines[:, 4] * coords[:, 1] + coords_affines[:, 5]
+    crs_geometries = shapely.set_coordinates(geometries, crs_coords)
+
+    crs = tiles_crs[0] if tiles_crs else None
+    gdf = gpd.GeoDataFrame(dataframe.drop(columns=dataframe.geometry.name), geometry=crs_geometries, crs=crs)
+
+    tiles_crs_wkt = [tile_crs.to_wkt() if tile_crs is not None else None for tile_crs in tiles_crs]
+    for crs_wkt in set(tiles_crs_wkt) - {tiles_crs_wkt[0] if tiles_crs_wkt else None}:
+        rows = np.isin(tiles_ids, [i for i, tile_crs_wkt in enumerate(tiles_crs_wkt) if tile_crs_wkt == crs_wkt])
+        gdf.loc[rows, gdf.geometry.name] = gpd.GeoSeries(crs_geometries[rows], crs=crs_wkt).to_crs(crs).values
+
+    return gdf
+
+
+def _read_tile_affine_and_crs(tile_path: str):
+    with rasterio.open(tile_path) as src:
+        transform = src.transform
+        return [transform.a, transform.b, transform.c, transform.d, transform.e, transform.f], src.crs
+
+
+def _masks_batch_to_polygons(masks: np.ndarray, simplify_tolerance: float) -> List[Polygon]:
+    n_masks = masks.shape[0]
+    if n_masks == 0:
+        return []
+
+    # Bounding boxes of all the masks at once
+    rows_any = masks.any(axis=2)
+    cols_any = masks.any(axis=1)
+    non_empty = rows_any.any(axis=1)
+    y0 = np.argmax(rows_any, axis=1)
+    y1 = masks.shape[1] - np.argmax(rows_any[:, ::-1], axis=1)
+    x0 = np.argmax(cols_any, axis=1)
+    x1 = masks.shape[2] - np.argmax(cols_any[:, ::-1], axis=1)
+
+    output = [Polygon() for _ in range(n_masks)]
+    masks_ids = np.flatnonzero(non_empty)
+    if len(masks_ids) == 0:
+        return output
+
+    # Packing the crops on shelves of a single canvas, with a 1 pixel zero border around each crop
+    # so that contours never touch each other or the canvas edges.
+    heights = y1[masks_ids] - y0[masks_ids] + 2
+    widths = x1[masks_ids] - x0[masks_ids] + 2
+    order = np.argsort(-heights, kind='stable')
+    canvas_width = max(int(widths.max()), int(np.sqrt(np.sum(heights * widths))))
+
+    slot_x = np.zeros(len(masks_ids), dtype=np.int64)
+    slot_y = np.zeros(len(masks_ids), dtype=np.int64)
+    shelves_y = [0]
+    shelf_height = 0
+    cursor_x = 0
+    for idx in order:
+        if cursor_x + widths[idx] > canvas_width:
+            shelves_y.append(shelves_y[-1] + shelf_height)
+            shelf_height = 0
+            cursor_x = 0
+        slot_x[idx] = cursor_x
+        slot_y[idx] = shelves_y[-1]
+        cursor_x += widths[idx]
+        shelf_height = max(shelf_height, heights[idx])
+    canvas_height = shelves_y[-1] + shelf_height
+
+    canvas = np.zeros((canvas_height, canvas_width), dtype=np.uint8)
+    for slot_idx, mask_id in enumerate(masks_ids):
+        sy, sx = slot_y[slot_idx] + 1, slot_x[slot_idx] + 1
+        canvas[sy:sy + heights[slot_idx] - 2, sx:sx + widths[slot_idx] - 2] = \
+            masks[mask_id, y0[mask_id]:y1[mask_id], x0[mask_id]:x1[mask_id]]
+
+    contours, _ = cv2.findContours(canvas, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contours = [contour.reshape(-1, 2) for contour in contours if len(contour) >= 3]
+    if len(contours) == 0:
+        return output
+
+    # Finding the slot of each contour from its first point: first its shelf, then its position on the shelf
+    contours_lengths = np.array([len(contour) for contour in contours])
+    coords = np.concatenate(contours, axis=0).astype(np.float64)
+    first_points = coords[np.concatenate([[0], np.cumsum(contours_lengths)[:-1]])]
+    slots_sort = np.lexsort((slot_x, slot_y))
+    slots_keys = slot_y[slots_sort] * canvas_width + slot_x[slots_sort]
+    first_points_keys = (np.asarray(shelves_y)[np.searchsorted(shelves_y, first_points[:, 1], side='right') - 1]
+                         * canvas_width + first_points[:, 0])
+    contours_slots = slots_sort[np.searchsorted(slots_keys, first_points_keys, side='right') - 1]
+
+    # Moving the contours back to their mask coordinates
+    contours_masks_ids = masks_ids[contours_slots]
+    points_slots = np.repeat(contours_slots, contours_lengths)
+    points_masks_ids = np.repeat(contours_masks_ids, contours_lengths)
+    coords[:, 0] += x0[points_masks_ids] - slot_x[points_slots] - 1
+    coords[:, 1] += y0[points_masks_ids] - slot_y[points_slots] - 1
+
+    rings = shapely.linearrings(coords, indices=np.repeat(np.arange(len(contours)), contours_lengths))
+    candidates = shapely.polygons(rings)
+
+    # Keeping the largest valid polygon of each mask
+    areas = np.where(shapely.is_valid(candidates), shapely.area(candidates), -1.0)
+    candidates_order = np.lexsort((-areas, contours_masks_ids))
+    _, first_candidates = np.unique(contours_masks_ids[candidates_order], return_index=True)
+    best_candidates = candidates_order[first_candidates]
+    best_candidates = best_candidates[areas[best_candidates] >= 0]
+
+    simplified = shapely.simplify(candidates[best_candidates], tolerance=simplify_tolerance, preserve_topology=True)
+    for mask_id, polygon in zip(contours_masks_ids[best_candidates], simplified):
+        output[mask_id] = polygon
+
+    return output
@@ -16,7 +16,8 @@ def collate_fn_segmentation(batch):
                'labels': torch.tensor(np.array(item[1]['labels']), dtype=torch.int8),
                'area': torch.tensor(np.array(item[1]['area']).astype(np.int32), dtype=torch.float32),
                'iscrowd': torch.tensor(np.array(item[1]['iscrowd']), dtype=torch.bool),
-               'image_id': torch.tensor(np.array(item[1]['image_id']), dtype=torch.int16)} for item in batch]
+               # int64, the dataset indices of the tiles are used to place the inference results
+               'image_id': torch.tensor(np.array(item[1]['image_id']), dtype=torch.int64)} for item in batch]
 
     if 'labels_polygons' in batch[0][1]:
         for i, item in enumerate(batch):
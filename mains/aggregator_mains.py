@@ -6,6 +6,7 @@ from geodataset.utils import CocoNameConvention
 from shapely import Polygon
 
 from config.config_parsers.aggregator_parsers import AggregatorIOConfig, AggregatorConfig
+from engine.utils.geoparquet import is_geoparquet_path, parse_geoparquet_name, geoparquet_to_tiles_polygons
 
 
 def aggregator_main_with_polygons_input(config: AggregatorConfig,
@@ -48,7 +49,43 @@ def aggregator_main_with_polygons_input(config: AggregatorConfig,
     return output_path
 
 
+def aggregator_main_with_geoparquet_input(config: AggregatorIOConfig):
+    product_name, scale_factor, ground_resolution, fold = parse_geoparquet_name(Path(config.coco_path).name)
+
+    coco_output_path = CocoNameConvention.create_name(product_name=product_name,
+                                                      fold=f"{fold}aggregator",
+                                                      scale_factor=scale_factor,
+                                                      ground_resolution=ground_resolution)
+
+    aggregator_output_file = Path(config.output_folder) / coco_output_path
+
+    tiles_paths, polygons, polygons_scores = geoparquet_to_tiles_polygons(config.coco_path)
+    if config.scores_weights:
+        polygons_scores = {score_name: polygons_scores[score_name] for score_name in config.scores_weights}
+        polygons_scores_weights = config.scores_weights
+    else:
+        default_score_name = 'detector_score' if config.polygon_type == 'box' else 'segmenter_score'
+        polygons_scores = {default_score_name: polygons_scores[default_score_name]}
+        polygons_scores_weights = {default_score_name: 1.0}
+
+    aggregator_main_with_polygons_input(
+        config=config,
+        output_path=str(aggregator_output_file),
+        tiles_paths=tiles_paths,
+        polygons=polygons,
+        polygons_scores=polygons_scores,
+        polygons_scores_weights=polygons_scores_weights
+    )
+
+    config.save_yaml_config(output_path=Path(config.output_folder) / "aggregator_config.yaml")
+
+    return aggregator_output_file
+
+
 def aggregator_main_with_coco_input(config: AggregatorIOConfig):
+    if is_geoparquet_path(config.coco_path):
+        return aggregator_main_with_geoparquet_input(config)
+
     output_folder = Path(config.output_folder)
     output_folder.mkdir(exist_ok=False, parents=True)
 
@@ -1,15 +1,24 @@
 from pathlib import Path
 
-from geodataset.utils import CocoNameConvention, GeoPackageNameConvention, coco_to_geopackage
-
+from geodataset.utils import CocoNameConvention, GeoPackageNameConvention
 
 from config.config_parsers.coco_to_geopackage_parsers import CocoToGeopackageIOConfig
+from engine.utils.coco import coco_to_tiles_polygons_gdf
+from engine.utils.geoparquet import is_geoparquet_path, parse_geoparquet_name, geoparquet_to_crs_gdf
+from engine.utils.polygons import tiles_polygons_gdf_to_crs_gdf
 
 
 def coco_to_geopackage_main(config: CocoToGeopackageIOConfig):
+    """
+    Converts a COCO (or GeoParquet) file to a geopackage in the CRS of its tiles. Each polygon gets a 'polygon_id',
+    which the classifier tilerizer carries to its tiles to map them back to these polygons without decoding masks.
+    """
     output_folder = Path(config.output_folder)
     output_folder.mkdir(exist_ok=True, parents=True)
 
+    if is_geoparquet_path(config.coco_path):
+        return _geoparquet_to_geopackage_main(config)
+
     print('Converting COCO file to geopackage...')
 
     product_name, scale_factor, ground_resolution, fold = CocoNameConvention.parse_name(Path(config.coco_path).name)
@@ -21,11 +30,32 @@ def coco_to_geopackage_main(config: CocoToGeopackageIOConfig):
 
     geojson_output_path = output_folder / geojson_name
 
-    gdf = coco_to_geopackage(
-        coco_json_path=config.coco_path,
-        images_directory=config.input_tiles_root,
-        convert_to_crs_coordinates=True,
-        geopackage_output_path=str(geojson_output_path),
-    )
+    gdf = coco_to_tiles_polygons_gdf(coco_json_path=config.coco_path, images_directory=config.input_tiles_root)
+    gdf = tiles_polygons_gdf_to_crs_gdf(gdf)
+    gdf['polygon_id'] = range(len(gdf))
+    gdf.to_file(str(geojson_output_path), driver='GPKG')
+
+    return gdf, geojson_output_path
+
+
+def _geoparquet_to_geopackage_main(config: CocoToGeopackageIOConfig):
+    output_folder = Path(config.output_folder)
+    output_folder.mkdir(exist_ok=True, parents=True)
+
+    print('Converting GeoParquet file to geopackage...')
+
+    product_name, scale_factor, ground_resolution, fold = parse_geoparquet_name(Path(config.coco_path).name)
+
+    geojson_name = GeoPackageNameConvention.create_name(product_name=product_name,
+                                                        fold=fold,
+                                                        scale_factor=scale_factor,
+                                                        ground_resolution=ground_resolution)
+
+    geojson_output_path = output_folder / geojson_name
+
+    # No RLE to decode, the polygons are already stored as WKB and only have to be moved to the CRS of their tiles
+    gdf = geoparquet_to_crs_gdf(config.coco_path)
+    gdf['polygon_id'] = range(len(gdf))
+    gdf.to_file(str(geojson_output_path), driver='GPKG')
 
     return gdf, geojson_output_path
@@ -8,6 +8,7 @@ from geodataset.utils import TileNameConvention, CocoNameConvention, COCOGenerat
 from config.config_parsers.detector_parsers import DetectorTrainIOConfig, DetectorScoreIOConfig, \
     DetectorInferIOConfig
 from engine.detector.utils import detector_result_to_lists
+from engine.utils.geoparquet import create_geoparquet_name, tiles_polygons_to_geoparquet
 from engine.utils.utils import collate_fn_detection, collate_fn_images
 from engine.detector.detector_pipelines import DetectorTrainPipeline, DetectorScorePipeline, DetectorInferencePipeline
 
@@ -70,7 +71,7 @@ def detector_infer_main(config: DetectorInferIOConfig):
                                       transform=None)  # No augmentation for testing
 
     if config.output_folder:
-        return _detector_infer_main_coco_output(config=config, infer_ds=infer_ds)
+        return _detector_infer_main_geoparquet_output(config=config, infer_ds=infer_ds)
     else:
         return _detector_infer_main_polygons_output(config=config, infer_ds=infer_ds)
 
@@ -88,7 +89,7 @@ def _detector_infer_main_polygons_output(config: DetectorInferIOConfig, infer_ds
     return tiles_paths, boxes, boxes_scores
 
 
-def _detector_infer_main_coco_output(config: DetectorInferIOConfig, infer_ds: UnlabeledRasterDataset):
+def _detector_infer_main_geoparquet_output(config: DetectorInferIOConfig, infer_ds: UnlabeledRasterDataset):
     output_folder = Path(config.output_folder)
     output_folder.mkdir(exist_ok=False, parents=True)
 
@@ -101,30 +102,20 @@ def _detector_infer_main_coco_output(config: DetectorInferIOConfig, infer_ds: Un
     else:
         raster_name = list(raster_names)[0]
 
-    coco_output_name = CocoNameConvention.create_name(fold=config.infer_aoi_name,
-                                                      product_name=raster_name)
+    geoparquet_output_name = create_geoparquet_name(fold=config.infer_aoi_name,
+                                                    product_name=raster_name)
 
     tiles_paths, boxes, boxes_scores = _detector_infer_main_polygons_output(config=config, infer_ds=infer_ds)
 
-    coco_output_path = output_folder / f'{coco_output_name}'
+    geoparquet_output_path = output_folder / geoparquet_output_name
 
-    other_attributes = [[{'detector_score': score} for score in scores] for scores in boxes_scores]
+    print(f"Saving the box predictions to a GeoParquet file...")
 
-    print(f"Saving the box predictions to a COCO file (might take a while)...")
-
-    coco_generator = COCOGenerator(description=f"Inference predictions for {raster_name}.",
-                                   tiles_paths=tiles_paths,
-                                   polygons=boxes,
-                                   categories=None,
-                                   scores=None,
-                                   other_attributes=other_attributes,
-                                   output_path=coco_output_path,
-                                   use_rle_for_labels=True,
-                                   n_workers=config.coco_n_workers,
-                                   coco_categories_list=None)
-    coco_generator.generate_coco()
+    tiles_polygons_to_geoparquet(output_path=geoparquet_output_path,
+                                 tiles_paths=tiles_paths,
+                                 polygons=boxes,
+                                 polygons_scores={'detector_score': boxes_scores})
 
     config.save_yaml_config(output_path=output_folder / "detector_infer_config.yaml")
 
-    return tiles_paths, boxes, boxes_scores, coco_output_path
-
+    return tiles_paths, boxes, boxes_scores, geoparquet_output_path
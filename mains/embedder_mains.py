@@ -8,6 +8,7 @@ from config.config_parsers.embedder_parsers import EmbedderInferIOConfig, DINOv2
     DINOv2InferIOConfig, SiameseInferIOConfig
 from engine.embedder.dinov2.dinov2 import DINOv2Inference
 from engine.embedder.siamese.siamese_infer import siamese_infer
+from engine.utils.embeddings_store import POLYGON_ID_COLUMN, gdf_embeddings_to_stores
 
 
 def dino_v2_infer_main(config: DINOv2InferConfig, segmentation_dataset: SegmentationLabeledRasterCocoDataset):
@@ -66,6 +67,10 @@ def embedder_infer_main(config: EmbedderInferIOConfig):
         raise NotImplementedError
 
     output_path = output_folder / f"{product_name}_embeddings_{fold}.csv"
+    # The embeddings are saved as a binary store next to the csv, keyed by polygon_id (see engine.utils.embeddings_store)
+    if POLYGON_ID_COLUMN not in embeddings_df.columns:
+        embeddings_df[POLYGON_ID_COLUMN] = range(len(embeddings_df))
+    embeddings_df = gdf_embeddings_to_stores(embeddings_df, geopackage_path=output_path)
     embeddings_df.to_csv(output_path, index=False)
 
     config.save_yaml_config(output_path=output_folder / "embedder_infer_config.yaml")
@@ -3,21 +3,23 @@ from pathlib import Path
 import geopandas as gpd
 import torch
 from geodataset.dataset import DetectionLabeledRasterCocoDataset
-from geodataset.utils import CocoNameConvention, COCOGenerator
+from geodataset.utils import CocoNameConvention
 
 from config.config_parsers.segmenter_parsers import SegmenterInferIOConfig, SegmenterScoreIOConfig
+from engine.segmenter.masks_cache import load_masks_cache, save_masks_cache
 from engine.segmenter.sam import SamPredictorWrapper
+from engine.utils.geoparquet import create_geoparquet_name, tiles_polygons_to_geoparquet
 from engine.segmenter.metrics import Evaluator
 
 
 def segmenter_infer_main(config: SegmenterInferIOConfig):
     if config.output_folder:
-        return _segmenter_infer_main_coco_output(config)
+        return _segmenter_infer_main_geoparquet_output(config)
     else:
         return _segmenter_infer_main_polygons_output(config)
 
 
-def _segmenter_infer_main_coco_output(config: SegmenterInferIOConfig):
+def _segmenter_infer_main_geoparquet_output(config: SegmenterInferIOConfig):
     output_folder = Path(config.output_folder)
     output_folder.mkdir(exist_ok=False, parents=True)
 
@@ -27,38 +29,27 @@ def _segmenter_infer_main_coco_output(config: SegmenterInferIOConfig):
     assert tiles_path.is_dir() and tiles_path.name == "tiles", \
         "The tiles_path must be the path of a directory named 'tiles'."
 
-    coco_output_name = CocoNameConvention.create_name(product_name=product_name,
-                                                      fold=f"{fold}segmenter",
-                                                      scale_factor=scale_factor,
-                                                      ground_resolution=ground_resolution)
+    geoparquet_output_name = create_geoparquet_name(product_name=product_name,
+                                                    fold=f"{fold}segmenter",
+                                                    scale_factor=scale_factor,
+                                                    ground_resolution=ground_resolution)
 
     tiles_paths, masks, masks_scores, segmenter_boxes_scores = _segmenter_infer_main_polygons_output(config=config)
 
-    coco_output_path = output_folder / coco_output_name
+    geoparquet_output_path = output_folder / geoparquet_output_name
 
-    other_attributes = [[{'segmenter_score': mask_score} for mask_score in tile_masks_scores] for tile_masks_scores in masks_scores]
+    polygons_scores = {'segmenter_score': masks_scores}
     if segmenter_boxes_scores[0][0] is not None:
-        for i, tile_boxes_scores in enumerate(segmenter_boxes_scores):
-            for j, box_score in enumerate(tile_boxes_scores):
-                other_attributes[i][j]['detector_score'] = box_score
-
-    coco_generator = COCOGenerator(
-        description=f"Aggregated boxes from multiple tiles.",
-        tiles_paths=tiles_paths,
-        polygons=masks,
-        scores=None,
-        categories=None,  # TODO add support for categories
-        other_attributes=other_attributes,
-        output_path=coco_output_path,
-        use_rle_for_labels=True,  # TODO make this a parameter to the class
-        n_workers=5,  # TODO make this a parameter to the class
-        coco_categories_list=None  # TODO make this a parameter to the class
-    )
-    coco_generator.generate_coco()
+        polygons_scores['detector_score'] = segmenter_boxes_scores
+
+    tiles_polygons_to_geoparquet(output_path=geoparquet_output_path,
+                                 tiles_paths=tiles_paths,
+                                 polygons=masks,
+                                 polygons_scores=polygons_scores)
 
     config.save_yaml_config(output_path=output_folder / "segmenter_infer_config.yaml")
 
-    return tiles_paths, masks, masks_scores, segmenter_boxes_scores, coco_output_path
+    return tiles_paths, masks, masks_scores, segmenter_boxes_scores, geoparquet_output_path
 
 
 def _segmenter_infer_main_polygons_output(config: SegmenterInferIOConfig):
@@ -83,7 +74,20 @@ def _segmenter_infer_main_polygons_output(config: SegmenterInferIOConfig):
         box_batch_size=config.box_batch_size
     )
 
-    tiles_paths, masks, masks_scores = sam.infer_on_multi_box_dataset(dataset=dataset)
+    previous_masks_cache = load_masks_cache(config.previous_masks_cache_path) if config.previous_masks_cache_path else None
+
+    tiles_paths, tiles_boxes, masks, masks_scores = sam.infer_on_multi_box_dataset(
+        dataset=dataset,
+        previous_masks_cache=previous_masks_cache,
+        incremental_iou_threshold=config.incremental_iou_threshold
+    )
+
+    if config.masks_cache_output_path:
+        save_masks_cache(output_path=Path(config.masks_cache_output_path),
+                         tiles_paths=tiles_paths,
+                         tiles_boxes=tiles_boxes,
+                         tiles_masks_polygons=masks,
+                         tiles_masks_scores=masks_scores)
 
     # making sure the model is released from memory
     torch.cuda.reset_peak_memory_stats()
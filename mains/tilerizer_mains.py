@@ -5,6 +5,7 @@ from geodataset.tilerize import RasterTilerizer, LabeledRasterTilerizer, Polygon
 
 from config.config_parsers.tilerizer_parsers import TilerizerIOConfig
 from engine.tilerizer.utils import parse_tilerizer_aoi_config
+from engine.utils.geoparquet import is_geoparquet_path, geoparquet_to_crs_gdf
 
 
 def tilerizer_main(config: TilerizerIOConfig):
@@ -12,11 +13,18 @@ def tilerizer_main(config: TilerizerIOConfig):
     output_folder.mkdir(exist_ok=False, parents=True)
 
     aois_config = parse_tilerizer_aoi_config(config)
+
+    labels_path = config.labels_path
+    if labels_path and is_geoparquet_path(labels_path):
+        # geodataset loads the labels based on their file extension, so GeoParquet labels are handed over as a geopackage
+        labels_path = output_folder / Path(labels_path).with_suffix('.gpkg').name
+        geoparquet_to_crs_gdf(config.labels_path).to_file(labels_path, driver='GPKG')
+
     if config.tile_type == 'tile':
-        if config.labels_path:
+        if labels_path:
             tilerizer = LabeledRasterTilerizer(
                 raster_path=Path(config.raster_path),
-                labels_path=Path(config.labels_path),
+                labels_path=Path(labels_path),
                 output_path=Path(config.output_folder),
                 tile_size=config.tile_size,
                 tile_overlap=config.tile_overlap,
@@ -48,7 +56,7 @@ def tilerizer_main(config: TilerizerIOConfig):
         tilerizer = PolygonTilerizer(
             raster_path=Path(config.raster_path),
             output_path=Path(config.output_folder),
-            labels_path=Path(config.labels_path),
+            labels_path=Path(labels_path),
             tile_size=config.tile_size,
             use_variable_tile_size=config.use_variable_tile_size,
             variable_tile_size_pixel_buffer=config.variable_tile_size_pixel_buffer,